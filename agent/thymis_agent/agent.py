@@ -9,6 +9,8 @@ import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import urllib.parse
 import uuid
 from datetime import timezone
 from typing import Any, Dict, List, Literal, Optional, Tuple, Union
@@ -173,6 +175,8 @@ class AgentToRelayMessage(BaseModel):
         "EtRSwitchToNewConfigResultMessage",
         "EtRMetricsMessage",
         "EtRNetworkInterfacesMessage",
+        "EtRFetchClosureResultMessage",
+        "EtRStorePathsResultMessage",
     ] = Field(discriminator="kind")
 
 
@@ -187,6 +191,9 @@ class EtRSwitchToNewConfigResultMessage(BaseModel):
     switch_success: bool | None = None  # in v3 final
     stdout: str | None = None  # in v3 final
     stderr: str | None = None  # in v3 final
+    # hash of /run/current-system after the switch, the start message only
+    # has the one the agent connected with
+    build_hash: Optional[str] = None
 
 
 class EtRMetricsMessage(BaseModel):
@@ -202,6 +209,23 @@ class EtRNetworkInterfacesMessage(BaseModel):
     network_interfaces: List[Dict[str, Any]]
 
 
+class EtRStorePathsResultMessage(BaseModel):
+    kind: Literal["store_paths_result"] = "store_paths_result"
+    task_id: uuid.UUID
+    checked: int
+    missing: List[str]
+    error: Optional[str] = None
+    query_id: Optional[uuid.UUID] = None
+
+
+class EtRFetchClosureResultMessage(BaseModel):
+    kind: Literal["fetch_closure_result"] = "fetch_closure_result"
+    task_id: uuid.UUID
+    success: bool
+    stdout: str
+    stderr: str
+
+
 class RelayToAgentMessage(BaseModel):
     # This is a custom message that the relay sends to the agent
     inner: Union[
@@ -210,6 +234,8 @@ class RelayToAgentMessage(BaseModel):
         "RtESuccesfullySSHConnectedMessage",
         "RtESendSecretsMessage",
         "RtEUpdateHostnameMessage",
+        "RtEFetchClosureMessage",
+        "RtEQueryStorePathsMessage",
     ] = Field(discriminator="kind")
 
 
@@ -248,6 +274,22 @@ class RtEUpdateHostnameMessage(BaseModel):
     hostname: str
 
 
+class RtEQueryStorePathsMessage(BaseModel):
+    # answered with the paths that are not valid in the store of the device
+    kind: Literal["query_store_paths"] = "query_store_paths"
+    paths: List[str]
+    task_id: uuid.UUID
+    query_id: Optional[uuid.UUID] = None
+
+
+class RtEFetchClosureMessage(BaseModel):
+    # substitute the closure from the binary cache served at /agent/nix-cache
+    kind: Literal["fetch_closure"] = "fetch_closure"
+    store_path: str
+    trusted_public_key: str
+    task_id: uuid.UUID
+
+
 class EdgeAgentToRelayStartMessage(ea.EtRStartMessage):
     token: str
     hardware_ids: Dict[str, str]
@@ -257,6 +299,8 @@ class EdgeAgentToRelayStartMessage(ea.EtRStartMessage):
     network_interfaces: List[Dict[str, Any]] = []
     ram_bytes: Optional[int] = None
     last_error: Optional[str] = None
+    # hash of the running /run/current-system store path
+    build_hash: Optional[str] = None
 
 
 def replace_url_protocol_with_ws(url: str) -> str:
@@ -322,6 +366,7 @@ class Agent(ea.EdgeAgent):
                         AgentToRelayMessage(
                             inner=EtRSwitchToNewConfigResultMessage(
                                 task_id=message.inner.task_id,
+                                build_hash=self.detect_build_hash(),
                                 configuration_id=message.inner.configuration_id,
                                 config_commit=message.inner.config_commit,
                                 is_activated=False,
@@ -458,6 +503,7 @@ class Agent(ea.EdgeAgent):
                             AgentToRelayMessage(
                                 inner=EtRSwitchToNewConfigResultMessage(
                                     task_id=message.inner.task_id,
+                                    build_hash=self.detect_build_hash(),
                                     configuration_id=message.inner.configuration_id,
                                     config_commit=message.inner.config_commit,
                                     is_activated=False,
@@ -477,6 +523,7 @@ class Agent(ea.EdgeAgent):
                         AgentToRelayMessage(
                             inner=EtRSwitchToNewConfigResultMessage(
                                 task_id=message.inner.task_id,
+                                build_hash=self.detect_build_hash(),
                                 configuration_id=message.inner.configuration_id,
                                 config_commit=message.inner.config_commit,
                                 is_activated=is_activated,
@@ -529,9 +576,81 @@ class Agent(ea.EdgeAgent):
                             )
                         else:
                             logger.info("syslog.service reloaded successfully")
+            case RtEFetchClosureMessage():
+                asyncio.create_task(self.fetch_closure(message.inner))
+            case RtEQueryStorePathsMessage():
+                asyncio.create_task(self.query_store_paths(message.inner))
             case _:
                 logger.error("Unknown message: %s", message)
 
+    async def query_store_paths(self, message: RtEQueryStorePathsMessage):
+        proc = await asyncio.create_subprocess_exec(
+            "nix-store",
+            "--check-validity",
+            "--print-invalid",
+            *message.paths,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            logger.error("Failed to check store paths: %s", stderr.decode())
+        await self.websocket.send(
+            AgentToRelayMessage(
+                inner=EtRStorePathsResultMessage(
+                    task_id=message.task_id,
+                    checked=len(message.paths),
+                    missing=stdout.decode().split(),
+                    error=stderr.decode() if proc.returncode != 0 else None,
+                    query_id=message.query_id,
+                )
+            ).model_dump_json()
+        )
+
+    async def fetch_closure(self, message: RtEFetchClosureMessage):
+        logger.info("Fetching closure %s from the controller", message.store_path)
+        # the cache accepts the agent token as password
+        with tempfile.NamedTemporaryFile("w", suffix=".netrc") as netrc:
+            host = urllib.parse.urlparse(self.controller_host).hostname
+            netrc.write(f"machine {host} login thymis password {self.token}\n")
+            netrc.flush()
+            args = [
+                "nix-store",
+                "--realise",
+                message.store_path,
+                "--option",
+                "substituters",
+                f"{self.controller_host.rstrip('/')}/agent/nix-cache",
+                "--option",
+                "trusted-public-keys",
+                message.trusted_public_key,
+                "--option",
+                "netrc-file",
+                netrc.name,
+                "--option",
+                "narinfo-cache-negative-ttl",
+                "0",
+            ]
+            proc = await asyncio.create_subprocess_exec(
+                args[0],
+                *args[1:],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            logger.error("Failed to fetch closure: %s", stderr.decode())
+        await self.websocket.send(
+            AgentToRelayMessage(
+                inner=EtRFetchClosureResultMessage(
+                    task_id=message.task_id,
+                    success=proc.returncode == 0,
+                    stdout=stdout.decode(),
+                    stderr=stderr.decode(),
+                )
+            ).model_dump_json()
+        )
+
     @classmethod
     def place_secrets_on_message(cls, message: RtESendSecretsMessage):
         secrets = message.secrets
@@ -744,6 +863,7 @@ class Agent(ea.EdgeAgent):
             network_interfaces=self.detect_network_interfaces(),
             ram_bytes=self.detect_ram_bytes(),
             last_error=last_error,
+            build_hash=self.detect_build_hash(),
         )
 
     async def on_connection_closed(self):
@@ -825,8 +945,12 @@ class Agent(ea.EdgeAgent):
     def detect_hostname(self):
         return socket.gethostname()
 
-    def detect_build_hash(self):
-        store_path = os.readlink("/run/current-system")
+    def detect_build_hash(self) -> Optional[str]:
+        try:
+            store_path = os.readlink("/run/current-system")
+        except OSError as e:
+            logger.debug("Cannot read /run/current-system: %s", e)
+            return None
         return store_path[len("/nix/store/") :].split("-")[0]
 
     def detect_public_key(self):
@@ -0,0 +1,136 @@
+"""
+Benchmarks for the nix log parsing done in run_command.
+
+Every scenario runs in its own process, so the reported peak RSS only covers
+the fixture and the parser. Output is fed in reads of --read-size bytes, and
+every read is followed by a flush as in run_command: take_complete_lines,
+process_buffer and take_status_update. get_model is timed separately.
+
+    python benchmarks/bench_nix_log_parse.py [--size small|medium|large]
+        [--kind build|copy] [--capture build.log ...] [--validate]
+"""
+
+import argparse
+import multiprocessing
+import pathlib
+import resource
+import statistics
+import time
+
+from nix_log_fixtures import GENERATORS, SIZES
+from thymis_controller.nix.log_parse import NixParser
+
+
+def load_fixture(kind: str, size: str, capture: str | None) -> bytes:
+    if capture is not None:
+        return pathlib.Path(capture).read_bytes()
+    return GENERATORS[kind](SIZES[size])
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_scenario(kind, size, capture, read_size, validate, results):
+    log = load_fixture(kind, size, capture)
+    lines = log.count(b"\n")
+    parser = NixParser(validate=validate)
+    buffer = bytearray()
+    take_times, process_times, update_times, flush_times = [], [], [], []
+
+    start = time.perf_counter()
+    for offset in range(0, len(log), read_size):
+        buffer += log[offset : offset + read_size]
+        flush_start = time.perf_counter()
+        complete = parser.take_complete_lines(buffer)
+        taken = time.perf_counter()
+        parser.process_buffer(complete)
+        processed = time.perf_counter()
+        parser.take_status_update()
+        updated = time.perf_counter()
+        take_times.append(taken - flush_start)
+        process_times.append(processed - taken)
+        update_times.append(updated - processed)
+        flush_times.append(updated - flush_start)
+    parser.process_buffer(buffer)
+    elapsed = time.perf_counter() - start
+
+    model_times = []
+    for _ in range(20):
+        model_start = time.perf_counter()
+        parser.get_model()
+        model_times.append(time.perf_counter() - model_start)
+
+    results.put(
+        {
+            "name": capture or f"{kind}/{size}",
+            "lines": lines,
+            "seconds": elapsed,
+            "flushes": len(flush_times),
+            "take_complete_lines": sum(take_times),
+            "process_buffer": sum(process_times),
+            "take_status_update": sum(update_times),
+            "flush_p50": percentile(flush_times, 0.5),
+            "flush_p99": percentile(flush_times, 0.99),
+            "flush_max": max(flush_times, default=0.0),
+            "get_model": statistics.median(model_times),
+            # kilobytes on linux
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def report(result: dict):
+    ms = 1000
+    print(
+        f"{result['name']}: {result['lines']} lines in {result['seconds']:.2f}s, "
+        f"{result['lines'] / result['seconds']:,.0f} lines/s, "
+        f"peak RSS {result['peak_rss_mib']:.1f} MiB"
+    )
+    print(
+        f"  {result['flushes']} flushes: p50 {result['flush_p50'] * ms:.3f}ms, "
+        f"p99 {result['flush_p99'] * ms:.3f}ms, max {result['flush_max'] * ms:.3f}ms"
+    )
+    print(
+        f"  total take_complete_lines {result['take_complete_lines']:.3f}s, "
+        f"process_buffer {result['process_buffer']:.3f}s, "
+        f"take_status_update {result['take_status_update']:.3f}s, "
+        f"get_model {result['get_model'] * ms:.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", choices=SIZES, action="append")
+    parser.add_argument("--kind", choices=GENERATORS, action="append")
+    parser.add_argument("--capture", action="append", default=[])
+    parser.add_argument("--read-size", type=int, default=65536)
+    parser.add_argument("--validate", action="store_true")
+    args = parser.parse_args()
+
+    scenarios = [(None, None, capture) for capture in args.capture]
+    if not args.capture or args.size or args.kind:
+        scenarios += [
+            (kind, size, None)
+            for kind in args.kind or GENERATORS
+            for size in args.size or ["small", "medium"]
+        ]
+
+    context = multiprocessing.get_context("fork")
+    for kind, size, capture in scenarios:
+        results = context.Queue()
+        process = context.Process(
+            target=run_scenario,
+            args=(kind, size, capture, args.read_size, args.validate, results),
+        )
+        process.start()
+        result = results.get()
+        process.join()
+        report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Throughput of process output sent from a worker process to the executor.
+
+Compares the pickled, base64 encoded TaskStdOutErrUpdate messages with the raw
+output frames of thymis_controller.task.output_channel.
+
+    python benchmarks/bench_output_channel.py [--chunks N] [--chunk-size BYTES]
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import time
+import uuid
+
+import thymis_controller.models.task as models_task
+from thymis_controller.task.output_channel import decode_message, send_output
+
+
+def send_pickled(conn, task_id, chunks, chunk):
+    for _ in range(chunks):
+        conn.send(
+            models_task.RunnerToControllerTaskUpdate(
+                id=task_id,
+                update=models_task.TaskStdOutErrUpdate(
+                    process_index=0,
+                    stdoutb64=base64.b64encode(chunk).decode("utf-8"),
+                    stderrb64=base64.b64encode(b"").decode("utf-8"),
+                ),
+            )
+        )
+    conn.close()
+
+
+def send_frames(conn, task_id, chunks, chunk):
+    for _ in range(chunks):
+        send_output(conn, task_id, 0, chunk, b"")
+    conn.close()
+
+
+def receive_pickled(conn):
+    received = 0
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return received
+        received += len(base64.b64decode(message.update.stdoutb64))
+        received += len(base64.b64decode(message.update.stderrb64))
+
+
+def receive_frames(conn):
+    received = 0
+    while True:
+        try:
+            frame = decode_message(conn.recv_bytes())
+        except EOFError:
+            return received
+        received += len(frame.stdout) + len(frame.stderr)
+
+
+def run(name, sender, receiver, chunks, chunk):
+    receiver_side, sender_side = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=sender, args=(sender_side, uuid.uuid4(), chunks, chunk)
+    )
+    start = time.perf_counter()
+    process.start()
+    sender_side.close()
+    received = receiver(receiver_side)
+    process.join()
+    elapsed = time.perf_counter() - start
+    assert received == chunks * len(chunk)
+    print(
+        f"{name:>8}: {received / elapsed / 2**20:8.1f} MiB/s "
+        f"({chunks} chunks of {len(chunk)} bytes in {elapsed:.3f}s)"
+    )
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=16384)
+    args = parser.parse_args()
+
+    chunk = os.urandom(args.chunk_size)
+    pickled = run("pickled", send_pickled, receive_pickled, args.chunks, chunk)
+    frames = run("frames", send_frames, receive_frames, args.chunks, chunk)
+    print(f" speedup: {pickled / frames:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Database size and read latency of stored task output.
+
+Writes the nix log fixtures as process output the way the task update writer
+does, in small appends, once stored raw and once compressed and compacted
+into blocks. Reports the size of the vacuumed database and the latency of
+tail, range and full reads.
+
+    python benchmarks/bench_task_output_storage.py [--size medium] [--append-size BYTES]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import sqlalchemy
+from nix_log_fixtures import GENERATORS, SIZES
+from sqlalchemy.orm import Session
+from thymis_controller import crud, db_models
+from thymis_controller.database import compression
+from thymis_controller.database.base import Base
+
+READ_SIZE = 64 * 1024
+RANGE_READS = 200
+
+
+def write_output(engine, output: bytes, append_size: int, compress: bool):
+    with Session(engine) as db_session:
+        task = db_models.Task(
+            id=uuid.uuid4(),
+            submitted_time=datetime.now(timezone.utc),
+            state="completed",
+            task_type="build_project_task",
+            task_submission_data={},
+        )
+        db_session.add(task)
+        db_session.add(db_models.TaskProcess(task_id=task.id, process_index=0))
+        db_session.commit()
+        for start in range(0, len(output), append_size):
+            crud.task.append_process_output(
+                db_session,
+                task.id,
+                0,
+                "stderr",
+                output[start : start + append_size],
+            )
+            db_session.commit()
+        if compress:
+            crud.task.compact_process_output(db_session, task.id)
+            db_session.commit()
+        return task.id
+
+
+def timed(function, repeat: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def run_scenario(kind: str, size: str, append_size: int, compress: bool) -> dict:
+    output = GENERATORS[kind](SIZES[size])
+    min_size = compression.COMPRESS_MIN_SIZE
+    if not compress:
+        compression.COMPRESS_MIN_SIZE = float("inf")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "thymis.sqlite")
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+        try:
+            write_time = timed(
+                lambda: write_output(engine, output, append_size, compress)
+            )
+        finally:
+            compression.COMPRESS_MIN_SIZE = min_size
+        with engine.connect() as connection:
+            connection.exec_driver_sql("VACUUM")
+        db_size = os.path.getsize(path)
+
+        with Session(engine) as db_session:
+            task_id = db_session.scalar(sqlalchemy.select(db_models.Task.id))
+
+            def read(start=0, end=None):
+                return crud.task.read_process_output(
+                    db_session, task_id, 0, "stderr", start, end
+                )
+
+            assert read() == output
+            randomness = random.Random(0)
+            starts = [
+                randomness.randrange(max(len(output) - READ_SIZE, 1))
+                for _ in range(RANGE_READS)
+            ]
+            range_time = timed(
+                lambda: [read(start, start + READ_SIZE) for start in starts]
+            ) / len(starts)
+            tail_time = timed(lambda: read(len(output) - READ_SIZE), repeat=50)
+            full_time = timed(read, repeat=3)
+        engine.dispose()
+    return {
+        "kind": kind,
+        "size": size,
+        "storage": "compressed" if compress else "raw",
+        "output_bytes": len(output),
+        "db_bytes": db_size,
+        "write_s": write_time,
+        "tail_ms": tail_time * 1000,
+        "range_ms": range_time * 1000,
+        "full_ms": full_time * 1000,
+    }
+
+
+def report(result: dict):
+    print(
+        f"{result['kind']:>6} {result['size']:>6} {result['storage']:>10}: "
+        f"output {result['output_bytes'] / 2**20:7.1f} MiB, "
+        f"db {result['db_bytes'] / 2**20:7.2f} MiB, "
+        f"write {result['write_s']:6.2f} s, "
+        f"tail {result['tail_ms']:6.2f} ms, "
+        f"64 KiB range {result['range_ms']:6.2f} ms, "
+        f"full read {result['full_ms']:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", choices=SIZES, action="append")
+    parser.add_argument("--kind", choices=GENERATORS, action="append")
+    parser.add_argument("--append-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    for kind in args.kind or list(GENERATORS):
+        for size in args.size or ["small", "medium"]:
+            for compress in (False, True):
+                report(run_scenario(kind, size, args.append_size, compress))
+
+
+if __name__ == "__main__":
+    main()
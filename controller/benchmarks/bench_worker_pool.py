@@ -0,0 +1,102 @@
+"""
+Task start latency and worker memory of the task process pools.
+
+Compares workers forked from the controller process, as before, with workers
+started from a forkserver that preloads only the worker modules. Each task
+reports how long after its submission it started running and the peak RSS of
+its worker. The first round starts the workers, the following rounds reuse
+them, or replace them after --max-tasks tasks for the forkserver pool.
+
+    python benchmarks/bench_worker_pool.py [--workers 4] [--tasks 200] [--max-tasks 20]
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def proportional_set_size() -> int:
+    # memory shared with other processes counted in parts, Linux only
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def probe(submitted: float) -> tuple[float, int, int, int]:
+    return (
+        time.time() - submitted,
+        os.getpid(),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        proportional_set_size(),
+    )
+
+
+def run_round(pool: ProcessPoolExecutor, workers: int, tasks: int) -> list[tuple]:
+    # the scheduler never gives a pool more tasks than it has workers
+    results = []
+    for start in range(0, tasks, workers):
+        batch = min(workers, tasks - start)
+        futures = [pool.submit(probe, time.time()) for _ in range(batch)]
+        results += [future.result() for future in futures]
+    return results
+
+
+def run_scenario(name: str, pool: ProcessPoolExecutor, workers: int, tasks: int):
+    cold = run_round(pool, workers, workers)
+    warm = run_round(pool, workers, tasks)
+    pool.shutdown(wait=True)
+    latencies = sorted(result[0] for result in warm)
+    by_worker = {result[1]: result for result in cold + warm}
+    return {
+        "name": name,
+        "cold_ms": max(result[0] for result in cold) * 1000,
+        "median_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "workers_started": len(by_worker),
+        "rss_mib": statistics.mean(r[2] for r in by_worker.values()) / 2**20,
+        "pss_mib": statistics.mean(r[3] for r in by_worker.values()) / 2**20,
+    }
+
+
+def report(result: dict):
+    print(
+        f"{result['name']:>22}: "
+        f"cold start {result['cold_ms']:8.1f} ms, "
+        f"start median {result['median_ms']:6.2f} ms, "
+        f"p99 {result['p99_ms']:6.2f} ms, "
+        f"{result['workers_started']:3d} workers, "
+        f"mean peak RSS {result['rss_mib']:6.1f} MiB, "
+        f"PSS {result['pss_mib']:6.1f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--max-tasks", type=int, default=20)
+    args = parser.parse_args()
+
+    # part of what the controller process has loaded when it forks workers
+    import thymis_controller.task.controller  # noqa: F401
+    from thymis_controller.task.worker_pool import create_worker_pool
+
+    fork = ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=multiprocessing.get_context("fork")
+    )
+    report(run_scenario("fork from controller", fork, args.workers, args.tasks))
+    forkserver = create_worker_pool(args.workers, args.max_tasks)
+    report(run_scenario("forkserver, preloaded", forkserver, args.workers, args.tasks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Nix `--log-format internal-json` stderr fixtures for the benchmarks.
+
+Captures of real runs can be recorded with
+
+    nix build .#nixosConfigurations.<name>.config.system.build.toplevel \
+        --log-format internal-json -v 2> build.log
+    nix copy --to ssh-ng://root@<host> <path> --log-format internal-json -v 2> copy.log
+
+and passed to the benchmarks with `--capture`. The generated fixtures follow
+the structure of such captures: a top level builds/copy-paths activity with
+progress results, one activity per derivation or store path with phases,
+build log lines, file transfers and interleaved messages.
+"""
+
+import json
+import random
+
+from thymis_controller.nix.log_parse import ActivityType, ResultType
+
+# approximate number of lines of the generated fixtures
+SIZES = {
+    "small": 2_000,
+    "medium": 100_000,
+    "large": 1_000_000,
+}
+
+PHASES = [
+    "unpackPhase",
+    "patchPhase",
+    "configurePhase",
+    "buildPhase",
+    "checkPhase",
+    "installPhase",
+    "fixupPhase",
+]
+
+
+def _line(**fields) -> bytes:
+    return b"@nix " + json.dumps(fields, separators=(",", ":")).encode() + b"\n"
+
+
+def generate_build_log(lines: int, seed: int = 0) -> bytes:
+    """Stderr of a `nix build` of a system with many derivations"""
+    rng = random.Random(seed)
+    out = []
+    top_id = 1
+    out.append(
+        _line(
+            action="start",
+            id=top_id,
+            level=0,
+            type=ActivityType.BUILDS,
+            text="",
+            parent=0,
+        )
+    )
+    next_id = 2
+    done = 0
+    derivations = max(lines // 60, 1)
+    while len(out) < lines:
+        drv = f"/nix/store/{rng.randbytes(16).hex()}-package-{next_id}.drv"
+        build_id = next_id
+        next_id += 1
+        out.append(
+            _line(
+                action="start",
+                id=build_id,
+                level=3,
+                type=ActivityType.BUILD,
+                text=f"building '{drv}'",
+                parent=top_id,
+                fields=[drv, "", 1, 1],
+            )
+        )
+        out.append(
+            _line(
+                action="result",
+                id=top_id,
+                type=ResultType.PROGRESS,
+                fields=[done, derivations, 1, 0],
+            )
+        )
+        for phase in PHASES:
+            out.append(
+                _line(
+                    action="result",
+                    id=build_id,
+                    type=ResultType.SET_PHASE,
+                    fields=[phase],
+                )
+            )
+            for _ in range(rng.randint(2, 12)):
+                text = f"compiling src/{rng.randbytes(4).hex()}.c -O2 -Wall"
+                if rng.random() < 0.02:
+                    text = f"\x1b[1mwarning:\x1b[0m unused variable '{rng.randbytes(2).hex()}'"
+                out.append(
+                    _line(
+                        action="result",
+                        id=build_id,
+                        type=ResultType.BUILD_LOG_LINE,
+                        fields=[text],
+                    )
+                )
+        if rng.random() < 0.05:
+            out.append(
+                _line(
+                    action="msg",
+                    level=1,
+                    msg=f"\x1b[35;1mwarning:\x1b[0m ignoring untrusted substituter for {drv}",
+                )
+            )
+        out.append(_line(action="stop", id=build_id))
+        done += 1
+    out.append(
+        _line(
+            action="result",
+            id=top_id,
+            type=ResultType.PROGRESS,
+            fields=[done, derivations, 0, 0],
+        )
+    )
+    out.append(_line(action="stop", id=top_id))
+    return b"".join(out)
+
+
+def generate_copy_log(lines: int, seed: int = 0) -> bytes:
+    """Stderr of a `nix copy` of a closure to a device"""
+    rng = random.Random(seed)
+    out = [
+        b"Warning: Permanently added '[127.0.0.1]:2222' (ED25519) to the list of known hosts.\n"
+    ]
+    top_id = 1
+    out.append(
+        _line(
+            action="start",
+            id=top_id,
+            level=0,
+            type=ActivityType.COPY_PATHS,
+            text="",
+            parent=0,
+        )
+    )
+    next_id = 2
+    paths = max(lines // 12, 1)
+    copied = 0
+    while len(out) < lines:
+        path = f"/nix/store/{rng.randbytes(16).hex()}-path-{next_id}"
+        size = rng.randint(1_000, 50_000_000)
+        copy_id = next_id
+        next_id += 1
+        out.append(
+            _line(
+                action="start",
+                id=copy_id,
+                level=3,
+                type=ActivityType.COPY_PATH,
+                text=f"copying '{path}' to 'ssh-ng://root@127.0.0.1'",
+                parent=top_id,
+                fields=[path, "local", "ssh-ng://root@127.0.0.1"],
+            )
+        )
+        transferred = 0
+        for _ in range(rng.randint(4, 10)):
+            transferred = min(
+                size, transferred + rng.randint(size // 10, size // 3 + 1)
+            )
+            out.append(
+                _line(
+                    action="result",
+                    id=copy_id,
+                    type=ResultType.PROGRESS,
+                    fields=[transferred, size, 0, 0],
+                )
+            )
+        out.append(_line(action="stop", id=copy_id))
+        copied += 1
+        out.append(
+            _line(
+                action="result",
+                id=top_id,
+                type=ResultType.PROGRESS,
+                fields=[copied, paths, 1, 0],
+            )
+        )
+    out.append(_line(action="stop", id=top_id))
+    return b"".join(out)
+
+
+GENERATORS = {
+    "build": generate_build_log,
+    "copy": generate_copy_log,
+}
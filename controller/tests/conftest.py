@@ -1,4 +1,6 @@
 import tempfile
+import uuid
+from datetime import datetime, timezone
 
 import pytest
 from fastapi.testclient import TestClient
@@ -39,6 +41,59 @@ def db_session():
     connection.close()
 
 
+@pytest.fixture(scope="function")
+def make_task(db_session):
+    """
+    Factory for committed task rows. Each entry of `processes` adds a task
+    process with these columns, other keyword arguments are task columns.
+    """
+
+    def make_task(
+        state="running",
+        task_type="build_project_task",
+        submitted_time=None,
+        submission_data=None,
+        processes=(),
+        **columns,
+    ) -> db_models.Task:
+        task = db_models.Task(
+            id=uuid.uuid4(),
+            submitted_time=submitted_time or datetime.now(timezone.utc),
+            state=state,
+            task_type=task_type,
+            task_submission_data=submission_data or {},
+            **columns,
+        )
+        db_session.add(task)
+        for process_index, process_columns in enumerate(processes):
+            db_session.add(
+                db_models.TaskProcess(
+                    task_id=task.id, process_index=process_index, **process_columns
+                )
+            )
+        db_session.commit()
+        return task
+
+    return make_task
+
+
+class FakeController:
+    """Stands in for the task controller of executors in tests that do not use it"""
+
+
+@pytest.fixture(scope="function")
+def task_executor(db_session):
+    """A task executor on the test database, its threads stop with the test"""
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+    executor = TaskWorkerPoolManager(FakeController())
+    executor._db_engine = db_session.bind
+    yield executor
+    executor.dispatcher.stop()
+    executor.update_writer.stop()
+    executor.output_compactor.stop()
+
+
 @pytest.fixture(scope="function")
 def project(db_session):
     from thymis_controller.project import Project
@@ -0,0 +1,34 @@
+import uuid
+
+from thymis_controller import crud
+
+KEY = ("abc123", "kiosk", "toplevel")
+
+
+def test_build_result_cache(db_session):
+    assert crud.build_result.get(db_session, *KEY) is None
+    builder = uuid.uuid4()
+    crud.build_result.record(db_session, *KEY, "/nix/store/abc-toplevel", builder)
+    db_session.commit()
+
+    result = crud.build_result.get(db_session, *KEY)
+    assert result.out_path == "/nix/store/abc-toplevel"
+    assert result.builder_task_id == builder
+    crud.build_result.record_hit(db_session, result)
+    db_session.commit()
+    assert crud.build_result.get(db_session, *KEY).hits == 1
+    # other attributes of the configuration are separate entries
+    assert crud.build_result.get(db_session, "abc123", "kiosk", "image") is None
+
+    # a rebuild replaces the result
+    crud.build_result.record(db_session, *KEY, "/nix/store/def-toplevel", None)
+    db_session.commit()
+    db_session.expire_all()
+    assert crud.build_result.get(db_session, *KEY).out_path == "/nix/store/def-toplevel"
+    assert crud.build_result.get(db_session, *KEY).hits == 0
+
+    # an outdated invalid path does not remove the newer result
+    crud.build_result.delete_path(db_session, *KEY, "/nix/store/abc-toplevel")
+    assert crud.build_result.count(db_session) == 1
+    crud.build_result.delete_path(db_session, *KEY, "/nix/store/def-toplevel")
+    assert crud.build_result.get(db_session, *KEY) is None
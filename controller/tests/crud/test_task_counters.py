@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, select
+from thymis_controller import crud, db_models
+
+
+def _scan_count(db_session, state, from_date, to_date):
+    return db_session.scalar(
+        select(func.count())
+        .select_from(db_models.Task)
+        .where(
+            db_models.Task.state == state,
+            db_models.Task.submitted_time >= from_date,
+            db_models.Task.submitted_time <= to_date,
+        )
+    )
+
+
+def test_state_counters_follow_task_changes(db_session, make_task):
+    start = datetime(2026, 3, 1, 12, 0)
+    tasks = [
+        make_task(
+            state="pending",
+            task_type="deploy_device_task",
+            submitted_time=start + timedelta(hours=7 * i),
+        )
+        for i in range(20)
+    ]
+    for i, task in enumerate(tasks):
+        task.state = "running"
+        db_session.commit()
+        if i % 3:
+            task.state = "completed"
+        else:
+            task.state = "failed"
+            task.add_exception("\nbuild of device failed\nsecond line")
+        db_session.commit()
+    db_session.delete(tasks[-1])
+    db_session.commit()
+
+    assert crud.task.get_task_count(db_session) == 19
+    assert crud.task.get_task_state_counts(db_session) == {
+        "completed": 12,
+        "failed": 7,
+        "pending": 0,
+        "running": 0,
+    }
+    assert crud.task.get_task_counters_updated_time(db_session) is not None
+    ranges = [
+        (start, start + timedelta(days=10)),
+        (start - timedelta(days=1), start + timedelta(hours=30)),
+        (datetime(2026, 3, 2), datetime(2026, 3, 4)),
+        (start + timedelta(hours=1), start + timedelta(hours=5)),
+    ]
+    for from_date, to_date in ranges:
+        for state in ("completed", "failed"):
+            assert crud.task.count_tasks_with_state(
+                db_session, state, from_date, to_date
+            ) == _scan_count(db_session, state, from_date, to_date)
+    assert tasks[0].error_headline == "build of device failed"
+    assert tasks[0].last_update_time is not None
+
+
+def test_device_identifier_summary(db_session, make_task):
+    task = make_task(
+        state="pending",
+        task_type="deploy_device_task",
+        submitted_time=datetime(2026, 3, 1),
+        submission_data={"device": {"identifier": "kiosk-1"}},
+    )
+    assert task.device_identifier == "kiosk-1"
+    task = make_task(
+        state="pending",
+        task_type="deploy_device_task",
+        submitted_time=datetime(2026, 3, 1),
+        submission_data={"devices": [{"identifier": "a"}, {"identifier": "b"}]},
+    )
+    assert task.device_identifier is None
+    [short] = [
+        short for short in crud.task.get_tasks_short(db_session) if short.id == task.id
+    ]
+    assert short.state == "pending"
+    assert short.last_update_time is not None
+
+
+def test_summaries_query_only_flushes_with_task_changes(db_session, make_task):
+    tasks = [
+        make_task(
+            state="pending",
+            task_type="deploy_device_task",
+            submitted_time=datetime(2026, 3, 1),
+        )
+        for _ in range(3)
+    ]
+    statements = []
+
+    @event.listens_for(db_session.connection(), "before_cursor_execute")
+    def record(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    crud.deployment_info.create(db_session, ssh_public_key="key-a")
+    assert not any("tasks" in statement for statement in statements)
+
+    for task in tasks:
+        task.state = "running"
+    db_session.commit()
+    # one lookup of the stored states for all changed tasks
+    assert (
+        len([s for s in statements if s.startswith("SELECT tasks.id, tasks.state ")])
+        == 1
+    )
+    assert crud.task.get_task_state_counts(db_session) == {
+        "pending": 0,
+        "running": 3,
+    }
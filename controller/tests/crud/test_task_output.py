@@ -0,0 +1,208 @@
+from sqlalchemy import LargeBinary, event, select, type_coerce
+from thymis_controller import crud, db_models, models
+from thymis_controller.database.compression import OUTPUT_BLOCK_SIZE
+
+
+def test_append_process_output_reassembles_on_read(db_session, make_task):
+    task = make_task(processes=[{}])
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"hello ")
+    crud.task.append_process_output(db_session, task.id, 0, "stderr", b"warning\n")
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"world\n")
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"")
+    db_session.commit()
+    db_session.expire_all()
+
+    process = crud.task.get_task_by_id(db_session, task.id).get_process_by_index(0)
+    assert process.process_stdout == b"hello world\n"
+    assert process.process_stderr == b"warning\n"
+    stdout_chunks = [c for c in process.output_chunks if c.stream == "stdout"]
+    assert [chunk.seq for chunk in stdout_chunks] == [0, 1]
+
+
+def test_chunk_offsets_follow_legacy_output(db_session, make_task):
+    task = make_task(processes=[{"legacy_stdout": b"old output\n"}])
+    first = crud.task.append_process_output(db_session, task.id, 0, "stdout", b"ab")
+    second = crud.task.append_process_output(db_session, task.id, 0, "stdout", b"cd")
+    db_session.commit()
+
+    assert first.offset == len(b"old output\n")
+    assert second.offset == first.offset + 2
+    db_session.expire_all()
+    process = crud.task.get_task_by_id(db_session, task.id).get_process_by_index(0)
+    assert process.process_stdout == b"old output\nabcd"
+    assert process.process_stderr is None
+
+
+def test_task_model_reads_chunked_output(db_session, make_task):
+    task = make_task(processes=[{}])
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"line 1\n")
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"line 2\n")
+    db_session.commit()
+    db_session.expire_all()
+
+    task_model = models.Task.from_orm_task(
+        crud.task.get_task_by_id(db_session, task.id)
+    )
+    assert task_model.processes[0].process_stdout == "line 1\nline 2\n"
+    assert task_model.processes[0].process_stderr is None
+
+
+def test_read_process_output_ranges(db_session, make_task):
+    task = make_task(processes=[{"legacy_stdout": b"0123"}])
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"4567")
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"89")
+    db_session.commit()
+
+    def read(start=0, end=None):
+        return crud.task.read_process_output(
+            db_session, task.id, 0, "stdout", start, end
+        )
+
+    assert read() == b"0123456789"
+    assert read(2, 6) == b"2345"
+    assert read(5) == b"56789"
+    assert read(5, 9) == b"5678"
+    assert read(10) == b""
+    assert read(6, 6) == b""
+    assert crud.task.process_output_length(db_session, task.id, 0, "stdout") == 10
+    assert crud.task.process_output_length(db_session, task.id, 0, "stderr") == 0
+
+
+def test_large_output_is_stored_in_compressed_blocks(db_session, make_task):
+    task = make_task(processes=[{}])
+    output = b"building /nix/store/...\n" * 10000
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", output)
+    db_session.commit()
+
+    chunks = db_session.query(db_models.TaskOutputChunk).order_by("offset").all()
+    assert [chunk.length for chunk in chunks[:-1]] == [OUTPUT_BLOCK_SIZE] * (
+        len(chunks) - 1
+    )
+    assert all(chunk.compression == "zlib" for chunk in chunks)
+    assert sum(len(chunk.data) for chunk in chunks) < len(output) / 10
+    assert (
+        crud.task.read_process_output(
+            db_session,
+            task.id,
+            0,
+            "stdout",
+            OUTPUT_BLOCK_SIZE - 4,
+            OUTPUT_BLOCK_SIZE + 4,
+        )
+        == output[OUTPUT_BLOCK_SIZE - 4 : OUTPUT_BLOCK_SIZE + 4]
+    )
+
+
+def test_small_appends_are_compressed_by_compaction(db_session, make_task):
+    task = make_task(processes=[{}])
+    output = b"building /nix/store/...\n" * 200
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", output)
+    db_session.commit()
+
+    (chunk,) = db_session.query(db_models.TaskOutputChunk).all()
+    assert chunk.compression is None
+
+    crud.task.compact_process_output(db_session, task.id)
+    db_session.commit()
+    db_session.expire_all()
+
+    (chunk,) = db_session.query(db_models.TaskOutputChunk).all()
+    assert chunk.compression == "zlib"
+    assert chunk.read() == output
+
+
+def test_compact_merges_chunks_into_blocks(db_session, make_task):
+    task = make_task(processes=[{"legacy_stdout": b"old\n"}])
+    output = b""
+    for i in range(200):
+        line = f"line {i} ".encode() * 100 + b"\n"
+        output += line
+        crud.task.append_process_output(db_session, task.id, 0, "stdout", line)
+    crud.task.append_process_output(db_session, task.id, 0, "stderr", b"warning\n")
+    db_session.commit()
+
+    crud.task.compact_process_output(db_session, task.id)
+    db_session.commit()
+    db_session.expire_all()
+
+    process = crud.task.get_task_by_id(db_session, task.id).get_process_by_index(0)
+    stdout_chunks = [c for c in process.output_chunks if c.stream == "stdout"]
+    assert len(stdout_chunks) == 3
+    assert all(chunk.length <= OUTPUT_BLOCK_SIZE for chunk in stdout_chunks)
+    assert process.process_stdout == b"old\n" + output
+    assert process.process_stderr == b"warning\n"
+    assert (
+        crud.task.read_process_output(db_session, task.id, 0, "stdout", 1000, 100000)
+        == (b"old\n" + output)[1000:100000]
+    )
+    # later output continues after the compacted blocks
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"more\n")
+    assert crud.task.process_output_length(db_session, task.id, 0, "stdout") == len(
+        b"old\n" + output + b"more\n"
+    )
+
+
+def test_nix_logs_are_stored_compressed(db_session, make_task):
+    task = make_task(processes=[{}])
+    crud.task.append_nix_log(
+        db_session, task.id, 0, "nix_info_logs", ["copying path"] * 1000
+    )
+    db_session.commit()
+
+    stored = db_session.scalar(
+        select(type_coerce(db_models.TaskNixLogChunk.entries, LargeBinary))
+    )
+    assert len(stored) < 200
+    db_session.expire_all()
+    process = crud.task.get_task_by_id(db_session, task.id).get_process_by_index(0)
+    assert process.nix_info_logs == ["copying path"] * 1000
+
+
+def test_nix_log_appends_do_not_load_the_list(db_session, make_task):
+    task = make_task(processes=[{}])
+    assert crud.task.append_nix_log(db_session, task.id, 0, "nix_info_logs", []) is None
+    crud.task.append_nix_log(db_session, task.id, 0, "nix_info_logs", ["a", "b"])
+
+    statements = []
+    event.listen(
+        db_session.bind,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    start = crud.task.append_nix_log(
+        db_session, task.id, 0, "nix_info_logs", ["c", "d", "e"]
+    )
+    assert start == 2
+    assert not any(
+        "SELECT" in statement and "entries" in statement for statement in statements
+    )
+    assert not any(statement.startswith("UPDATE") for statement in statements)
+
+    assert crud.task.nix_log_length(db_session, task.id, 0, "nix_info_logs") == 5
+    assert crud.task.read_nix_log(db_session, task.id, 0, "nix_info_logs", 1, 4) == [
+        "b",
+        "c",
+        "d",
+    ]
+    assert crud.task.read_nix_log(db_session, task.id, 0, "nix_error_logs") == []
+
+
+def test_nix_log_chunks_are_merged_by_compaction(db_session, make_task):
+    task = make_task(processes=[{}])
+    for entry in range(5):
+        crud.task.append_nix_log(db_session, task.id, 0, "nix_info_logs", [entry])
+    crud.task.append_nix_log(db_session, task.id, 0, "nix_errors", [{"msg": "x"}])
+    crud.task.compact_nix_logs(db_session, task.id)
+    db_session.commit()
+
+    chunks = db_session.scalars(select(db_models.TaskNixLogChunk)).all()
+    assert sorted((chunk.stream, chunk.length) for chunk in chunks) == [
+        ("nix_errors", 1),
+        ("nix_info_logs", 5),
+    ]
+    assert crud.task.read_nix_log(db_session, task.id, 0, "nix_info_logs", 2) == [
+        2,
+        3,
+        4,
+    ]
+    assert crud.task.append_nix_log(db_session, task.id, 0, "nix_info_logs", [5]) == 5
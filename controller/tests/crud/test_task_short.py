@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event
+from thymis_controller import crud
+
+
+def _make_task_with_output(make_task, db_session, submitted_time, statuses):
+    task = make_task(
+        state="completed",
+        submitted_time=submitted_time,
+        processes=[
+            {"legacy_stdout": b"x" * 1000, "nix_status": status} for status in statuses
+        ],
+    )
+    for process_index in range(len(statuses)):
+        crud.task.append_nix_log(
+            db_session, task.id, process_index, "nix_info_logs", ["copying path"] * 100
+        )
+    db_session.commit()
+    return task.id
+
+
+def _status(done):
+    return {"done": done, "expected": 10, "running": 0, "failed": 0}
+
+
+def _capture_statements(db_session):
+    statements = []
+    event.listen(
+        db_session.bind,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+def test_tasks_short_do_not_load_output(db_session, make_task):
+    now = datetime.now(timezone.utc)
+    older = _make_task_with_output(
+        make_task, db_session, now - timedelta(hours=1), [_status(1), None]
+    )
+    newer = _make_task_with_output(make_task, db_session, now, [_status(2), _status(3)])
+    _make_task_with_output(make_task, db_session, now - timedelta(hours=2), [])
+    db_session.expunge_all()
+
+    statements = _capture_statements(db_session)
+    tasks = crud.task.get_tasks_short(db_session, limit=2)
+
+    assert [task.id for task in tasks] == [newer, older]
+    assert tasks[0].nix_status.done == 3
+    assert tasks[1].nix_status.done == 1
+    assert len(statements) == 2
+    assert not any(
+        "process_stdout" in statement or "task_nix_log_chunks" in statement
+        for statement in statements
+    )
+    assert crud.task.get_task_count(db_session) == 3
+    assert crud.task.count_tasks_with_state(db_session, "completed") == 3
+    assert crud.task.count_tasks_with_state(db_session, "failed") == 0
+
+
+def test_heavy_process_columns_are_deferred(db_session, make_task):
+    task_id = _make_task_with_output(
+        make_task, db_session, datetime.now(timezone.utc), [_status(1)]
+    )
+    db_session.expunge_all()
+
+    statements = _capture_statements(db_session)
+    process = crud.task.get_task_by_id(db_session, task_id).processes[0]
+    assert process.nix_status["done"] == 1
+    assert not any("task_nix_log_chunks" in statement for statement in statements)
+
+    assert process.nix_info_logs == ["copying path"] * 100
+    assert process.process_stdout == b"x" * 1000
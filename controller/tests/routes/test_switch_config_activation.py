@@ -85,3 +85,48 @@ def test_switch_activation_promotes_deployed_config_id_from_task(db_session):
     assert updated.pending_config_id is None
     assert updated.deployed_config_commit == "commit-b"
     assert relay.task_controller.executor.messages
+
+
+def test_switch_result_replaces_the_running_build_hash(db_session):
+    deployment_info = crud.deployment_info.create(
+        db_session,
+        ssh_public_key="key-a",
+        deployed_config_id="config-a",
+    )
+    task = _create_switch_task(db_session, deployment_info.id)
+
+    relay = NetworkRelay(db_session.bind, NotificationManager())
+    relay.public_key_to_connection_id["key-a"] = "conn-1"
+    relay.connection_id_to_public_key["conn-1"] = "key-a"
+    relay.connection_id_to_start_message["conn-1"] = agent.EdgeAgentToRelayStartMessage(
+        token="token",
+        hardware_ids={},
+        public_key="key-a",
+        deployed_config_id="config-a",
+        build_hash="hash-a",
+    )
+    relay.task_controller = FakeTaskController()
+
+    def switch_result(build_hash):
+        asyncio.run(
+            relay.handle_custom_agent_message(
+                agent.AgentToRelayMessage(
+                    inner=agent.EtRSwitchToNewConfigResultMessage(
+                        task_id=task.id,
+                        switch_success=True,
+                        is_activated=True,
+                        config_commit="commit-b",
+                        stdout="",
+                        stderr="activating the configuration...",
+                        build_hash=build_hash,
+                    )
+                ),
+                "conn-1",
+            )
+        )
+
+    switch_result("hash-b")
+    assert relay.running_build_hash("key-a") == "hash-b"
+    # an agent that does not report the hash leaves it unknown
+    switch_result(None)
+    assert relay.running_build_hash("key-a") is None
@@ -0,0 +1,123 @@
+import uuid
+from multiprocessing import Pipe
+
+from thymis_controller.models import task as task_models
+from thymis_controller.task import worker
+from thymis_controller.task.build_coordinator import BuildCoordinator
+
+
+def test_concurrent_claims_share_one_build():
+    coordinator = BuildCoordinator()
+    builder, first, second, other = (uuid.uuid4() for _ in range(4))
+    key = ("abc123", "kiosk")
+
+    assert coordinator.claim(builder, key).status == "build"
+    assert coordinator.claim(first, key).status == "wait"
+    assert coordinator.claim(second, key).builder_task_id == builder
+    # another configuration builds on its own
+    assert coordinator.claim(other, ("abc123", "gateway")).status == "build"
+    assert coordinator.stats().waiting == 2
+
+    replies = coordinator.finish(builder, "/nix/store/abc-toplevel")
+    assert [task_id for task_id, _ in replies] == [first, second]
+    assert {result.status for _, result in replies} == {"built"}
+    assert {result.out_path for _, result in replies} == {"/nix/store/abc-toplevel"}
+    # the finished build is not shared with later claims
+    assert coordinator.claim(uuid.uuid4(), key).status == "build"
+
+    stats = coordinator.stats()
+    assert stats.builds_started == 3
+    assert stats.builds_shared == 2
+
+
+def test_waiter_takes_over_when_builder_ends():
+    coordinator = BuildCoordinator()
+    builder, cancelled, waiter = (uuid.uuid4() for _ in range(3))
+    key = ("abc123", "kiosk")
+    coordinator.claim(builder, key)
+    coordinator.claim(cancelled, key)
+    coordinator.claim(waiter, key)
+
+    assert coordinator.task_finished(cancelled) == []
+    [(task_id, result)] = coordinator.task_finished(builder)
+    assert task_id == waiter
+    assert result.status == "build"
+    # nobody is left waiting for the failed build
+    assert coordinator.finish(waiter, None) == []
+    assert coordinator.stats().in_flight == 0
+
+
+def test_cached_result_is_used_unless_invalid():
+    coordinator = BuildCoordinator()
+    earlier, task, other = (uuid.uuid4() for _ in range(3))
+    key = ("abc123", "kiosk", "toplevel")
+    cached = ("/nix/store/abc-toplevel", earlier)
+
+    result = coordinator.claim(task, key, cached)
+    assert result.status == "cached"
+    assert result.out_path == "/nix/store/abc-toplevel"
+    assert result.builder_task_id == earlier
+    # a cached result starts no build
+    assert coordinator.building(task) is None
+
+    # the path was garbage collected, the task claims again without it
+    coordinator.cached_result_invalid()
+    assert coordinator.claim(task, key).status == "build"
+    assert coordinator.building(task) == key
+    # a running build is shared even if a cached result is known
+    assert coordinator.claim(other, key, cached).status == "wait"
+
+    stats = coordinator.stats()
+    assert stats.cache_hits == 1
+    assert stats.cache_misses == 1
+    assert stats.cache_invalid == 1
+
+
+def test_cancelled_builder_reports_no_build_result(monkeypatch, tmp_path):
+    process_list = worker.ProcessList()
+    process_list.msg_queue.put(
+        task_models.ControllerToRunnerTaskUpdate(
+            inner=task_models.BuildClaimResult(status="build")
+        )
+    )
+
+    def cancelled_build(*args, **kwargs):
+        # the build process is killed by the cancellation
+        process_list.terminated = True
+        return -15
+
+    monkeypatch.setattr(worker, "run_command", cancelled_build)
+    controller_side, worker_side = Pipe()
+    task = task_models.TaskSubmission(
+        id=uuid.uuid4(),
+        data=task_models.ProjectFlakeUpdateTaskSubmission(
+            project_path="/project", nix_access_tokens=""
+        ),
+    )
+
+    result = worker.build_configuration(
+        task,
+        worker_side,
+        process_list,
+        tmp_path,
+        "abc123",
+        "kiosk",
+        str(tmp_path / "result"),
+        None,
+        str(tmp_path),
+    )
+
+    assert result == (None, "Task was cancelled")
+    updates = []
+    while controller_side.poll():
+        updates.append(controller_side.recv().update)
+    assert [type(update) for update in updates] == [task_models.BuildClaimUpdate]
+
+    # the waiting deploy builds itself instead of failing
+    coordinator = BuildCoordinator()
+    builder, waiter = uuid.uuid4(), uuid.uuid4()
+    key = ("abc123", "kiosk", "toplevel")
+    coordinator.claim(builder, key)
+    coordinator.claim(waiter, key)
+    [(task_id, claim)] = coordinator.task_finished(builder)
+    assert (task_id, claim.status) == (waiter, "build")
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import uuid
+from multiprocessing import Pipe
+
+from thymis_agent import agent
+from thymis_controller.models import task as task_models
+from thymis_controller.task.executor import TaskWorkerPoolManager
+from thymis_controller.task.worker import ProcessList, query_missing_paths
+
+CLOSURE = [f"/nix/store/{i:032d}-path-{i}" for i in range(5)]
+
+
+def _task():
+    return task_models.TaskSubmission(
+        id=uuid.uuid4(),
+        data=task_models.DeployDeviceTaskSubmission(
+            device=task_models.DeployDeviceInformation(
+                identifier="kiosk",
+                source_identifier="kiosk",
+                deployment_info_id=uuid.uuid4(),
+                deployment_public_key="key-a",
+                secrets=[],
+            ),
+            project_path="/project",
+            ssh_key_path="/project/id_thymis",
+            known_hosts_path="/tmp/known_hosts",
+            controller_ssh_pubkey="controller-key",
+            controller_access_client_endpoint="ws://127.0.0.1/agent/relay_for_clients",
+            access_client_token="token",
+            config_commit="commit",
+            closure_transfer="delta",
+        ),
+    )
+
+
+def _reply(process_list, result):
+    process_list.msg_queue.put(task_models.ControllerToRunnerTaskUpdate(inner=result))
+
+
+def test_missing_paths_of_all_batches_in_closure_order():
+    receiver, sender = Pipe(duplex=False)
+    process_list = ProcessList()
+    _reply(
+        process_list,
+        task_models.AgentStorePathsResult(checked=3, missing=[CLOSURE[2], CLOSURE[0]]),
+    )
+    _reply(process_list, task_models.AgentStorePathsResult(checked=2, missing=[]))
+
+    missing, error = query_missing_paths(_task(), sender, process_list, CLOSURE)
+
+    assert (missing, error) == ([CLOSURE[0], CLOSURE[2]], None)
+    query = receiver.recv().update
+    assert isinstance(query, task_models.AgentQueryStorePathsUpdate)
+    assert query.paths == CLOSURE
+
+
+def test_missing_paths_query_fails_with_the_agent_error():
+    _, sender = Pipe(duplex=False)
+    process_list = ProcessList()
+    _reply(
+        process_list,
+        task_models.AgentStorePathsResult(
+            checked=5, missing=[], error="error: cannot open store"
+        ),
+    )
+
+    assert query_missing_paths(_task(), sender, process_list, CLOSURE) == (
+        None,
+        "error: cannot open store",
+    )
+
+
+def test_missing_paths_ignore_answers_to_earlier_queries():
+    receiver, sender = Pipe(duplex=False)
+    process_list = ProcessList()
+    # sent before the agent disconnected, arrives after the query was repeated
+    _reply(
+        process_list,
+        task_models.AgentStorePathsResult(
+            checked=5, missing=CLOSURE, query_id=uuid.uuid4()
+        ),
+    )
+    missing = {}
+    thread = threading.Thread(
+        target=lambda: missing.update(
+            result=query_missing_paths(_task(), sender, process_list, CLOSURE)
+        )
+    )
+    thread.start()
+    query = receiver.recv().update
+    _reply(
+        process_list,
+        task_models.AgentStorePathsResult(
+            checked=5, missing=[CLOSURE[4]], query_id=query.query_id
+        ),
+    )
+    thread.join()
+
+    assert missing["result"] == ([CLOSURE[4]], None)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+
+class FakeNetworkRelay:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.public_key_to_connection_id = {}
+        self.registered_agent_connections = {}
+
+
+class FakeController:
+    def __init__(self):
+        self.network_relay = FakeNetworkRelay()
+
+
+def test_store_path_query_waits_for_the_agent_to_reconnect():
+    controller = FakeController()
+    relay = controller.network_relay
+    executor = TaskWorkerPoolManager(controller)
+    task_id = uuid.uuid4()
+    executor.futures[task_id] = (None, None)
+    update = task_models.AgentQueryStorePathsUpdate(
+        deployment_info_id=uuid.uuid4(),
+        paths=[f"/nix/store/{i:032d}-path" for i in range(4500)],
+    )
+
+    executor.query_store_paths("key-a", task_id, update)
+
+    connection = FakeConnection()
+    relay.public_key_to_connection_id["key-a"] = "connection"
+    relay.registered_agent_connections["connection"] = connection
+    executor.agent_connected("key-a")
+    relay.loop.run_until_complete(asyncio.sleep(0.05))
+
+    messages = [
+        agent.RelayToAgentMessage.model_validate_json(text).inner
+        for text in connection.sent
+    ]
+    assert [len(message.paths) for message in messages] == [2000, 2000, 500]
+    assert {message.query_id for message in messages} == {update.query_id}
+    # sent once
+    executor.agent_connected("key-a")
+    relay.loop.run_until_complete(asyncio.sleep(0.05))
+    assert len(connection.sent) == 3
+    relay.loop.close()
@@ -0,0 +1,116 @@
+import uuid
+from datetime import datetime, timezone
+from multiprocessing import Pipe
+
+from thymis_controller import crud, db_models, models
+from thymis_controller.models import task as task_models
+from thymis_controller.task.executor import TaskWorkerPoolManager
+
+RUNNING = "/nix/store/1b9p07z77phvv2hf6gm9f28syh5ycl2k-nixos-system-kiosk"
+NEW = "/nix/store/4bj2kxdm1462fzcc2i2s4dn33g2angcc-nixos-system-kiosk"
+
+
+class FakeNetworkRelay:
+    def running_build_hash(self, public_key):
+        return "1b9p07z77phvv2hf6gm9f28syh5ycl2k" if public_key == "key-a" else None
+
+
+class FakeController:
+    network_relay = FakeNetworkRelay()
+
+
+def _make_deploy_task(db_session, deployment_info_id, parent_task_id):
+    task_data = models.DeployDeviceTaskSubmission(
+        device=models.DeployDeviceInformation(
+            identifier="kiosk",
+            source_identifier="kiosk",
+            deployment_info_id=deployment_info_id,
+            deployment_public_key="key-a",
+            secrets=[],
+        ),
+        project_path="/project",
+        ssh_key_path="/project/id_thymis",
+        known_hosts_path="/tmp/known_hosts",
+        controller_ssh_pubkey="controller-key",
+        controller_access_client_endpoint="ws://127.0.0.1:8080/agent/relay_for_clients",
+        access_client_token="token",
+        config_commit="commit-b",
+        parent_task_id=parent_task_id,
+    )
+    task = db_models.Task(
+        id=uuid.uuid4(),
+        submitted_time=datetime.now(timezone.utc),
+        start_time=datetime.now(timezone.utc),
+        state="running",
+        task_type=task_data.type,
+        task_submission_data=task_data.model_dump(mode="json"),
+        parent_task_id=parent_task_id,
+    )
+    db_session.add(task)
+    db_session.commit()
+    return task
+
+
+def _check(executor, db_session, task, toplevel):
+    controller_side, worker_side = Pipe()
+    executor.apply_task_update(
+        db_session,
+        controller_side,
+        task,
+        task_models.DeployUpToDateCheckUpdate(
+            deployment_info_id=uuid.UUID(
+                task.task_submission_data["device"]["deployment_info_id"]
+            ),
+            toplevel=toplevel,
+        ),
+    )
+    db_session.commit()
+    return worker_side.recv().inner.up_to_date
+
+
+def test_deploy_of_running_toplevel_is_skipped(db_session):
+    deployment_info = crud.deployment_info.create(
+        db_session, ssh_public_key="key-a", deployed_config_id="kiosk"
+    )
+    crud.deployment_info.update(
+        db_session,
+        deployment_info.id,
+        deployed_config_commit="commit-a",
+        pending_config_id="kiosk",
+    )
+    parent = db_models.Task(
+        id=uuid.uuid4(),
+        submitted_time=datetime.now(timezone.utc),
+        state="running",
+        task_type="deploy_devices_task",
+    )
+    db_session.add(parent)
+    db_session.commit()
+    changed = _make_deploy_task(db_session, deployment_info.id, parent.id)
+    unchanged = _make_deploy_task(db_session, deployment_info.id, parent.id)
+    parent.children = [str(changed.id), str(unchanged.id)]
+    db_session.commit()
+
+    executor = TaskWorkerPoolManager(FakeController())
+    executor._db_engine = db_session.bind
+
+    assert _check(executor, db_session, changed, NEW) is False
+    assert changed.devices_skipped is None
+    updated = crud.deployment_info.get_by_id(db_session, deployment_info.id)
+    assert updated.deployed_config_commit == "commit-a"
+
+    assert _check(executor, db_session, unchanged, RUNNING) is True
+    assert unchanged.devices_skipped == 1
+    updated = crud.deployment_info.get_by_id(db_session, deployment_info.id)
+    assert updated.deployed_config_commit == "commit-b"
+    assert updated.pending_config_id is None
+
+    changed.state = unchanged.state = "completed"
+    unchanged.deploy_time_saved_seconds = 42.0
+    db_session.commit()
+    executor.update_composite_task(parent.id)
+    db_session.expire_all()
+    parent = crud.task.get_task_by_id(db_session, parent.id)
+    assert parent.state == "completed"
+    assert parent.devices_skipped == 1
+    assert parent.deploy_time_saved_seconds == 42.0
@@ -0,0 +1,65 @@
+import uuid
+
+from thymis_controller.task.deploy_stages import DeployStageLimiter
+from thymis_controller.task.scheduler import ResourceSlots
+
+
+def test_stages_have_separate_limits():
+    limiter = DeployStageLimiter({"eval": 1, "build": 1, "copy": 2, "activate": 2})
+    first, second, third = (uuid.uuid4() for _ in range(3))
+
+    assert limiter.acquire(first, "eval")
+    assert not limiter.acquire(second, "eval")
+    assert not limiter.acquire(third, "eval")
+    # the first device evaluated, the next one evaluates while it builds
+    [(task_id, granted)] = limiter.release(first, "eval")
+    assert task_id == second
+    assert granted.stage == "eval"
+    assert limiter.acquire(first, "build")
+    limiter.release(first, "build")
+    # the first device copies while the others evaluate and build
+    assert limiter.acquire(first, "copy")
+    assert [task_id for task_id, _ in limiter.release(second, "eval")] == [third]
+    assert limiter.acquire(second, "build")
+
+    stats = {stats.stage: stats for stats in limiter.stats()}
+    assert stats["eval"].started == 3
+    assert stats["eval"].running == 1
+    assert stats["build"].running == 1
+    assert stats["copy"].running == 1
+    assert stats["activate"].started == 0
+
+
+def test_ended_task_frees_its_slots():
+    limiter = DeployStageLimiter({"eval": 1, "build": 1, "copy": 1, "activate": 1})
+    cancelled, waiting, other = (uuid.uuid4() for _ in range(3))
+    limiter.acquire(cancelled, "copy")
+    limiter.acquire(waiting, "copy")
+    limiter.acquire(other, "build")
+    limiter.acquire(cancelled, "build")
+
+    [(task_id, granted)] = limiter.task_finished(cancelled)
+    assert task_id == waiting
+    assert granted.stage == "copy"
+    # it no longer waits for a build slot
+    assert limiter.release(other, "build") == []
+
+
+def test_build_stage_shares_the_build_limit():
+    builds = ResourceSlots(2)
+    limiter = DeployStageLimiter(
+        {"eval": 1, "build": 2, "copy": 1, "activate": 1}, {"build": builds}
+    )
+    build_task, first, second = (uuid.uuid4() for _ in range(3))
+    assert builds.acquire(build_task)
+
+    assert limiter.acquire(first, "build")
+    assert not limiter.acquire(second, "build")
+    assert not builds.acquire(uuid.uuid4())
+    # the build task ended, its slot goes to the waiting deploy
+    builds.release(build_task)
+    [(task_id, granted)] = limiter.grant_waiting("build")
+    assert (task_id, granted.stage) == (second, "build")
+
+    limiter.release(first, "build")
+    assert builds.acquire(build_task)
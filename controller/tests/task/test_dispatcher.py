@@ -0,0 +1,122 @@
+import threading
+import time
+from multiprocessing import Pipe
+
+from thymis_controller import crud
+from thymis_controller.models import task as task_models
+from thymis_controller.task import executor as executor_module
+from thymis_controller.task.worker_pool import create_worker_pool
+
+
+def test_single_dispatcher_thread_serves_all_tasks(
+    db_session, make_task, task_executor
+):
+    executor = task_executor
+    tasks = [make_task(state="pending") for _ in range(20)]
+    threads_before = threading.active_count()
+
+    workers = []
+    listeners = []
+    for task in tasks:
+        controller_side, worker_side = Pipe()
+        listeners.append(executor.dispatcher.register(task.id, controller_side))
+        workers.append(worker_side)
+    for task, worker_side in zip(tasks, workers):
+        worker_side.send(
+            task_models.RunnerToControllerTaskUpdate(
+                id=task.id, update=task_models.TaskPickedUpdate()
+            )
+        )
+    # dispatcher and update writer, independent of the number of tasks
+    assert threading.active_count() <= threads_before + 2
+
+    for task, worker_side in zip(tasks, workers):
+        worker_side.send(
+            task_models.RunnerToControllerTaskUpdate(
+                id=task.id, update=task_models.TaskCompletedUpdate()
+            )
+        )
+        worker_side.close()
+    for listener in listeners:
+        assert listener.drained.wait(5)
+
+    db_session.expire_all()
+    for task in tasks:
+        assert crud.task.get_task_by_id(db_session, task.id).state == "completed"
+
+
+def test_dispatcher_drains_connection_closed_without_terminal_update(
+    db_session, make_task, task_executor
+):
+    executor = task_executor
+    task = make_task(state="pending")
+    controller_side, worker_side = Pipe()
+    listener = executor.dispatcher.register(task.id, controller_side)
+    worker_side.send(
+        task_models.RunnerToControllerTaskUpdate(
+            id=task.id, update=task_models.TaskPickedUpdate()
+        )
+    )
+    worker_side.close()
+
+    assert listener.drained.wait(5)
+    assert controller_side.closed
+    db_session.expire_all()
+    assert crud.task.get_task_by_id(db_session, task.id).state == "running"
+
+
+def _return_without_update(task, conn):
+    pass
+
+
+def test_worker_returning_without_terminal_update_finishes(
+    db_session, make_task, task_executor, monkeypatch
+):
+    monkeypatch.setattr(executor_module, "worker_run_task", _return_without_update)
+    executor = task_executor
+    pool = create_worker_pool(1, 1)
+    executor.pools = {kind: pool for kind in executor.pools}
+    task = make_task(state="pending")
+
+    executor.start_task(
+        task_models.TaskSubmission(
+            id=task.id,
+            data=task_models.ProjectFlakeUpdateTaskSubmission(
+                project_path="/project", nix_access_tokens=""
+            ),
+        )
+    )
+
+    # finish_task marks the task failed once the connection drained
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        db_session.expire_all()
+        if crud.task.get_task_by_id(db_session, task.id).state == "failed":
+            break
+        time.sleep(0.01)
+    assert crud.task.get_task_by_id(db_session, task.id).state == "failed"
+    assert not executor.futures and not executor.listeners
+    assert not executor.worker_connections
+    pool.shutdown()
+
+
+def test_dispatcher_survives_a_corrupt_message(db_session, make_task, task_executor):
+    executor = task_executor
+    corrupt, healthy = make_task(state="pending"), make_task(state="pending")
+    corrupt_side, corrupt_worker = Pipe()
+    healthy_side, healthy_worker = Pipe()
+    corrupt_listener = executor.dispatcher.register(corrupt.id, corrupt_side)
+    healthy_listener = executor.dispatcher.register(healthy.id, healthy_side)
+
+    corrupt_worker.send_bytes(b"\x80\x05not a pickle")
+    assert corrupt_listener.drained.wait(5)
+    assert corrupt_side.closed
+
+    healthy_worker.send(
+        task_models.RunnerToControllerTaskUpdate(
+            id=healthy.id, update=task_models.TaskCompletedUpdate()
+        )
+    )
+    assert healthy_listener.drained.wait(5)
+    db_session.expire_all()
+    assert crud.task.get_task_by_id(db_session, healthy.id).state == "completed"
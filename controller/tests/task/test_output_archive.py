@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from thymis_controller import crud
+from thymis_controller.config import global_settings
+from thymis_controller.task import output_archive
+
+
+def _make_expired_task(make_task, db_session, age_days):
+    end_time = datetime.now(timezone.utc) - timedelta(days=age_days)
+    task = make_task(
+        state="completed",
+        submitted_time=end_time,
+        end_time=end_time,
+        processes=[{"nix_status": {"done": 1}}],
+    )
+    crud.task.append_nix_log(
+        db_session, task.id, 0, "nix_warning_logs", ["warning: dirty tree"]
+    )
+    db_session.commit()
+    return task.id
+
+
+def test_archive_and_restore_task_output(db_session, make_task, tmp_path, monkeypatch):
+    monkeypatch.setattr(global_settings, "PROJECT_PATH", tmp_path)
+    monkeypatch.setattr(global_settings, "TASK_OUTPUT_RETENTION_DAYS", 30)
+    monkeypatch.setattr(global_settings, "TASK_OUTPUT_ARCHIVE_BATCH_SIZE", 1)
+    old_id = _make_expired_task(make_task, db_session, age_days=40)
+    recent_id = _make_expired_task(make_task, db_session, age_days=1)
+    stdout = os.urandom(200 * 1024)
+    for task_id in (old_id, recent_id):
+        crud.task.append_process_output(db_session, task_id, 0, "stdout", stdout)
+        crud.task.append_process_output(db_session, task_id, 0, "stderr", b"err\n")
+    db_session.commit()
+
+    assert asyncio.run(output_archive.archive_expired_task_output(db_session)) == 1
+    db_session.expire_all()
+    task = crud.task.get_task_by_id(db_session, old_id)
+    assert task.output_archived_time is not None
+    assert crud.task.process_output_length(db_session, old_id, 0, "stdout") == 0
+    process = task.get_process_by_index(0)
+    assert process.nix_warning_logs is None
+    # the summary stays
+    assert process.nix_status == {"done": 1}
+    assert output_archive.archive_path(old_id).exists()
+    assert not output_archive.archive_path(recent_id).exists()
+    assert crud.task.read_process_output(db_session, recent_id, 0, "stdout") == stdout
+
+    output_archive.restore_task_output(db_session, old_id)
+    db_session.expire_all()
+    task = crud.task.get_task_by_id(db_session, old_id)
+    assert task.output_archived_time is None
+    assert crud.task.read_process_output(db_session, old_id, 0, "stdout") == stdout
+    assert crud.task.read_process_output(db_session, old_id, 0, "stderr") == b"err\n"
+    assert task.get_process_by_index(0).nix_warning_logs == ["warning: dirty tree"]
+    assert not output_archive.archive_path(old_id).exists()
+    # restored output is kept for another retention period
+    assert asyncio.run(output_archive.archive_expired_task_output(db_session)) == 0
+
+
+def test_archiving_does_not_block_the_event_loop(
+    db_session, make_task, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(global_settings, "PROJECT_PATH", tmp_path)
+    monkeypatch.setattr(global_settings, "TASK_OUTPUT_RETENTION_DAYS", 30)
+    _make_expired_task(make_task, db_session, age_days=40)
+    write_output_archive = output_archive.write_output_archive
+
+    def slow_write_output_archive(session, task_id):
+        # stands in for compressing a large output
+        time.sleep(0.3)
+        write_output_archive(session, task_id)
+
+    monkeypatch.setattr(
+        output_archive, "write_output_archive", slow_write_output_archive
+    )
+
+    async def archive_and_tick():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        archived = await output_archive.archive_expired_task_output(db_session)
+        ticker.cancel()
+        return archived, ticks
+
+    archived, ticks = asyncio.run(archive_and_tick())
+    assert archived == 1
+    assert ticks > 10
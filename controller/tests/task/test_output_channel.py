@@ -0,0 +1,46 @@
+import uuid
+from multiprocessing import Pipe
+
+import pytest
+from thymis_controller.models import task as task_models
+from thymis_controller.task.output_channel import (
+    TaskOutputFrame,
+    decode_message,
+    encode_output_frame,
+    send_output,
+)
+
+
+def test_output_frame_round_trip_over_pipe():
+    task_id = uuid.uuid4()
+    receiver, sender = Pipe(duplex=False)
+    send_output(sender, task_id, 3, b"stdout \x00\xff", b"")
+
+    frame = decode_message(receiver.recv_bytes())
+
+    assert frame == TaskOutputFrame(
+        task_id=task_id, process_index=3, stdout=b"stdout \x00\xff", stderr=b""
+    )
+
+
+def test_pickled_messages_share_the_connection():
+    task_id = uuid.uuid4()
+    receiver, sender = Pipe(duplex=False)
+    sender.send(
+        task_models.RunnerToControllerTaskUpdate(
+            id=task_id, update=task_models.TaskPickedUpdate()
+        )
+    )
+    send_output(sender, task_id, 0, b"", b"TOUT on stderr")
+
+    message = decode_message(receiver.recv_bytes())
+    frame = decode_message(receiver.recv_bytes())
+
+    assert isinstance(message.update, task_models.TaskPickedUpdate)
+    assert frame.stderr == b"TOUT on stderr"
+
+
+def test_truncated_output_frame_is_rejected():
+    frame = encode_output_frame(uuid.uuid4(), 0, b"abc", b"def")
+    with pytest.raises(ValueError):
+        decode_message(bytes(frame[:-1]))
@@ -0,0 +1,26 @@
+from thymis_controller import crud, db_models
+from thymis_controller.task.output_compactor import TaskOutputCompactor
+
+
+class FakeManager:
+    def __init__(self, db_engine):
+        self.db_engine = db_engine
+
+
+def test_compactor_merges_output_of_queued_tasks(db_session, make_task):
+    task = make_task(state="completed", processes=[{}])
+    output = b""
+    for i in range(50):
+        line = f"line {i}\n".encode() * 50
+        output += line
+        crud.task.append_process_output(db_session, task.id, 0, "stdout", line)
+    db_session.commit()
+
+    compactor = TaskOutputCompactor(FakeManager(db_session.bind))
+    compactor.put(task.id)
+    compactor.stop()
+
+    db_session.expire_all()
+    (chunk,) = db_session.query(db_models.TaskOutputChunk).all()
+    assert chunk.compression == "zlib"
+    assert crud.task.read_process_output(db_session, task.id, 0, "stdout") == output
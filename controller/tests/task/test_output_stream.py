@@ -0,0 +1,77 @@
+import asyncio
+
+from thymis_controller import crud
+from thymis_controller.notifier import Notifier
+from thymis_controller.task import output_stream
+from thymis_controller.task.output_stream import (
+    TaskOutputFollower,
+    content_range,
+    resolve_output_range,
+)
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.on_task_output = Notifier()
+        self.on_task_update = Notifier()
+
+
+def test_resolve_output_range():
+    assert resolve_output_range(100) == (0, 100)
+    assert resolve_output_range(100, start=10, end=20) == (10, 20)
+    assert resolve_output_range(100, start=90, end=200) == (90, 100)
+    assert resolve_output_range(100, start=200) == (100, 100)
+    assert resolve_output_range(100, start=50, end=10) == (50, 50)
+    assert resolve_output_range(100, tail=30) == (70, 100)
+    assert resolve_output_range(100, tail=300) == (0, 100)
+    length = output_stream.MAX_OUTPUT_RANGE_BYTES * 2
+    assert resolve_output_range(length, start=1) == (
+        1,
+        1 + output_stream.MAX_OUTPUT_RANGE_BYTES,
+    )
+    assert content_range(70, 100, 100) == "bytes 70-99/100"
+    assert content_range(100, 100, 100) == "bytes */100"
+
+
+def test_follower_streams_until_task_finished(db_session, make_task, monkeypatch):
+    monkeypatch.setattr(output_stream, "FOLLOW_READ_SIZE", 4)
+    task = make_task(processes=[{}])
+    crud.task.append_process_output(db_session, task.id, 0, "stdout", b"ab\xe2\x82")
+    db_session.commit()
+
+    async def follow():
+        follower = TaskOutputFollower(
+            db_session.bind, FakeExecutor(), task.id, 0, "stdout"
+        )
+        events = follower.events()
+        received = [await anext(events)]
+        crud.task.append_process_output(db_session, task.id, 0, "stdout", b"\xac cd")
+        task.state = "completed"
+        db_session.commit()
+        follower.changed.set()
+        async for event in events:
+            received.append(event)
+        return received
+
+    assert asyncio.run(follow()) == [
+        'event: output\nid: 2\ndata: "ab"\n\n',
+        'event: output\nid: 8\ndata: "\\u20ac cd"\n\n',
+        'event: end\ndata: "completed"\n\n',
+    ]
+
+
+def test_follower_resumes_from_offset(db_session, make_task):
+    task = make_task(state="failed", processes=[{}])
+    crud.task.append_process_output(db_session, task.id, 0, "stderr", b"0123456789")
+    db_session.commit()
+
+    async def follow():
+        follower = TaskOutputFollower(
+            db_session.bind, FakeExecutor(), task.id, 0, "stderr", offset=7
+        )
+        return [event async for event in follower.events()]
+
+    assert asyncio.run(follow()) == [
+        'event: output\nid: 10\ndata: "789"\n\n',
+        'event: end\ndata: "failed"\n\n',
+    ]
@@ -0,0 +1,127 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy
+from thymis_controller import crud, db_models
+from thymis_controller.config import global_settings
+from thymis_controller.task.rollout import activation_state, rollout_wave_sizes
+
+
+def test_rollout_wave_sizes():
+    assert rollout_wave_sizes(100, ["1", "5%", "25%"]) == [1, 5, 25, 69]
+    # percentages round up, waves are never empty
+    assert rollout_wave_sizes(10, ["1", "5%", "25%"]) == [1, 1, 3, 5]
+    assert rollout_wave_sizes(2, ["1", "5%", "25%"]) == [1, 1]
+    assert rollout_wave_sizes(3, []) == [3]
+    assert rollout_wave_sizes(3, ["100%"]) == [3]
+
+
+def _make_device(db_session, commit, last_seen):
+    deployment_info = db_models.DeploymentInfo(
+        ssh_public_key=f"ssh-ed25519 AAAA{uuid.uuid4().hex}",
+        deployed_config_id="kiosk",
+        deployed_config_commit=commit,
+        last_seen=last_seen,
+    )
+    db_session.add(deployment_info)
+    db_session.commit()
+    crud.agent_connection.create(db_session, "connect", deployment_info.id)
+    return deployment_info
+
+
+def _make_deploy_task(db_session, parent_id, deployment_info, wave, state, end_time):
+    task = db_models.Task(
+        id=uuid.uuid4(),
+        submitted_time=datetime.now(timezone.utc),
+        end_time=end_time,
+        state=state,
+        task_type="deploy_device_task",
+        parent_task_id=parent_id,
+        task_submission_data={
+            "type": "deploy_device_task",
+            "device": {
+                "identifier": "kiosk",
+                "deployment_info_id": str(deployment_info.id),
+            },
+            "config_commit": "new",
+            "rollout_wave": wave,
+        },
+    )
+    db_session.add(task)
+    db_session.commit()
+    return task
+
+
+def test_wave_activates_after_previous_wave_is_healthy(db_session, monkeypatch):
+    monkeypatch.setattr(global_settings, "DEPLOY_ROLLOUT_HEALTH_TIMEOUT_SECONDS", 600)
+    now = datetime.now(timezone.utc)
+    parent_id = uuid.uuid4()
+    canary = _make_device(db_session, "old", now)
+    first = _make_deploy_task(db_session, parent_id, canary, 0, "running", None)
+    second = _make_deploy_task(
+        db_session, parent_id, _make_device(db_session, "old", now), 1, "running", None
+    )
+
+    assert activation_state(db_session, first) == ("open", None)
+    assert activation_state(db_session, second) == ("wait", None)
+
+    # activated, but the agent did not report the new configuration yet
+    first.state = "completed"
+    first.end_time = now - timedelta(seconds=5)
+    db_session.commit()
+    assert activation_state(db_session, second) == ("wait", None)
+
+    canary.deployed_config_commit = "new"
+    db_session.commit()
+    assert activation_state(db_session, second) == ("open", None)
+
+
+def test_rollout_halts_when_previous_wave_fails_or_stays_unhealthy(
+    db_session, monkeypatch
+):
+    monkeypatch.setattr(global_settings, "DEPLOY_ROLLOUT_HEALTH_TIMEOUT_SECONDS", 60)
+    now = datetime.now(timezone.utc)
+    parent_id = uuid.uuid4()
+    device = _make_device(db_session, "old", now - timedelta(minutes=10))
+    _make_deploy_task(
+        db_session, parent_id, device, 0, "completed", now - timedelta(minutes=5)
+    )
+    later = _make_deploy_task(db_session, parent_id, device, 1, "running", None)
+    state, reason = activation_state(db_session, later)
+    assert state == "halt"
+    assert "not healthy" in reason
+
+    other_parent = uuid.uuid4()
+    _make_deploy_task(db_session, other_parent, device, 0, "failed", now)
+    later = _make_deploy_task(db_session, other_parent, device, 1, "running", None)
+    state, reason = activation_state(db_session, later)
+    assert state == "halt"
+    assert "failed" in reason
+
+
+def test_held_tasks_of_a_rollout_share_its_waves(db_session):
+    now = datetime.now(timezone.utc)
+    parent_id = uuid.uuid4()
+    device = _make_device(db_session, "new", now)
+    _make_deploy_task(
+        db_session, parent_id, device, 0, "completed", now - timedelta(seconds=5)
+    )
+    held = [
+        _make_deploy_task(db_session, parent_id, device, 1, "running", None)
+        for _ in range(20)
+    ]
+    statements = []
+    sqlalchemy.event.listen(
+        db_session.get_bind(),
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    rollouts = {}
+    states = [activation_state(db_session, task, rollouts) for task in held]
+
+    assert set(states) == {("open", None)}
+    assert list(rollouts) == [parent_id]
+    # one count by wave and state and one load of the previous wave in total
+    rollout_queries = [s for s in statements if "tasks.parent_task_id = ?" in s]
+    assert len(rollout_queries) == 2
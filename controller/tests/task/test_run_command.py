@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+import uuid
+from multiprocessing import Pipe
+
+import pytest
+from thymis_controller.models import task as task_models
+from thymis_controller.task.output_channel import TaskOutputFrame, decode_message
+from thymis_controller.task.worker import ProcessList, run_command
+
+
+def _task():
+    return task_models.TaskSubmission(
+        id=uuid.uuid4(),
+        data=task_models.ProjectFlakeUpdateTaskSubmission(
+            project_path="/project", nix_access_tokens=""
+        ),
+    )
+
+
+def _receive_all(conn):
+    messages = []
+    while True:
+        try:
+            messages.append((time.monotonic(), decode_message(conn.recv_bytes())))
+        except EOFError:
+            return messages
+
+
+def _run(script, **kwargs):
+    receiver, sender = Pipe(duplex=False)
+    messages = []
+    collector = threading.Thread(target=lambda: messages.extend(_receive_all(receiver)))
+    collector.start()
+    started = time.monotonic()
+    returncode = run_command(
+        _task(), sender, ProcessList(), ["sh", "-c", script], **kwargs
+    )
+    sender.close()
+    collector.join()
+    return returncode, started, messages
+
+
+def _frames(messages):
+    return [m for _, m in messages if isinstance(m, TaskOutputFrame)]
+
+
+def test_run_command_collects_output_and_exit_code():
+    returncode, _, messages = _run(
+        "printf 'out\\n'; printf 'err\\n' >&2; head -c 200000 /dev/zero; exit 3"
+    )
+
+    frames = _frames(messages)
+    stdout = b"".join(frame.stdout for frame in frames)
+    assert returncode == 3
+    assert stdout == b"out\n" + b"\0" * 200000
+    assert b"".join(frame.stderr for frame in frames) == b"err\n"
+    assert isinstance(messages[0][1].update, task_models.CommandRunUpdate)
+
+
+def test_complete_lines_are_flushed_without_waiting_for_more_output():
+    _, started, messages = _run("echo first; sleep 1; echo second")
+
+    first_at, first = next(
+        (at, m) for at, m in messages if isinstance(m, TaskOutputFrame)
+    )
+    assert first.stdout == b"first\n"
+    assert first_at - started < 0.5
+
+
+def test_partial_nix_lines_are_parsed_once_complete():
+    line = "@nix " + json.dumps({"action": "msg", "level": 0, "msg": "boom"})
+    returncode, _, messages = _run(
+        f"printf '%s' '{line[:10]}' >&2; sleep 0.7; printf '%s\\n' '{line[10:]}' >&2"
+    )
+
+    statuses = [
+        m.update
+        for _, m in messages
+        if isinstance(m, task_models.RunnerToControllerTaskUpdate)
+        and isinstance(m.update, task_models.TaskNixStatusUpdate)
+    ]
+    assert returncode == 0
+    assert statuses[-1].status.logs_by_level[0] == ["boom"]
+    assert b"".join(frame.stderr for frame in _frames(messages)) == b""
+
+
+def test_run_command_writes_input():
+    returncode, _, messages = _run("cat", input=b"x" * 300000)
+
+    assert returncode == 0
+    assert b"".join(frame.stdout for frame in _frames(messages)) == b"x" * 300000
+
+
+def test_run_command_reads_stdin_pipe_and_polls():
+    read_fd, write_fd = os.pipe()
+    polls = []
+
+    def feed():
+        with os.fdopen(write_fd, "wb") as sink:
+            for _ in range(3):
+                sink.write(b"y" * 1000)
+                sink.flush()
+                time.sleep(0.3)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    returncode, _, messages = _run(
+        "wc -c", stdin=read_fd, on_poll=lambda: polls.append(1)
+    )
+    feeder.join()
+
+    assert returncode == 0
+    assert b"".join(frame.stdout for frame in _frames(messages)).strip() == b"3000"
+    assert len(polls) >= 2
+    # the pipe was handed to the process, not kept open here
+    with pytest.raises(OSError):
+        os.fstat(read_fd)
@@ -0,0 +1,181 @@
+import uuid
+
+from thymis_controller.models import task as task_models
+from thymis_controller.task.scheduler import ResourceSlots, TaskScheduler
+
+
+def _submission(task_type):
+    data = {
+        "ssh_command_task": task_models.SSHCommandTaskSubmission,
+        "build_project_task": task_models.BuildProjectTaskSubmission,
+        "run_nixos_vm_task": task_models.RunNixOSVMTaskSubmission,
+        "deploy_device_task": task_models.DeployDeviceTaskSubmission,
+    }[task_type].model_construct()
+    return task_models.TaskSubmission.model_construct(id=uuid.uuid4(), data=data)
+
+
+def _scheduler(
+    workers, builds=10, io_workers=None, vms=10, interactive_workers=0, waiting=None
+):
+    started = []
+    scheduler = TaskScheduler(
+        lambda submission: started.append(submission.id),
+        {"cpu": workers, "io": workers if io_workers is None else io_workers},
+        {"nix_build": ResourceSlots(builds), "nixos_vm": ResourceSlots(vms)},
+        interactive_workers,
+        waiting,
+    )
+    return scheduler, started
+
+
+def test_interactive_tasks_start_before_builds():
+    scheduler, started = _scheduler(workers=1)
+    first = _submission("build_project_task")
+    scheduler.submit(first)
+    builds = [_submission("build_project_task") for _ in range(3)]
+    for submission in builds:
+        scheduler.submit(submission)
+    vm = _submission("run_nixos_vm_task")
+    scheduler.submit(vm)
+
+    assert started == [first.id]
+    scheduler.task_finished(first.id)
+    assert started == [first.id, vm.id]
+
+    stats = {stats.priority: stats for stats in scheduler.stats()}
+    assert stats["build"].queued == 3
+    assert stats["interactive"].running == 1
+    assert stats["interactive"].started == 1
+
+
+def test_resource_limit_and_user_round_robin():
+    scheduler, started = _scheduler(workers=4, builds=2)
+    alice, bob = uuid.uuid4(), uuid.uuid4()
+    alice_builds = [_submission("build_project_task") for _ in range(3)]
+    bob_builds = [_submission("build_project_task") for _ in range(2)]
+    for submission in alice_builds:
+        scheduler.submit(submission, alice)
+    for submission in bob_builds:
+        scheduler.submit(submission, bob)
+
+    # only two builds may run, the remaining workers stay free
+    assert started == [alice_builds[0].id, alice_builds[1].id]
+    scheduler.task_finished(alice_builds[0].id)
+    assert started[-1] == bob_builds[0].id
+    scheduler.task_finished(alice_builds[1].id)
+    assert started[-1] == alice_builds[2].id
+    scheduler.task_finished(bob_builds[0].id)
+    assert started[-1] == bob_builds[1].id
+
+
+def test_cancel_queued_task():
+    scheduler, started = _scheduler(workers=1)
+    running = _submission("build_project_task")
+    queued = _submission("build_project_task")
+    scheduler.submit(running)
+    scheduler.submit(queued)
+
+    assert scheduler.cancel(queued.id)
+    assert not scheduler.cancel(running.id)
+    scheduler.task_finished(running.id)
+    assert started == [running.id]
+
+
+def test_worker_pools_are_sized_separately():
+    scheduler, started = _scheduler(workers=1, io_workers=2)
+    builds = [_submission("build_project_task") for _ in range(2)]
+    commands = [_submission("ssh_command_task") for _ in range(3)]
+    for submission in builds + commands:
+        scheduler.submit(submission)
+
+    # a busy build worker does not hold back commands on the io pool
+    assert started == [builds[0].id, commands[0].id, commands[1].id]
+    scheduler.task_finished(commands[0].id)
+    assert started[-1] == commands[2].id
+    scheduler.task_finished(builds[0].id)
+    assert started[-1] == builds[1].id
+
+
+def test_running_vms_do_not_hold_build_slots():
+    scheduler, started = _scheduler(workers=4, builds=2, vms=1)
+    vms = [_submission("run_nixos_vm_task") for _ in range(2)]
+    builds = [_submission("build_project_task") for _ in range(2)]
+    for submission in vms + builds:
+        scheduler.submit(submission)
+
+    assert started == [vms[0].id, builds[0].id, builds[1].id]
+    scheduler.task_finished(vms[0].id)
+    assert started[-1] == vms[1].id
+
+
+def test_workers_are_reserved_for_interactive_tasks():
+    scheduler, started = _scheduler(workers=3, interactive_workers=1)
+    builds = [_submission("build_project_task") for _ in range(3)]
+    for submission in builds:
+        scheduler.submit(submission)
+    assert started == [builds[0].id, builds[1].id]
+
+    command = _submission("ssh_command_task")
+    vm = _submission("run_nixos_vm_task")
+    scheduler.submit(command)
+    scheduler.submit(vm)
+    assert started[2:] == [command.id, vm.id]
+
+    # a pool with a single worker is not reserved
+    scheduler, started = _scheduler(workers=1, interactive_workers=1)
+    build = _submission("build_project_task")
+    scheduler.submit(build)
+    assert started == [build.id]
+
+
+def test_waiting_tasks_give_up_their_worker():
+    scheduler, started = _scheduler(workers=1, io_workers=1, waiting={"io": 1})
+    deploys = [_submission("deploy_device_task") for _ in range(3)]
+    for submission in deploys:
+        scheduler.submit(submission)
+    assert started == [deploys[0].id]
+
+    # the first deploy waits for a stage slot, the next one takes its place
+    scheduler.task_waiting(deploys[0].id)
+    scheduler.dispatch()
+    assert started == [deploys[0].id, deploys[1].id]
+    # all extra workers are taken, the second deploy keeps its place
+    scheduler.task_waiting(deploys[1].id)
+    scheduler.dispatch()
+    assert started == [deploys[0].id, deploys[1].id]
+
+    scheduler.task_resumed(deploys[0].id)
+    scheduler.task_finished(deploys[1].id)
+    assert started == [deploys[0].id, deploys[1].id]
+    scheduler.task_finished(deploys[0].id)
+    assert started[-1] == deploys[2].id
+
+
+def test_failed_start_does_not_stop_the_other_tasks():
+    started, failed = [], []
+    broken = _submission("ssh_command_task")
+
+    def start_task(submission):
+        if submission.id == broken.id:
+            raise RuntimeError("pool is gone")
+        started.append(submission.id)
+
+    scheduler = TaskScheduler(
+        start_task,
+        {"cpu": 4, "io": 4},
+        {"nix_build": ResourceSlots(1)},
+        start_failed=lambda submission, e: failed.append((submission.id, str(e))),
+    )
+    ssh, build = _submission("ssh_command_task"), _submission("build_project_task")
+    # queue all of them, so one dispatch pass takes them in this order
+    scheduler._stopped = True
+    for submission in (broken, ssh, build):
+        scheduler.submit(submission)
+    scheduler._stopped = False
+    scheduler.dispatch()
+
+    assert failed == [(broken.id, "pool is gone")]
+    assert started == [ssh.id, build.id]
+    stats = {stats.priority: stats for stats in scheduler.stats()}
+    assert stats["interactive"].running == 1
+    assert stats["build"].running == 1
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+from thymis_controller import crud
+from thymis_controller.task.subscribe_ui import (
+    SNAPSHOT_TAIL_BYTES,
+    SubscribedTaskProcessCounter,
+    TaskWebsocketSubscriber,
+)
+from thymis_controller.task.update_writer import TaskOutputDelta
+
+
+@pytest.fixture
+def event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def _subscribe(db_session, task, cursor=None):
+    subscriber = TaskWebsocketSubscriber(db_session.bind, None, None)
+    subscriber.reset_subscribed_task(task.id, cursor)
+    snapshot, _ = subscriber.create_subscribed_task(
+        db_session, crud.task.get_task_by_id(db_session, task.id)
+    )
+    return subscriber, snapshot
+
+
+def _append(db_session, task, data, delta=None):
+    chunk = crud.task.append_process_output(db_session, task.id, 0, "stdout", data)
+    db_session.commit()
+    if delta is not None:
+        delta.process(0).append("stdout", chunk.offset, data)
+
+
+def test_split_utf8_character_is_held_back(db_session, make_task, event_loop):
+    task = make_task(processes=[{"legacy_stdout": b"old "}])
+    _append(db_session, task, "€".encode()[:2])
+    subscriber, snapshot = _subscribe(db_session, task)
+    assert snapshot.processes[0].process_stdout == "old "
+    assert subscriber.process_counter[0].send_stdout == 4
+
+    delta = TaskOutputDelta(task.id)
+    _append(db_session, task, "€".encode()[2:] + b"!", delta)
+    output = subscriber.create_process_output(task.id, delta.processes[0])
+    assert output.process_stdout == "€!"
+    assert output.process_program is None
+    assert subscriber.process_counter[0].send_stdout == 8
+
+
+def test_overlap_is_trimmed_and_gaps_are_read(db_session, make_task, event_loop):
+    task = make_task(processes=[{"legacy_stdout": b"old "}])
+    early = TaskOutputDelta(task.id)
+    _append(db_session, task, b"a", early)
+    # the snapshot already contains "a" when its delta is delivered
+    subscriber, snapshot = _subscribe(db_session, task)
+    assert snapshot.processes[0].process_stdout == "old a"
+    assert subscriber.create_process_output(task.id, early.processes[0]) == (
+        subscriber.create_process_output(task.id, TaskOutputDelta(task.id).process(0))
+    )
+
+    # "b" was committed but its delta was missed
+    _append(db_session, task, b"b")
+    delta = TaskOutputDelta(task.id)
+    _append(db_session, task, b"c", delta)
+    output = subscriber.create_process_output(task.id, delta.processes[0])
+    assert output.process_stdout == "bc"
+
+    delta = TaskOutputDelta(task.id)
+    delta.process(0).append("nix_error_logs", 0, ["first", "second"])
+    subscriber.process_counter[0].send_nix_error_logs = 1
+    output = subscriber.create_process_output(task.id, delta.processes[0])
+    assert output.nix_error_logs == ["second"]
+    assert subscriber.process_counter[0].send_nix_error_logs == 2
+
+
+def test_resume_from_cursor(db_session, make_task, event_loop):
+    task = make_task(processes=[{"legacy_stdout": b"old "}])
+    _append(db_session, task, b"new output")
+    crud.task.append_nix_log(
+        db_session, task.id, 0, "nix_info_logs", ["sent", "new", "newer"]
+    )
+    db_session.commit()
+    subscriber, snapshot = _subscribe(
+        db_session,
+        task,
+        {0: SubscribedTaskProcessCounter(send_stdout=4, send_nix_info_logs=1)},
+    )
+    assert snapshot.processes[0].process_stdout == "new output"
+    assert snapshot.processes[0].process_stderr is None
+    assert subscriber.process_counter[0].send_stdout == len(b"old new output")
+    assert snapshot.processes[0].nix_info_logs == ["new", "newer"]
+    assert snapshot.processes[0].nix_warning_logs is None
+    assert subscriber.process_counter[0].send_nix_info_logs == 3
+
+
+def test_snapshot_starts_at_the_tail(db_session, make_task, event_loop):
+    task = make_task(processes=[{"legacy_stdout": b"old "}])
+    euros = SNAPSHOT_TAIL_BYTES // 3 + 1
+    _append(db_session, task, b"x" * 1000 + "€".encode() * euros)
+    subscriber = TaskWebsocketSubscriber(db_session.bind, None, None)
+    subscriber.reset_subscribed_task(task.id)
+    snapshot, output_start = subscriber.create_subscribed_task(
+        db_session, crud.task.get_task_by_id(db_session, task.id)
+    )
+
+    # the tail starts in the middle of the first euro sign, which is left out
+    length = len(b"old ") + 1000 + euros * 3
+    assert length - SNAPSHOT_TAIL_BYTES == len(b"old ") + 1000 + 2
+    assert output_start == {0: {"stdout": len(b"old ") + 1000 + 3}}
+    assert snapshot.processes[0].process_stdout == "€" * (euros - 1)
+    assert subscriber.process_counter[0].send_stdout == length
+
+
+def test_resume_far_behind_starts_at_the_tail(db_session, make_task, event_loop):
+    task = make_task(processes=[{"legacy_stdout": b"old "}])
+    _append(db_session, task, b"x" * (SNAPSHOT_TAIL_BYTES + 1000))
+    subscriber = TaskWebsocketSubscriber(db_session.bind, None, None)
+    subscriber.reset_subscribed_task(
+        task.id, {0: SubscribedTaskProcessCounter(send_stdout=2)}
+    )
+    snapshot, output_start = subscriber.create_subscribed_task(
+        db_session, crud.task.get_task_by_id(db_session, task.id)
+    )
+
+    length = len(b"old ") + SNAPSHOT_TAIL_BYTES + 1000
+    assert output_start == {0: {"stdout": length - SNAPSHOT_TAIL_BYTES}}
+    assert len(snapshot.processes[0].process_stdout) == SNAPSHOT_TAIL_BYTES
+    assert subscriber.process_counter[0].send_stdout == length
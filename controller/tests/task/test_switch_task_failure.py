@@ -67,7 +67,7 @@ def test_failed_switch_task_clears_pending_config_id(db_session):
     worker_side.close()
     executor.futures[task.id] = (None, controller_side)
 
-    executor.listen_child_messages(controller_side, task.id)
+    executor.dispatcher.register(task.id, controller_side).drained.wait()
     db_session.expire_all()
 
     updated = crud.deployment_info.get_by_id(db_session, deployment_info.id)
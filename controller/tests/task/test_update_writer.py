@@ -0,0 +1,159 @@
+import base64
+import uuid
+from multiprocessing import Pipe
+
+from thymis_controller import crud
+from thymis_controller.models import task as task_models
+from thymis_controller.nix.log_parse import ParsedNixProcess
+from thymis_controller.task.output_channel import send_output
+from thymis_controller.task.update_writer import (
+    PendingTaskOutput,
+    PendingTaskUpdate,
+    coalesce_updates,
+)
+
+
+def _output(task_id, process_index, stdout):
+    return PendingTaskOutput(
+        task_id=task_id, process_index=process_index, stdout=bytearray(stdout)
+    )
+
+
+def _nix_status(task_id, done, error_logs=()):
+    return PendingTaskUpdate(
+        conn=None,
+        message=task_models.RunnerToControllerTaskUpdate(
+            id=task_id,
+            update=task_models.TaskNixStatusUpdate(
+                process_index=0,
+                status=ParsedNixProcess(
+                    done=done,
+                    expected=10,
+                    running=0,
+                    failed=0,
+                    logs_by_level={0: list(error_logs)},
+                ),
+            ),
+        ),
+    )
+
+
+def test_coalesce_merges_output_and_nix_status():
+    task_id = uuid.uuid4()
+    other_task_id = uuid.uuid4()
+    updates = [
+        _output(task_id, 0, b"a"),
+        _nix_status(task_id, 1, ["first"]),
+        _output(other_task_id, 0, b"x"),
+        _output(task_id, 0, b"b"),
+        _nix_status(task_id, 5, ["second"]),
+        _output(task_id, 1, b"c"),
+    ]
+
+    coalesced = coalesce_updates(updates)
+
+    assert len(coalesced) == 4
+    assert coalesced[0].stdout == b"ab"
+    assert coalesced[1].message.update.status.done == 5
+    assert coalesced[1].message.update.status.logs_by_level[0] == ["first", "second"]
+    assert coalesced[2].stdout == b"x"
+    assert coalesced[3].process_index == 1
+
+
+def test_writer_commits_batched_output_before_terminal_update(
+    db_session, make_task, task_executor
+):
+    task = make_task(state="pending")
+
+    executor = task_executor
+    controller_side, worker_side = Pipe()
+    for update in [
+        task_models.TaskPickedUpdate(),
+        task_models.CommandRunUpdate(process_index=0, args=["nix", "build"]),
+        task_models.TaskStdOutErrUpdate(
+            process_index=0,
+            stdoutb64=base64.b64encode(b"one\n").decode(),
+            stderrb64="",
+        ),
+    ]:
+        worker_side.send(
+            task_models.RunnerToControllerTaskUpdate(id=task.id, update=update)
+        )
+    send_output(worker_side, task.id, 0, b"two\n", b"")
+    worker_side.send(
+        task_models.RunnerToControllerTaskUpdate(
+            id=task.id, update=task_models.TaskCompletedUpdate()
+        )
+    )
+    worker_side.close()
+    executor.futures[task.id] = (None, controller_side)
+
+    executor.dispatcher.register(task.id, controller_side).drained.wait()
+    db_session.expire_all()
+
+    finished = crud.task.get_task_by_id(db_session, task.id)
+    assert finished.state == "completed"
+    assert finished.processes[0].process_program == "nix"
+    assert finished.processes[0].process_stdout == b"one\ntwo\n"
+    # both output updates were coalesced into a single chunk
+    assert len(finished.processes[0].output_chunks) == 1
+
+
+def test_nix_status_logs_are_appended(db_session, make_task, task_executor):
+    task = make_task(state="running")
+
+    executor = task_executor
+    executor.update_writer.apply([_nix_status(task.id, 1, ["first"])])
+    executor.update_writer.apply([_nix_status(task.id, 2, ["second"])])
+    executor.update_writer.apply([_nix_status(task.id, 3)])
+    db_session.expire_all()
+
+    process = crud.task.get_task_by_id(db_session, task.id).processes[0]
+    assert process.nix_status["done"] == 3
+    assert process.nix_error_logs == ["first", "second"]
+    assert process.nix_warning_logs is None
+
+
+def test_retried_batch_sends_replies_once(db_session, make_task, task_executor):
+    task = make_task(state="running", task_type="deploy_device_task")
+
+    executor = task_executor
+    controller_side, worker_side = Pipe()
+    batch = [
+        PendingTaskUpdate(
+            conn=controller_side,
+            message=task_models.RunnerToControllerTaskUpdate(
+                id=task.id, update=task_models.DeployStageClaimUpdate(stage="copy")
+            ),
+        ),
+        # fails the batch, which is then retried one update at a time
+        PendingTaskUpdate(
+            conn=controller_side,
+            message=task_models.RunnerToControllerTaskUpdate(
+                id=uuid.uuid4(), update=task_models.TaskPickedUpdate()
+            ),
+        ),
+    ]
+    executor.update_writer.write_batch(batch)
+
+    assert worker_side.recv().inner == task_models.DeployStageGranted(stage="copy")
+    assert not worker_side.poll(0.1)
+    stats = {stats.stage: stats for stats in executor.deploy_stages.stats()}
+    assert (stats["copy"].running, stats["copy"].started) == (1, 1)
+
+
+def test_stage_claims_skip_the_latency_budget(db_session, make_task, task_executor):
+    task = make_task(state="running", task_type="deploy_device_task")
+
+    executor = task_executor
+    executor.update_writer.commit_latency = 60
+    controller_side, worker_side = Pipe()
+    executor.update_writer.put(
+        controller_side,
+        task_models.RunnerToControllerTaskUpdate(
+            id=task.id, update=task_models.DeployStageClaimUpdate(stage="eval")
+        ),
+    )
+
+    assert worker_side.poll(5)
+    assert worker_side.recv().inner == task_models.DeployStageGranted(stage="eval")
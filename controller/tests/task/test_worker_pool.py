@@ -0,0 +1,28 @@
+import uuid
+
+from thymis_controller.task.worker_pool import WorkerPoolMetrics
+
+
+def test_worker_pool_metrics():
+    metrics = WorkerPoolMetrics({"cpu": 2, "io": 4})
+    tasks = [uuid.uuid4() for _ in range(4)]
+    for task_id in tasks[:3]:
+        metrics.task_submitted(task_id, "cpu")
+    metrics.task_submitted(tasks[3], "io")
+
+    # three workers reported but the pool only has two, the oldest is dropped
+    metrics.task_picked(tasks[0], 100, 50 * 2**20)
+    metrics.task_picked(tasks[1], 101, 60 * 2**20)
+    metrics.task_picked(tasks[2], 102, 70 * 2**20)
+    # a task finishing before it was picked is not counted
+    metrics.task_finished(tasks[3])
+    metrics.task_picked(tasks[3], 200, 80 * 2**20)
+
+    stats = {stats.pool: stats for stats in metrics.stats()}
+    assert stats["cpu"].workers == 2
+    assert stats["cpu"].tasks_started == 3
+    assert stats["cpu"].start_latency_median_seconds >= 0
+    assert stats["cpu"].worker_max_rss_bytes == {101: 60 * 2**20, 102: 70 * 2**20}
+    assert stats["io"].tasks_started == 0
+    assert stats["io"].start_latency_median_seconds is None
+    assert stats["io"].worker_max_rss_bytes == {}
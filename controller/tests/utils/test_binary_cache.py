@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import json
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from thymis_controller.nix.binary_cache import (
+    BinaryCache,
+    NixSigningKey,
+    nar_hash_nix32,
+    nix32_encode,
+    parse_path_infos,
+)
+
+TOPLEVEL = "/nix/store/1b9p07z77phvv2hf6gm9f28syh5ycl2k-nixos-system-kiosk"
+BASH = "/nix/store/4bj2kxdm1462fzcc2i2s4dn33g2angcc-bash-5.2"
+NAR_HASH = hashlib.sha256(b"nar").digest()
+
+
+def test_nix32_encode():
+    assert (
+        nix32_encode(hashlib.sha256(b"").digest())
+        == "0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73"
+    )
+    nix32 = f"sha256:{nix32_encode(NAR_HASH)}"
+    assert nar_hash_nix32(nix32) == nix32
+    assert nar_hash_nix32(f"sha256-{base64.b64encode(NAR_HASH).decode()}") == nix32
+    assert nar_hash_nix32(f"sha256:{NAR_HASH.hex()}") == nix32
+
+
+def test_parse_path_infos_old_and_new_format():
+    old = [
+        {
+            "path": TOPLEVEL,
+            "narHash": f"sha256:{nix32_encode(NAR_HASH)}",
+            "narSize": 1234,
+            "references": [BASH, TOPLEVEL],
+            "deriver": "/nix/store/x3jd-nixos-system-kiosk.drv",
+        },
+        {"path": BASH, "valid": False},
+    ]
+    new = {
+        TOPLEVEL: {
+            "narHash": f"sha256-{base64.b64encode(NAR_HASH).decode()}",
+            "narSize": 1234,
+            "references": [BASH.removeprefix("/nix/store/"), TOPLEVEL],
+            "deriver": "x3jd-nixos-system-kiosk.drv",
+        },
+        BASH: None,
+    }
+    assert parse_path_infos(json.dumps(old)) == parse_path_infos(json.dumps(new))
+    (info,) = parse_path_infos(json.dumps(old))
+    assert info.references == [BASH, TOPLEVEL]
+    assert info.deriver == "/nix/store/x3jd-nixos-system-kiosk.drv"
+
+
+def test_narinfo_is_signed(tmp_path):
+    cache = BinaryCache(tmp_path, 6, 1024)
+    (info,) = parse_path_infos(
+        json.dumps(
+            [
+                {
+                    "path": TOPLEVEL,
+                    "narHash": f"sha256:{nix32_encode(NAR_HASH)}",
+                    "narSize": 1234,
+                    "references": [BASH],
+                }
+            ]
+        )
+    )
+    cache._paths["1b9p07z77phvv2hf6gm9f28syh5ycl2k"] = info
+    assert cache.narinfo("4bj2kxdm1462fzcc2i2s4dn33g2angcc") is None
+    assert cache.nar_file("4bj2kxdm1462fzcc2i2s4dn33g2angcc") is None
+
+    narinfo = dict(
+        line.split(": ", 1)
+        for line in cache.narinfo("1b9p07z77phvv2hf6gm9f28syh5ycl2k").splitlines()
+    )
+    assert narinfo["URL"] == "nar/1b9p07z77phvv2hf6gm9f28syh5ycl2k.nar.xz"
+    assert narinfo["References"] == "4bj2kxdm1462fzcc2i2s4dn33g2angcc-bash-5.2"
+    assert "Deriver" not in narinfo
+
+    name, _, public_key = cache.signing_key.public_key.partition(":")
+    signature_name, _, signature = narinfo["Sig"].partition(":")
+    assert name == signature_name == "thymis-controller-1"
+    Ed25519PublicKey.from_public_bytes(base64.b64decode(public_key)).verify(
+        base64.b64decode(signature),
+        f"1;{TOPLEVEL};{narinfo['NarHash']};1234;{BASH}".encode(),
+    )
+
+    # the key is kept, devices keep trusting it after a restart
+    reloaded = NixSigningKey.load_or_create(tmp_path / "signing-key")
+    assert reloaded.public_key == cache.signing_key.public_key
+    assert (tmp_path / "signing-key").stat().st_mode & 0o777 == 0o600
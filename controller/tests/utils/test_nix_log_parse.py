@@ -0,0 +1,158 @@
+import json
+import random
+
+from thymis_controller.nix.log_parse import ActivityType, NixParser, ResultType
+
+
+def _line(**fields) -> bytes:
+    return b"@nix " + json.dumps(fields).encode() + b"\n"
+
+
+def _recalculate(parser: NixParser):
+    # full walk over all activities, as done before the counters were incremental
+    done = expected = running = failed = 0
+    for activities in parser.activities_done_expect_failed_by_type.values():
+        done += activities.done
+        expected += activities.done
+        failed += activities.failed
+        for activity in activities.activity_info_by_id.values():
+            done += activity.done
+            expected += activity.expected
+            running += activity.running
+            failed += activity.failed
+    return done, expected, running, failed
+
+
+def _random_build_log(seed: int, events: int = 2000) -> list[bytes]:
+    rng = random.Random(seed)
+    lines = []
+    live = []
+    next_id = 1
+    for _ in range(events):
+        choice = rng.random()
+        if choice < 0.2 or not live:
+            activity_type = rng.choice(
+                [ActivityType.BUILDS, ActivityType.BUILD, ActivityType.COPY_PATHS]
+            )
+            lines.append(
+                _line(
+                    action="start",
+                    id=next_id,
+                    level=rng.randint(0, 5),
+                    type=activity_type,
+                    text=rng.choice(["", f"building {next_id}"]),
+                    parent=0,
+                )
+            )
+            live.append(next_id)
+            next_id += 1
+        elif choice < 0.35:
+            lines.append(_line(action="stop", id=live.pop(rng.randrange(len(live)))))
+        elif choice < 0.7:
+            expected = rng.randint(0, 50)
+            done = rng.randint(0, expected)
+            lines.append(
+                _line(
+                    action="result",
+                    id=rng.choice(live),
+                    type=ResultType.PROGRESS,
+                    fields=[done, expected, rng.randint(0, 4), rng.randint(0, 2)],
+                )
+            )
+        elif choice < 0.8:
+            lines.append(
+                _line(
+                    action="result",
+                    id=rng.choice(live),
+                    type=ResultType.SET_EXPECTED,
+                    fields=[ActivityType.BUILD, rng.randint(0, 50)],
+                )
+            )
+        else:
+            lines.append(
+                _line(action="msg", level=rng.randint(0, 4), msg=f"message {choice}")
+            )
+    return lines
+
+
+def test_incremental_counters_match_full_recalculation():
+    for seed in range(5):
+        parser = NixParser()
+        for line in _random_build_log(seed):
+            parser.process_buffer(bytearray(line))
+            assert parser.calc_activities_done_expected_failed() == _recalculate(parser)
+
+
+def test_status_updates_only_carry_new_errors_and_logs():
+    parser = NixParser()
+    parser.process_buffer(
+        bytearray(
+            _line(action="msg", level=0, msg="first error")
+            + _line(action="msg", level=1, msg="warning")
+            + _line(action="msg", level=0, msg="boom", raw_msg="boom")
+        )
+    )
+    first = parser.take_status_update()
+    parser.process_buffer(bytearray(_line(action="msg", level=0, msg="second error")))
+    second = parser.take_status_update()
+    third = parser.take_status_update()
+
+    assert first.logs_by_level[0] == ["first error"]
+    assert first.logs_by_level[1] == ["warning"]
+    assert [error.msg for error in first.errors] == ["boom"]
+    assert second.logs_by_level == {0: ["second error"], 1: [], 2: [], 3: []}
+    assert second.errors == []
+    assert third.logs_by_level == {0: [], 1: [], 2: [], 3: []}
+    assert parser.get_model().logs_by_level[0] == ["first error", "second error"]
+
+
+def test_fast_decoder_matches_validating_parser():
+    lines = _random_build_log(7) + [
+        _line(action="msg", level=0, msg="\x1b[31;1merror:\x1b[0m colored"),
+        _line(
+            action="msg",
+            level=0,
+            msg="\x1b[31;1merror:\x1b[0m builder failed",
+            raw_msg="builder failed",
+            line=3,
+            file="/nix/store/x.nix",
+            trace=[{"raw_msg": "while evaluating"}],
+        ),
+        _line(action="result", id=1, type=ResultType.FILE_LINKED, fields=[42, 0]),
+        _line(action="unknown", id=1),
+        b"@nix {not json\n",
+        b"plain stderr line\n",
+        b"@nix " + json.dumps({"action": "msg", "level": 1}).encode(),
+    ]
+    buffer = bytearray(b"".join(lines))
+    fast, validating = NixParser(), NixParser(validate=True)
+    fast_buffer, validating_buffer = bytearray(buffer), bytearray(buffer)
+
+    assert fast.process_buffer(fast_buffer) == validating.process_buffer(
+        validating_buffer
+    )
+    assert fast_buffer == validating_buffer
+    assert fast.get_model() == validating.get_model()
+    assert fast.msg_output == validating.msg_output
+    assert list(fast.other_messages) == list(validating.other_messages)
+    assert fast.files_linked == validating.files_linked == 1
+    assert fast.errors[0].msg == "error: builder failed"
+
+
+def test_logs_and_msg_output_are_bounded():
+    parser = NixParser(max_log_lines=3, max_msg_output_chars=20)
+    for i in range(10):
+        parser.process_buffer(bytearray(_line(action="msg", level=1, msg=f"w{i}")))
+        if i == 1:
+            first = parser.take_status_update()
+    update = parser.take_status_update()
+
+    assert list(parser.warnings) == ["w7", "w8", "w9"]
+    assert parser.warnings.dropped == 7
+    assert first.logs_by_level[1] == ["w0", "w1"]
+    # w2 to w6 were dropped before they could be sent
+    assert update.logs_by_level[1] == ["[5 earlier lines dropped]", "w7", "w8", "w9"]
+    assert parser.get_model().logs_by_level[1][0] == "[7 earlier lines dropped]"
+    assert parser.msg_output.endswith("w8\nw9\n")
+    assert parser.msg_output_chars <= 20
+    assert parser.msg_output.startswith("[")
@@ -0,0 +1,258 @@
+"""compress task output
+
+Revision ID: 0d1b655f5a3e
+Revises: ff4c00b3de89
+Create Date: 2026-10-18 15:02:11.804932
+
+"""
+
+import zlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0d1b655f5a3e"
+down_revision = "ff4c00b3de89"
+branch_labels = None
+depends_on = None
+
+# same values as thymis_controller.database.compression at the time of writing
+OUTPUT_BLOCK_SIZE = 64 * 1024
+COMPRESS_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+
+NIX_LOG_COLUMNS = (
+    "nix_error_logs",
+    "nix_warning_logs",
+    "nix_notice_logs",
+    "nix_info_logs",
+)
+
+
+def compress_block(data):
+    if len(data) < COMPRESS_MIN_SIZE:
+        return None, data
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    if len(compressed) >= len(data):
+        return None, data
+    return "zlib", compressed
+
+
+def as_bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+def compact_stream(connection, task_id, process_index, stream):
+    # rewrites legacy output and all chunks of a stream as compressed blocks,
+    # holding at most one block in memory
+    key = {"task_id": task_id, "process_index": process_index, "stream": stream}
+    chunk_where = (
+        "task_id = :task_id AND process_index = :process_index AND stream = :stream"
+    )
+    chunks = connection.execute(
+        sa.text(
+            f"SELECT seq FROM task_output_chunks WHERE {chunk_where} ORDER BY offset"
+        ),
+        key,
+    ).all()
+    next_seq = max((row.seq for row in chunks), default=-1) + 1
+    legacy_length = (
+        connection.execute(
+            sa.text(
+                f"SELECT length(process_{stream}) FROM task_processes "
+                "WHERE task_id = :task_id AND process_index = :process_index"
+            ),
+            key,
+        ).scalar()
+        or 0
+    )
+
+    def pieces():
+        for start in range(0, legacy_length, OUTPUT_BLOCK_SIZE):
+            yield as_bytes(
+                connection.execute(
+                    sa.text(
+                        f"SELECT substr(process_{stream}, :start, :size) "
+                        "FROM task_processes WHERE task_id = :task_id "
+                        "AND process_index = :process_index"
+                    ),
+                    {**key, "start": start + 1, "size": OUTPUT_BLOCK_SIZE},
+                ).scalar()
+            )
+        for chunk in chunks:
+            yield as_bytes(
+                connection.execute(
+                    sa.text(
+                        f"SELECT data FROM task_output_chunks WHERE {chunk_where} "
+                        "AND seq = :seq"
+                    ),
+                    {**key, "seq": chunk.seq},
+                ).scalar()
+            )
+
+    def write_block(offset, block):
+        compression, stored = compress_block(block)
+        connection.execute(
+            sa.text(
+                "INSERT INTO task_output_chunks (task_id, process_index, stream, "
+                "seq, offset, length, compression, data) VALUES (:task_id, "
+                ":process_index, :stream, :seq, :offset, :length, :compression, :data)"
+            ),
+            {
+                **key,
+                "seq": next_seq + blocks,
+                "offset": offset,
+                "length": len(block),
+                "compression": compression,
+                "data": stored,
+            },
+        )
+
+    buffer = bytearray()
+    offset = 0
+    blocks = 0
+    for piece in pieces():
+        buffer += piece
+        while len(buffer) >= OUTPUT_BLOCK_SIZE:
+            write_block(offset, bytes(buffer[:OUTPUT_BLOCK_SIZE]))
+            del buffer[:OUTPUT_BLOCK_SIZE]
+            offset += OUTPUT_BLOCK_SIZE
+            blocks += 1
+    if buffer:
+        write_block(offset, bytes(buffer))
+    connection.execute(
+        sa.text(f"DELETE FROM task_output_chunks WHERE {chunk_where} AND seq < :seq"),
+        {**key, "seq": next_seq},
+    )
+
+
+def upgrade():
+    with op.batch_alter_table("task_output_chunks") as batch_op:
+        batch_op.add_column(sa.Column("length", sa.BigInteger(), nullable=True))
+        batch_op.add_column(
+            sa.Column("compression", sa.String(length=8), nullable=True)
+        )
+    op.execute("UPDATE task_output_chunks SET length = length(data)")
+    with op.batch_alter_table("task_output_chunks") as batch_op:
+        batch_op.alter_column("length", existing_type=sa.BigInteger(), nullable=False)
+        batch_op.create_index(
+            "ix_task_output_chunks_offset",
+            ["task_id", "process_index", "stream", "offset"],
+        )
+
+    connection = op.get_bind()
+    streams = connection.execute(
+        sa.text(
+            "SELECT task_id, process_index, 'stdout' AS stream FROM task_processes "
+            "WHERE process_stdout IS NOT NULL "
+            "UNION SELECT task_id, process_index, 'stderr' FROM task_processes "
+            "WHERE process_stderr IS NOT NULL "
+            "UNION SELECT DISTINCT task_id, process_index, stream "
+            "FROM task_output_chunks"
+        )
+    ).all()
+    for task_id, process_index, stream in streams:
+        compact_stream(connection, task_id, process_index, stream)
+    op.execute("UPDATE task_processes SET process_stdout = NULL, process_stderr = NULL")
+
+    with op.batch_alter_table("task_processes") as batch_op:
+        for column in NIX_LOG_COLUMNS:
+            batch_op.alter_column(
+                column, existing_type=sa.JSON(), type_=sa.LargeBinary()
+            )
+    for column in NIX_LOG_COLUMNS:
+        rows = connection.execute(
+            sa.text(
+                f"SELECT task_id, process_index, {column} AS value "
+                f"FROM task_processes WHERE {column} IS NOT NULL"
+            )
+        ).all()
+        for row in rows:
+            connection.execute(
+                sa.text(
+                    f"UPDATE task_processes SET {column} = :value "
+                    "WHERE task_id = :task_id AND process_index = :process_index"
+                ),
+                {
+                    "task_id": row.task_id,
+                    "process_index": row.process_index,
+                    "value": zlib.compress(as_bytes(row.value), COMPRESSION_LEVEL),
+                },
+            )
+
+
+def downgrade():
+    connection = op.get_bind()
+    for column in NIX_LOG_COLUMNS:
+        rows = connection.execute(
+            sa.text(
+                f"SELECT task_id, process_index, {column} AS value "
+                f"FROM task_processes WHERE {column} IS NOT NULL"
+            )
+        ).all()
+        for row in rows:
+            value = as_bytes(row.value)
+            if value[:1] == b"\x78":
+                value = zlib.decompress(value)
+            connection.execute(
+                sa.text(
+                    f"UPDATE task_processes SET {column} = :value "
+                    "WHERE task_id = :task_id AND process_index = :process_index"
+                ),
+                {
+                    "task_id": row.task_id,
+                    "process_index": row.process_index,
+                    "value": value.decode(),
+                },
+            )
+    with op.batch_alter_table("task_processes") as batch_op:
+        for column in NIX_LOG_COLUMNS:
+            batch_op.alter_column(
+                column, existing_type=sa.LargeBinary(), type_=sa.JSON()
+            )
+
+    # decompress the chunks and number them in stream order again, the
+    # previous revision folds them back into the process columns by seq
+    chunks = connection.execute(
+        sa.text(
+            "SELECT task_id, process_index, stream, seq, compression "
+            "FROM task_output_chunks ORDER BY task_id, process_index, stream, offset"
+        )
+    ).all()
+    connection.execute(sa.text("UPDATE task_output_chunks SET seq = -seq - 1"))
+    position = {}
+    for chunk in chunks:
+        key = (chunk.task_id, chunk.process_index, chunk.stream)
+        position[key] = position.get(key, -1) + 1
+        params = {
+            "task_id": chunk.task_id,
+            "process_index": chunk.process_index,
+            "stream": chunk.stream,
+            "old_seq": -chunk.seq - 1,
+            "seq": position[key],
+        }
+        chunk_where = (
+            "task_id = :task_id AND process_index = :process_index "
+            "AND stream = :stream AND seq = :old_seq"
+        )
+        if chunk.compression == "zlib":
+            data = connection.execute(
+                sa.text(f"SELECT data FROM task_output_chunks WHERE {chunk_where}"),
+                params,
+            ).scalar()
+            connection.execute(
+                sa.text(
+                    f"UPDATE task_output_chunks SET data = :data WHERE {chunk_where}"
+                ),
+                {**params, "data": zlib.decompress(data)},
+            )
+        connection.execute(
+            sa.text(f"UPDATE task_output_chunks SET seq = :seq WHERE {chunk_where}"),
+            params,
+        )
+
+    with op.batch_alter_table("task_output_chunks") as batch_op:
+        batch_op.drop_index("ix_task_output_chunks_offset")
+        batch_op.drop_column("compression")
+        batch_op.drop_column("length")
@@ -0,0 +1,28 @@
+"""add closure transfer stats
+
+Revision ID: 3f7a0d9c5e12
+Revises: 8c2e6b1f9a47
+Create Date: 2026-10-18 22:40:03.114875
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f7a0d9c5e12"
+down_revision = "8c2e6b1f9a47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.add_column(
+            sa.Column("closure_transfer_stats", sa.JSON(), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_column("closure_transfer_stats")
@@ -0,0 +1,32 @@
+"""add task output archive
+
+Revision ID: 6a3f9e1c27d4
+Revises: 0d1b655f5a3e
+Create Date: 2026-10-18 16:40:27.114803
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "6a3f9e1c27d4"
+down_revision = "0d1b655f5a3e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.add_column(
+            sa.Column("output_archived_time", sa.DateTime(), nullable=True)
+        )
+        batch_op.add_column(
+            sa.Column("output_restored_time", sa.DateTime(), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_column("output_restored_time")
+        batch_op.drop_column("output_archived_time")
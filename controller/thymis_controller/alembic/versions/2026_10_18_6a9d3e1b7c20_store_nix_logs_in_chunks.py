@@ -0,0 +1,155 @@
+"""store nix logs in chunks
+
+Revision ID: 6a9d3e1b7c20
+Revises: 3f7a0d9c5e12
+Create Date: 2026-10-18 23:18:52.640317
+
+"""
+
+import json
+import zlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "6a9d3e1b7c20"
+down_revision = "3f7a0d9c5e12"
+branch_labels = None
+depends_on = None
+
+# same value as thymis_controller.database.compression at the time of writing
+COMPRESSION_LEVEL = 6
+
+# nix_errors was a plain JSON column, the logs were compressed
+NIX_LOG_COLUMNS = {
+    "nix_errors": sa.JSON(),
+    "nix_error_logs": sa.LargeBinary(),
+    "nix_warning_logs": sa.LargeBinary(),
+    "nix_notice_logs": sa.LargeBinary(),
+    "nix_info_logs": sa.LargeBinary(),
+}
+
+
+def as_bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+def load_entries(value):
+    value = as_bytes(value)
+    if value[:1] == b"\x78":
+        value = zlib.decompress(value)
+    return json.loads(value)
+
+
+def upgrade():
+    op.create_table(
+        "task_nix_log_chunks",
+        sa.Column("task_id", sa.Uuid(), nullable=False),
+        sa.Column("process_index", sa.Integer(), nullable=False),
+        sa.Column("stream", sa.String(length=16), nullable=False),
+        sa.Column("seq", sa.Integer(), nullable=False),
+        sa.Column("offset", sa.Integer(), nullable=False),
+        sa.Column("length", sa.Integer(), nullable=False),
+        sa.Column("entries", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["task_id", "process_index"],
+            ["task_processes.task_id", "task_processes.process_index"],
+        ),
+        sa.PrimaryKeyConstraint("task_id", "process_index", "stream", "seq"),
+    )
+    op.create_index(
+        "ix_task_nix_log_chunks_offset",
+        "task_nix_log_chunks",
+        ["task_id", "process_index", "stream", "offset"],
+    )
+
+    # every stored list becomes the first chunk of its stream
+    connection = op.get_bind()
+    for column in NIX_LOG_COLUMNS:
+        rows = connection.execute(
+            sa.text(
+                f"SELECT task_id, process_index, {column} AS value "
+                f"FROM task_processes WHERE {column} IS NOT NULL"
+            )
+        ).all()
+        for row in rows:
+            entries = load_entries(row.value)
+            if not entries:
+                continue
+            connection.execute(
+                sa.text(
+                    "INSERT INTO task_nix_log_chunks (task_id, process_index, "
+                    "stream, seq, offset, length, entries) VALUES (:task_id, "
+                    ":process_index, :stream, 0, 0, :length, :entries)"
+                ),
+                {
+                    "task_id": row.task_id,
+                    "process_index": row.process_index,
+                    "stream": column,
+                    "length": len(entries),
+                    "entries": zlib.compress(
+                        json.dumps(entries).encode(), COMPRESSION_LEVEL
+                    ),
+                },
+            )
+
+    with op.batch_alter_table("task_processes") as batch_op:
+        for column in NIX_LOG_COLUMNS:
+            batch_op.drop_column(column)
+
+
+def downgrade():
+    with op.batch_alter_table("task_processes") as batch_op:
+        for column, column_type in NIX_LOG_COLUMNS.items():
+            batch_op.add_column(sa.Column(column, column_type, nullable=True))
+
+    # one chunk is held in memory at a time, each list is written once
+    connection = op.get_bind()
+    streams = connection.execute(
+        sa.text(
+            "SELECT DISTINCT task_id, process_index, stream FROM task_nix_log_chunks"
+        )
+    ).all()
+    for stream in streams:
+        key = {
+            "task_id": stream.task_id,
+            "process_index": stream.process_index,
+            "stream": stream.stream,
+        }
+        chunks = connection.execute(
+            sa.text(
+                "SELECT seq FROM task_nix_log_chunks WHERE task_id = :task_id "
+                "AND process_index = :process_index AND stream = :stream "
+                "ORDER BY offset"
+            ),
+            key,
+        ).all()
+        entries = []
+        for chunk in chunks:
+            entries.extend(
+                load_entries(
+                    connection.execute(
+                        sa.text(
+                            "SELECT entries FROM task_nix_log_chunks "
+                            "WHERE task_id = :task_id "
+                            "AND process_index = :process_index "
+                            "AND stream = :stream AND seq = :seq"
+                        ),
+                        {**key, "seq": chunk.seq},
+                    ).scalar()
+                )
+            )
+        value = json.dumps(entries)
+        if stream.stream != "nix_errors":
+            value = zlib.compress(value.encode(), COMPRESSION_LEVEL)
+        connection.execute(
+            sa.text(
+                f"UPDATE task_processes SET {stream.stream} = :value "
+                "WHERE task_id = :task_id AND process_index = :process_index"
+            ),
+            {**key, "value": value},
+        )
+
+    op.drop_index("ix_task_nix_log_chunks_offset", table_name="task_nix_log_chunks")
+    op.drop_table("task_nix_log_chunks")
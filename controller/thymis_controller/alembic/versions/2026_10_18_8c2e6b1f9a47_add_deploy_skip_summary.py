@@ -0,0 +1,30 @@
+"""add deploy skip summary
+
+Revision ID: 8c2e6b1f9a47
+Revises: d5e81c3f40b9
+Create Date: 2026-10-18 21:12:40.518203
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c2e6b1f9a47"
+down_revision = "d5e81c3f40b9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.add_column(sa.Column("devices_skipped", sa.Integer(), nullable=True))
+        batch_op.add_column(
+            sa.Column("deploy_time_saved_seconds", sa.Float(), nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_column("deploy_time_saved_seconds")
+        batch_op.drop_column("devices_skipped")
@@ -0,0 +1,83 @@
+"""add task summaries
+
+Revision ID: b47e2d90c1a8
+Revises: 6a3f9e1c27d4
+Create Date: 2026-10-18 18:05:51.630214
+
+"""
+
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b47e2d90c1a8"
+down_revision = "6a3f9e1c27d4"
+branch_labels = None
+depends_on = None
+
+
+def error_headline(exception):
+    for line in (exception or "").splitlines():
+        if line.strip():
+            return line.strip()[:255]
+    return None
+
+
+def upgrade():
+    op.create_table(
+        "task_state_counters",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("state", sa.String(length=50), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("updated_time", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("day", "state"),
+    )
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.add_column(sa.Column("last_update_time", sa.DateTime(), nullable=True))
+        batch_op.add_column(
+            sa.Column("device_identifier", sa.String(length=255), nullable=True)
+        )
+        batch_op.add_column(
+            sa.Column("error_headline", sa.String(length=255), nullable=True)
+        )
+        batch_op.create_index(
+            "ix_tasks_state_submitted_time", ["state", "submitted_time"]
+        )
+
+    connection = op.get_bind()
+    connection.execute(
+        sa.text(
+            "INSERT INTO task_state_counters (day, state, count, updated_time) "
+            "SELECT date(submitted_time), state, count(*), :now FROM tasks "
+            "GROUP BY date(submitted_time), state"
+        ),
+        {"now": datetime.now(timezone.utc).replace(tzinfo=None)},
+    )
+    op.execute(
+        "UPDATE tasks SET "
+        "last_update_time = COALESCE(end_time, start_time, submitted_time), "
+        "device_identifier = COALESCE("
+        "json_extract(task_submission_data, '$.device.identifier'), "
+        "json_extract(task_submission_data, '$.configuration_id'), "
+        "CASE WHEN json_array_length(task_submission_data, '$.devices') = 1 "
+        "THEN json_extract(task_submission_data, '$.devices[0].identifier') END)"
+    )
+    rows = connection.execute(
+        sa.text("SELECT id, exception FROM tasks WHERE exception IS NOT NULL")
+    ).all()
+    for row in rows:
+        connection.execute(
+            sa.text("UPDATE tasks SET error_headline = :headline WHERE id = :id"),
+            {"id": row.id, "headline": error_headline(row.exception)},
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("tasks") as batch_op:
+        batch_op.drop_index("ix_tasks_state_submitted_time")
+        batch_op.drop_column("error_headline")
+        batch_op.drop_column("device_identifier")
+        batch_op.drop_column("last_update_time")
+    op.drop_table("task_state_counters")
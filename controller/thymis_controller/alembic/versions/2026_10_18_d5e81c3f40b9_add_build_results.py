@@ -0,0 +1,35 @@
+"""add build results
+
+Revision ID: d5e81c3f40b9
+Revises: b47e2d90c1a8
+Create Date: 2026-10-18 20:41:17.382910
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d5e81c3f40b9"
+down_revision = "b47e2d90c1a8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "build_results",
+        sa.Column("flake_rev", sa.String(length=64), nullable=False),
+        sa.Column("configuration_id", sa.String(length=255), nullable=False),
+        sa.Column("attribute", sa.String(length=255), nullable=False),
+        sa.Column("out_path", sa.String(), nullable=False),
+        sa.Column("builder_task_id", sa.Uuid(), nullable=True),
+        sa.Column("created_time", sa.DateTime(), nullable=False),
+        sa.Column("last_used_time", sa.DateTime(), nullable=False),
+        sa.Column("hits", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("flake_rev", "configuration_id", "attribute"),
+    )
+
+
+def downgrade():
+    op.drop_table("build_results")
@@ -0,0 +1,60 @@
+"""add task output chunks
+
+Revision ID: ff4c00b3de89
+Revises: e0c02eaf8190
+Create Date: 2026-10-18 09:12:41.518203
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "ff4c00b3de89"
+down_revision = "e0c02eaf8190"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "task_output_chunks",
+        sa.Column("task_id", sa.Uuid(), nullable=False),
+        sa.Column("process_index", sa.Integer(), nullable=False),
+        sa.Column("stream", sa.String(length=6), nullable=False),
+        sa.Column("seq", sa.Integer(), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["task_id", "process_index"],
+            ["task_processes.task_id", "task_processes.process_index"],
+        ),
+        sa.PrimaryKeyConstraint("task_id", "process_index", "stream", "seq"),
+    )
+
+
+def downgrade():
+    # fold the chunks back into the process blobs before dropping them
+    op.execute(
+        "UPDATE task_processes SET process_stdout = CAST(COALESCE(process_stdout, X'') || "
+        "(SELECT group_concat(data, '') FROM (SELECT data FROM task_output_chunks "
+        "WHERE task_output_chunks.task_id = task_processes.task_id "
+        "AND task_output_chunks.process_index = task_processes.process_index "
+        "AND stream = 'stdout' ORDER BY seq)) AS BLOB) "
+        "WHERE EXISTS (SELECT 1 FROM task_output_chunks "
+        "WHERE task_output_chunks.task_id = task_processes.task_id "
+        "AND task_output_chunks.process_index = task_processes.process_index "
+        "AND stream = 'stdout')"
+    )
+    op.execute(
+        "UPDATE task_processes SET process_stderr = CAST(COALESCE(process_stderr, X'') || "
+        "(SELECT group_concat(data, '') FROM (SELECT data FROM task_output_chunks "
+        "WHERE task_output_chunks.task_id = task_processes.task_id "
+        "AND task_output_chunks.process_index = task_processes.process_index "
+        "AND stream = 'stderr' ORDER BY seq)) AS BLOB) "
+        "WHERE EXISTS (SELECT 1 FROM task_output_chunks "
+        "WHERE task_output_chunks.task_id = task_processes.task_id "
+        "AND task_output_chunks.process_index = task_processes.process_index "
+        "AND stream = 'stderr')"
+    )
+    op.drop_table("task_output_chunks")
@@ -1,4 +1,5 @@
 import pathlib
+from typing import Literal
 
 from pydantic import ConfigDict
 from pydantic_settings import BaseSettings
@@ -30,6 +31,53 @@ class GlobalSettings(BaseSettings):
     METRICS_RETENTION_DAYS: int = 30
     METRICS_CLEANUP_INTERVAL_SECONDS: int = 60 * 60 * 24  # 24 hours
 
+    # worker updates are committed in batches collected for at most this long
+    TASK_UPDATE_COMMIT_LATENCY_MS: int = 100
+    # worker processes for builds, defaults to the number of CPUs
+    TASK_CPU_WORKERS: int | None = None
+    # worker processes for deploys and commands, which mostly wait on the network
+    TASK_IO_WORKERS: int = 16
+    # workers are replaced after this many tasks
+    TASK_WORKER_MAX_TASKS: int = 20
+    # tasks running nix builds at the same time, and separately deploys in
+    # their build stage. Deploys copying closures at the same time
+    TASK_MAX_CONCURRENT_BUILDS: int = 2
+    TASK_MAX_CONCURRENT_COPIES: int = 8
+    # VMs started from the UI running at the same time
+    TASK_MAX_CONCURRENT_VMS: int = 2
+    # workers of each pool kept free for interactive tasks such as ssh commands
+    TASK_INTERACTIVE_WORKERS: int = 1
+    # extra io workers for deploys waiting for a deploy stage or their rollout
+    # wave, a waiting deploy does not take one of the TASK_IO_WORKERS
+    TASK_DEPLOY_WAITING_WORKERS: int = 16
+    # deploys evaluating configurations and activating them at the same time,
+    # the eval limit defaults to the number of CPUs
+    TASK_DEPLOY_EVAL_CONCURRENCY: int | None = None
+    TASK_DEPLOY_ACTIVATE_CONCURRENCY: int = 16
+    # devices of a fleet deploy activating in each wave, counts or percentages
+    # of the fleet such as ["1", "5%", "25%"], the remaining devices form the
+    # last wave. A wave activates once the previous one reconnected healthy
+    DEPLOY_ROLLOUT_WAVES: list[str] = []
+    DEPLOY_ROLLOUT_HEALTH_TIMEOUT_SECONDS: int = 600
+    DEPLOY_ROLLOUT_POLL_INTERVAL_SECONDS: int = 10
+    # how deploys get the closure onto devices: push copies it over ssh,
+    # substitute lets the agent fetch it from the binary cache of the
+    # controller, delta asks the agent for the paths it lacks in one query and
+    # imports only those over ssh. substitute and delta need agents that
+    # support them
+    DEPLOY_CLOSURE_TRANSFER: Literal["push", "substitute", "delta"] = "push"
+    # xz preset of the NARs of the binary cache, and the disk space they may use
+    NIX_CACHE_COMPRESSION_LEVEL: int = 6
+    NIX_CACHE_MAX_BYTES: int = 20 * 1024**3
+    # output of finished tasks is removed from the database after this many
+    # days, task summaries are kept. None keeps output forever
+    TASK_OUTPUT_RETENTION_DAYS: int | None = 30
+    # write removed output to compressed files below PROJECT_PATH, from where
+    # it can be restored, instead of dropping it
+    TASK_OUTPUT_ARCHIVE: bool = True
+    # tasks whose output is removed per transaction
+    TASK_OUTPUT_ARCHIVE_BATCH_SIZE: int = 20
+
     model_config = ConfigDict(
         env_prefix="THYMIS_", env_file=".env", env_file_encoding="utf-8"
     )
@@ -1,6 +1,7 @@
 from . import (
     agent_connection,
     agent_token,
+    build_result,
     check_systemd_timer,
     controller_settings,
     deployment_info,
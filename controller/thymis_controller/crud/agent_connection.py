@@ -61,6 +61,18 @@ def get_all_connected(
     )
 
 
+def is_connected(db_session: Session, deployment_info_id: uuid.UUID) -> bool:
+    return (
+        db_session.query(db_models.AgentConnection)
+        .filter(
+            db_models.AgentConnection.deployment_info_id == deployment_info_id,
+            db_models.AgentConnection.disconnected_at.is_(None),
+        )
+        .first()
+        is not None
+    )
+
+
 def get_max_concurrent_connections(
     db_session: Session,
     range_from: datetime,
@@ -0,0 +1,87 @@
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from thymis_controller import db_models
+
+
+def _key_filter(flake_rev: str, configuration_id: str, attribute: str):
+    return (
+        db_models.BuildResult.flake_rev == flake_rev,
+        db_models.BuildResult.configuration_id == configuration_id,
+        db_models.BuildResult.attribute == attribute,
+    )
+
+
+def get(
+    db_session: Session, flake_rev: str, configuration_id: str, attribute: str
+) -> db_models.BuildResult | None:
+    return db_session.scalars(
+        select(db_models.BuildResult).where(
+            *_key_filter(flake_rev, configuration_id, attribute)
+        )
+    ).first()
+
+
+def record(
+    db_session: Session,
+    flake_rev: str,
+    configuration_id: str,
+    attribute: str,
+    out_path: str,
+    builder_task_id: uuid.UUID | None,
+):
+    now = datetime.now(timezone.utc)
+    statement = sqlite_insert(db_models.BuildResult).values(
+        flake_rev=flake_rev,
+        configuration_id=configuration_id,
+        attribute=attribute,
+        out_path=out_path,
+        builder_task_id=builder_task_id,
+        created_time=now,
+        last_used_time=now,
+        hits=0,
+    )
+    db_session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[
+                db_models.BuildResult.flake_rev,
+                db_models.BuildResult.configuration_id,
+                db_models.BuildResult.attribute,
+            ],
+            set_={
+                "out_path": statement.excluded.out_path,
+                "builder_task_id": statement.excluded.builder_task_id,
+                "created_time": statement.excluded.created_time,
+                "last_used_time": statement.excluded.last_used_time,
+                "hits": 0,
+            },
+        )
+    )
+
+
+def record_hit(db_session: Session, result: db_models.BuildResult):
+    result.hits += 1
+    result.last_used_time = datetime.now(timezone.utc)
+
+
+def delete_path(
+    db_session: Session,
+    flake_rev: str,
+    configuration_id: str,
+    attribute: str,
+    out_path: str,
+):
+    # only the given path, a newer build of the same key stays
+    db_session.execute(
+        delete(db_models.BuildResult).where(
+            *_key_filter(flake_rev, configuration_id, attribute),
+            db_models.BuildResult.out_path == out_path,
+        )
+    )
+
+
+def count(db_session: Session) -> int:
+    return db_session.scalar(select(func.count()).select_from(db_models.BuildResult))
@@ -1,13 +1,22 @@
 import os
 import uuid
-from datetime import datetime
+from datetime import datetime, time, timedelta, timezone
 from typing import Literal
 
-from sqlalchemy import select
-from sqlalchemy.orm import Session, load_only, selectinload
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
 from thymis_controller import db_models
+from thymis_controller.database.compression import (
+    COMPRESS_MIN_SIZE,
+    OUTPUT_BLOCK_SIZE,
+    compress_block,
+    decompress_block,
+)
 from thymis_controller.models.task import TaskShort, TaskState
 
+# entries per nix log chunk once a task is compacted
+NIX_LOG_CHUNK_ENTRIES = 1000
+
 
 def create(
     db_session: Session,
@@ -36,33 +45,66 @@ def create(
 
 
 def get_tasks_short(db_session: Session, limit: int = 100, offset: int = 0):
-    all_tasks = db_session.scalars(
-        select(db_models.Task)
-        .options(
-            load_only(
-                db_models.Task.id,
-                db_models.Task.task_type,
-                db_models.Task.state,
-                db_models.Task.submitted_time,
-                db_models.Task.start_time,
-                db_models.Task.end_time,
-                db_models.Task.exception,
-                db_models.Task.task_submission_data,
-            ),
-            selectinload(db_models.Task.processes).load_only(
-                db_models.TaskProcess.nix_status
-            ),
+    # column-only selects, no Task or TaskProcess objects are loaded
+    tasks = db_session.execute(
+        select(
+            db_models.Task.id,
+            db_models.Task.task_type,
+            db_models.Task.state,
+            db_models.Task.submitted_time,
+            db_models.Task.start_time,
+            db_models.Task.end_time,
+            db_models.Task.exception,
+            db_models.Task.task_submission_data,
+            db_models.Task.last_update_time,
+            db_models.Task.device_identifier,
+            db_models.Task.error_headline,
+            db_models.Task.devices_skipped,
+            db_models.Task.deploy_time_saved_seconds,
         )
         .order_by(db_models.Task.submitted_time.desc())
         .limit(limit)
         .offset(offset)
     ).all()
 
-    return [TaskShort.from_orm_task(task) for task in all_tasks]
+    # the status of the last process that reported one
+    nix_status = {}
+    for task_id, status in db_session.execute(
+        select(db_models.TaskProcess.task_id, db_models.TaskProcess.nix_status)
+        .where(
+            db_models.TaskProcess.task_id.in_([task.id for task in tasks]),
+            db_models.TaskProcess.nix_status.is_not(None),
+        )
+        .order_by(db_models.TaskProcess.process_index)
+    ):
+        if status:
+            nix_status[task_id] = status
+
+    return [
+        TaskShort.from_task_columns(task, nix_status.get(task.id)) for task in tasks
+    ]
 
 
 def get_task_count(db_session: Session):
-    return db_session.query(db_models.Task).count()
+    return db_session.scalar(
+        select(func.coalesce(func.sum(db_models.TaskStateCounter.count), 0))
+    )
+
+
+def get_task_state_counts(db_session: Session) -> dict[str, int]:
+    return {
+        state: count
+        for state, count in db_session.execute(
+            select(
+                db_models.TaskStateCounter.state,
+                func.sum(db_models.TaskStateCounter.count),
+            ).group_by(db_models.TaskStateCounter.state)
+        )
+    }
+
+
+def get_task_counters_updated_time(db_session: Session) -> datetime | None:
+    return db_session.scalar(select(func.max(db_models.TaskStateCounter.updated_time)))
 
 
 def get_task_by_id(db_session, task_id: uuid.UUID) -> db_models.Task:
@@ -72,6 +114,83 @@ def get_task_by_id(db_session, task_id: uuid.UUID) -> db_models.Task:
     return task
 
 
+def get_task_state(db_session: Session, task_id: uuid.UUID) -> TaskState | None:
+    return db_session.scalar(
+        select(db_models.Task.state).where(db_models.Task.id == task_id)
+    )
+
+
+def _count_tasks_submitted_between(
+    db_session: Session,
+    state: TaskState,
+    from_date: datetime | None,
+    to_date: datetime | None,
+    include_to_date: bool,
+) -> int:
+    query = (
+        select(func.count())
+        .select_from(db_models.Task)
+        .where(db_models.Task.state == state)
+    )
+    if from_date:
+        query = query.where(db_models.Task.submitted_time >= from_date)
+    if to_date:
+        query = query.where(
+            db_models.Task.submitted_time <= to_date
+            if include_to_date
+            else db_models.Task.submitted_time < to_date
+        )
+    return db_session.scalar(query)
+
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    # submitted times are stored as naive UTC
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def count_tasks_with_state(
+    db_session: Session,
+    state: TaskState,
+    from_date: datetime = None,
+    to_date: datetime = None,
+) -> int:
+    """
+    Whole days of the range are summed from the state counters, only the
+    partial days at its ends are counted from the tasks
+    """
+    from_date, to_date = _as_utc(from_date), _as_utc(to_date)
+    first_day = None
+    if from_date:
+        first_day = from_date.date()
+        if from_date != datetime.combine(first_day, time()):
+            first_day += timedelta(days=1)
+    end_day = to_date.date() if to_date else None
+    if first_day and end_day and first_day >= end_day:
+        return _count_tasks_submitted_between(
+            db_session, state, from_date, to_date, True
+        )
+
+    query = select(func.coalesce(func.sum(db_models.TaskStateCounter.count), 0)).where(
+        db_models.TaskStateCounter.state == state
+    )
+    if first_day:
+        query = query.where(db_models.TaskStateCounter.day >= first_day)
+    if end_day:
+        query = query.where(db_models.TaskStateCounter.day < end_day)
+    count = db_session.scalar(query)
+    if first_day and from_date < datetime.combine(first_day, time()):
+        count += _count_tasks_submitted_between(
+            db_session, state, from_date, datetime.combine(first_day, time()), False
+        )
+    if end_day:
+        count += _count_tasks_submitted_between(
+            db_session, state, datetime.combine(end_day, time()), to_date, True
+        )
+    return count
+
+
 def get_tasks_with_state(
     db_session: Session,
     state: Literal["pending", "running", "completed", "failed"],
@@ -86,6 +205,440 @@ def get_tasks_with_state(
     return query.all()
 
 
+def append_process_output(
+    db_session: Session,
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: Literal["stdout", "stderr"],
+    data: bytes,
+) -> db_models.TaskOutputChunk | None:
+    # appends new chunks instead of rewriting the whole output blob, returns
+    # the first of them, output larger than a block is split into blocks
+    if not data:
+        return None
+    last_seq, end = db_session.execute(
+        select(
+            func.max(db_models.TaskOutputChunk.seq),
+            func.max(
+                db_models.TaskOutputChunk.offset + db_models.TaskOutputChunk.length
+            ),
+        ).where(
+            db_models.TaskOutputChunk.task_id == task_id,
+            db_models.TaskOutputChunk.process_index == process_index,
+            db_models.TaskOutputChunk.stream == stream,
+        )
+    ).one()
+    if last_seq is None:
+        # output from before chunked storage occupies the start of the stream
+        legacy_length = db_session.scalar(
+            select(func.length(_legacy_output_column(stream))).where(
+                db_models.TaskProcess.task_id == task_id,
+                db_models.TaskProcess.process_index == process_index,
+            )
+        )
+        seq, offset = 0, legacy_length or 0
+    else:
+        seq, offset = last_seq + 1, end
+    # smaller appends stay raw while the task runs, compact_process_output
+    # merges and compresses them
+    compress = len(data) >= OUTPUT_BLOCK_SIZE
+    chunks = []
+    for start in range(0, len(data), OUTPUT_BLOCK_SIZE):
+        block = data[start : start + OUTPUT_BLOCK_SIZE]
+        compression, stored = compress_block(block) if compress else (None, block)
+        chunks.append(
+            db_models.TaskOutputChunk(
+                task_id=task_id,
+                process_index=process_index,
+                stream=stream,
+                seq=seq + len(chunks),
+                offset=offset + start,
+                length=len(block),
+                compression=compression,
+                data=stored,
+            )
+        )
+    db_session.add_all(chunks)
+    db_session.flush()
+    return chunks[0]
+
+
+def _legacy_output_column(stream: Literal["stdout", "stderr"]):
+    return (
+        db_models.TaskProcess.legacy_stdout
+        if stream == "stdout"
+        else db_models.TaskProcess.legacy_stderr
+    )
+
+
+def read_process_output(
+    db_session: Session,
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: Literal["stdout", "stderr"],
+    start: int = 0,
+    end: int | None = None,
+) -> bytes:
+    # reads bytes [start, end) of a stream, only the chunks overlapping the
+    # range are loaded and decompressed
+    if end is not None and end <= start:
+        return b""
+    legacy_column = _legacy_output_column(stream)
+    legacy_length = (
+        db_session.scalar(
+            select(func.length(legacy_column)).where(
+                db_models.TaskProcess.task_id == task_id,
+                db_models.TaskProcess.process_index == process_index,
+            )
+        )
+        or 0
+    )
+    parts = []
+    if start < legacy_length:
+        legacy_end = legacy_length if end is None else min(end, legacy_length)
+        parts.append(
+            db_session.scalar(
+                select(func.substr(legacy_column, start + 1, legacy_end - start)).where(
+                    db_models.TaskProcess.task_id == task_id,
+                    db_models.TaskProcess.process_index == process_index,
+                )
+            )
+        )
+    query = select(
+        db_models.TaskOutputChunk.offset,
+        db_models.TaskOutputChunk.compression,
+        db_models.TaskOutputChunk.data,
+    ).where(
+        db_models.TaskOutputChunk.task_id == task_id,
+        db_models.TaskOutputChunk.process_index == process_index,
+        db_models.TaskOutputChunk.stream == stream,
+        db_models.TaskOutputChunk.offset + db_models.TaskOutputChunk.length > start,
+    )
+    if end is not None:
+        query = query.where(db_models.TaskOutputChunk.offset < end)
+    for offset, compression, data in db_session.execute(
+        query.order_by(db_models.TaskOutputChunk.offset)
+    ):
+        data = decompress_block(compression, data)
+        chunk_start = max(start - offset, 0)
+        chunk_stop = len(data) if end is None else min(end - offset, len(data))
+        parts.append(data[chunk_start:chunk_stop])
+    return b"".join(parts)
+
+
+def process_output_length(
+    db_session: Session,
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: Literal["stdout", "stderr"],
+) -> int:
+    end = db_session.scalar(
+        select(
+            func.max(
+                db_models.TaskOutputChunk.offset + db_models.TaskOutputChunk.length
+            )
+        ).where(
+            db_models.TaskOutputChunk.task_id == task_id,
+            db_models.TaskOutputChunk.process_index == process_index,
+            db_models.TaskOutputChunk.stream == stream,
+        )
+    )
+    if end is not None:
+        return end
+    return (
+        db_session.scalar(
+            select(func.length(_legacy_output_column(stream))).where(
+                db_models.TaskProcess.task_id == task_id,
+                db_models.TaskProcess.process_index == process_index,
+            )
+        )
+        or 0
+    )
+
+
+def _nix_log_filter(task_id: uuid.UUID, process_index: int, stream: str):
+    return (
+        db_models.TaskNixLogChunk.task_id == task_id,
+        db_models.TaskNixLogChunk.process_index == process_index,
+        db_models.TaskNixLogChunk.stream == stream,
+    )
+
+
+def append_nix_log(
+    db_session: Session,
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: str,
+    entries: list,
+) -> int | None:
+    # appends a chunk instead of rewriting the whole list, returns the index
+    # of its first entry
+    if not entries:
+        return None
+    last_seq, end = db_session.execute(
+        select(
+            func.max(db_models.TaskNixLogChunk.seq),
+            func.max(
+                db_models.TaskNixLogChunk.offset + db_models.TaskNixLogChunk.length
+            ),
+        ).where(*_nix_log_filter(task_id, process_index, stream))
+    ).one()
+    chunk = db_models.TaskNixLogChunk(
+        task_id=task_id,
+        process_index=process_index,
+        stream=stream,
+        seq=0 if last_seq is None else last_seq + 1,
+        offset=end or 0,
+        length=len(entries),
+        entries=list(entries),
+    )
+    db_session.add(chunk)
+    db_session.flush()
+    return chunk.offset
+
+
+def read_nix_log(
+    db_session: Session,
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: str,
+    start: int = 0,
+    end: int | None = None,
+) -> list:
+    # reads entries [start, end) of a nix log list, only the chunks
+    # overlapping the range are loaded
+    if end is not None and end <= start:
+        return []
+    query = select(
+        db_models.TaskNixLogChunk.offset, db_models.TaskNixLogChunk.entries
+    ).where(
+        *_nix_log_filter(task_id, process_index, stream),
+        db_models.TaskNixLogChunk.offset + db_models.TaskNixLogChunk.length > start,
+    )
+    if end is not None:
+        query = query.where(db_models.TaskNixLogChunk.offset < end)
+    entries = []
+    for offset, chunk_entries in db_session.execute(
+        query.order_by(db_models.TaskNixLogChunk.offset)
+    ):
+        chunk_start = max(start - offset, 0)
+        chunk_stop = (
+            len(chunk_entries) if end is None else min(end - offset, len(chunk_entries))
+        )
+        entries.extend(chunk_entries[chunk_start:chunk_stop])
+    return entries
+
+
+def nix_log_length(
+    db_session: Session, task_id: uuid.UUID, process_index: int, stream: str
+) -> int:
+    return (
+        db_session.scalar(
+            select(
+                func.max(
+                    db_models.TaskNixLogChunk.offset + db_models.TaskNixLogChunk.length
+                )
+            ).where(*_nix_log_filter(task_id, process_index, stream))
+        )
+        or 0
+    )
+
+
+def compact_nix_logs(db_session: Session, task_id: uuid.UUID):
+    """
+    Merge the nix log chunks of a finished task into chunks of
+    NIX_LOG_CHUNK_ENTRIES. Each merged chunk is committed on its own.
+    """
+    streams = db_session.execute(
+        select(
+            db_models.TaskNixLogChunk.process_index,
+            db_models.TaskNixLogChunk.stream,
+            func.max(db_models.TaskNixLogChunk.seq),
+        )
+        .where(db_models.TaskNixLogChunk.task_id == task_id)
+        .group_by(
+            db_models.TaskNixLogChunk.process_index, db_models.TaskNixLogChunk.stream
+        )
+    ).all()
+    for process_index, stream, last_seq in streams:
+        chunk_filter = _nix_log_filter(task_id, process_index, stream)
+        chunks = db_session.execute(
+            select(db_models.TaskNixLogChunk.seq, db_models.TaskNixLogChunk.length)
+            .where(*chunk_filter)
+            .order_by(db_models.TaskNixLogChunk.offset)
+        ).all()
+        groups: list[list] = [[]]
+        size = 0
+        for chunk in chunks:
+            if groups[-1] and size + chunk.length > NIX_LOG_CHUNK_ENTRIES:
+                groups.append([])
+                size = 0
+            groups[-1].append(chunk)
+            size += chunk.length
+        for group in groups:
+            if len(group) < 2:
+                continue
+            seqs = [chunk.seq for chunk in group]
+            rows = db_session.execute(
+                select(
+                    db_models.TaskNixLogChunk.offset, db_models.TaskNixLogChunk.entries
+                )
+                .where(*chunk_filter, db_models.TaskNixLogChunk.seq.in_(seqs))
+                .order_by(db_models.TaskNixLogChunk.offset)
+            ).all()
+            entries = [entry for row in rows for entry in row.entries]
+            last_seq += 1
+            db_session.execute(
+                delete(db_models.TaskNixLogChunk).where(
+                    *chunk_filter, db_models.TaskNixLogChunk.seq.in_(seqs)
+                )
+            )
+            db_session.add(
+                db_models.TaskNixLogChunk(
+                    task_id=task_id,
+                    process_index=process_index,
+                    stream=stream,
+                    seq=last_seq,
+                    offset=rows[0].offset,
+                    length=len(entries),
+                    entries=entries,
+                )
+            )
+            db_session.commit()
+
+
+def compact_process_output(db_session: Session, task_id: uuid.UUID):
+    """
+    Merge the small chunks a task appended while it ran into compressed
+    blocks of up to OUTPUT_BLOCK_SIZE bytes. Runs once the task finished,
+    a single block is held in memory at a time and each block is committed on
+    its own, so other writers wait for one block at most.
+    """
+    streams = db_session.execute(
+        select(
+            db_models.TaskOutputChunk.process_index,
+            db_models.TaskOutputChunk.stream,
+            func.max(db_models.TaskOutputChunk.seq),
+        )
+        .where(db_models.TaskOutputChunk.task_id == task_id)
+        .group_by(
+            db_models.TaskOutputChunk.process_index, db_models.TaskOutputChunk.stream
+        )
+    ).all()
+    for process_index, stream, last_seq in streams:
+        chunk_filter = (
+            db_models.TaskOutputChunk.task_id == task_id,
+            db_models.TaskOutputChunk.process_index == process_index,
+            db_models.TaskOutputChunk.stream == stream,
+        )
+        chunks = db_session.execute(
+            select(
+                db_models.TaskOutputChunk.seq,
+                db_models.TaskOutputChunk.length,
+                db_models.TaskOutputChunk.compression,
+            )
+            .where(*chunk_filter)
+            .order_by(db_models.TaskOutputChunk.offset)
+        ).all()
+        groups: list[list] = []
+        size = 0
+        for chunk in chunks:
+            if chunk.length >= OUTPUT_BLOCK_SIZE or (
+                groups and size + chunk.length > OUTPUT_BLOCK_SIZE
+            ):
+                groups.append([])
+                size = 0
+            if not groups:
+                groups.append([])
+            groups[-1].append(chunk)
+            size += chunk.length
+        for group in groups:
+            if len(group) == 1 and (
+                group[0].compression is not None or group[0].length < COMPRESS_MIN_SIZE
+            ):
+                continue
+            seqs = [chunk.seq for chunk in group]
+            rows = db_session.execute(
+                select(
+                    db_models.TaskOutputChunk.offset,
+                    db_models.TaskOutputChunk.compression,
+                    db_models.TaskOutputChunk.data,
+                )
+                .where(*chunk_filter, db_models.TaskOutputChunk.seq.in_(seqs))
+                .order_by(db_models.TaskOutputChunk.offset)
+            ).all()
+            block = b"".join(decompress_block(row[1], row[2]) for row in rows)
+            compression, stored = compress_block(block)
+            last_seq += 1
+            db_session.execute(
+                delete(db_models.TaskOutputChunk).where(
+                    *chunk_filter, db_models.TaskOutputChunk.seq.in_(seqs)
+                )
+            )
+            db_session.execute(
+                insert(db_models.TaskOutputChunk).values(
+                    task_id=task_id,
+                    process_index=process_index,
+                    stream=stream,
+                    seq=last_seq,
+                    offset=rows[0][0],
+                    length=len(block),
+                    compression=compression,
+                    data=stored,
+                )
+            )
+            db_session.commit()
+
+
+def get_tasks_with_expired_output(
+    db_session: Session, cutoff: datetime, limit: int
+) -> list[uuid.UUID]:
+    # finished tasks whose output is still stored, oldest first
+    return list(
+        db_session.scalars(
+            select(db_models.Task.id)
+            .where(
+                db_models.Task.state.in_(["completed", "failed"]),
+                db_models.Task.output_archived_time.is_(None),
+                func.coalesce(
+                    db_models.Task.output_restored_time, db_models.Task.end_time
+                )
+                < cutoff,
+            )
+            .order_by(db_models.Task.end_time)
+            .limit(limit)
+        )
+    )
+
+
+def clear_task_output(db_session: Session, task_id: uuid.UUID, archived_time: datetime):
+    """
+    Remove the output and nix logs of a task, the task and its processes
+    with their status and errors are kept
+    """
+    db_session.execute(
+        delete(db_models.TaskOutputChunk).where(
+            db_models.TaskOutputChunk.task_id == task_id
+        )
+    )
+    db_session.execute(
+        delete(db_models.TaskNixLogChunk).where(
+            db_models.TaskNixLogChunk.task_id == task_id,
+            db_models.TaskNixLogChunk.stream != "nix_errors",
+        )
+    )
+    db_session.execute(
+        update(db_models.TaskProcess)
+        .where(db_models.TaskProcess.task_id == task_id)
+        .values(legacy_stdout=None, legacy_stderr=None)
+    )
+    db_session.execute(
+        update(db_models.Task)
+        .where(db_models.Task.id == task_id)
+        .values(output_archived_time=archived_time, output_restored_time=None)
+    )
+
+
 def fail_running_tasks(db_session):
     # runs on startup, fails any tasks that were running when the controller was last shut down
     running_tasks = (
@@ -98,6 +651,50 @@ def fail_running_tasks(db_session):
     return len(running_tasks)
 
 
+def get_child_tasks(db_session: Session, parent_task_id: uuid.UUID):
+    return (
+        db_session.query(db_models.Task)
+        .filter(db_models.Task.parent_task_id == parent_task_id)
+        .all()
+    )
+
+
+# wave of a deploy task in the rollout of its parent, see task.rollout
+ROLLOUT_WAVE = func.coalesce(
+    db_models.Task.task_submission_data["rollout_wave"].as_integer(), 0
+)
+
+
+def child_wave_states(
+    db_session: Session, parent_task_id: uuid.UUID
+) -> list[tuple[int, str, int, datetime | None]]:
+    """Number of child tasks and their latest end time, by rollout wave and state"""
+    return db_session.execute(
+        select(
+            ROLLOUT_WAVE,
+            db_models.Task.state,
+            func.count(),
+            func.max(db_models.Task.end_time),
+        )
+        .where(db_models.Task.parent_task_id == parent_task_id)
+        .group_by(ROLLOUT_WAVE, db_models.Task.state)
+    ).all()
+
+
+def get_child_tasks_in_wave(
+    db_session: Session,
+    parent_task_id: uuid.UUID,
+    wave: int,
+    state: TaskState | None = None,
+) -> list[db_models.Task]:
+    query = select(db_models.Task).where(
+        db_models.Task.parent_task_id == parent_task_id, ROLLOUT_WAVE == wave
+    )
+    if state is not None:
+        query = query.where(db_models.Task.state == state)
+    return list(db_session.scalars(query))
+
+
 def child_task_states(db_session, tasks: list[uuid.UUID]) -> set[str]:
     tasks = db_session.query(db_models.Task).filter(db_models.Task.id.in_(tasks)).all()
     return set(task.state for task in tasks)
@@ -107,6 +704,7 @@ if "RUNNING_IN_PLAYWRIGHT" in os.environ:
 
     def delete_all_tasks(db_session: Session):
         db_session.query(db_models.Task).delete()
+        db_session.query(db_models.TaskStateCounter).delete()
         db_session.commit()
 
 
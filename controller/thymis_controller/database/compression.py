@@ -0,0 +1,60 @@
+import json
+import zlib
+from typing import Optional
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+# uncompressed size of a block of task output, range reads decompress only
+# the blocks they touch
+OUTPUT_BLOCK_SIZE = 64 * 1024
+# blocks smaller than this are stored raw, compressing them saves too little
+COMPRESS_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+ZLIB = "zlib"
+
+
+def compress_block(data: bytes) -> tuple[Optional[str], bytes]:
+    """Returns the compression used and the stored data"""
+    if len(data) < COMPRESS_MIN_SIZE:
+        return None, data
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    if len(compressed) >= len(data):
+        return None, data
+    return ZLIB, compressed
+
+
+def decompress_block(compression: Optional[str], data: bytes) -> bytes:
+    match compression:
+        case None:
+            return data
+        case "zlib":
+            return zlib.decompress(data)
+        case _:
+            raise ValueError(f"Unknown output compression: {compression}")
+
+
+class CompressedJSON(TypeDecorator):
+    """
+    JSON stored as a zlib compressed blob.
+
+    Values written before the column was compressed are still plain JSON
+    text, a zlib stream never starts like a JSON document.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(json.dumps(value).encode(), COMPRESSION_LEVEL)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return json.loads(value)
+        if value[:1] == b"\x78":
+            return json.loads(zlib.decompress(value))
+        return json.loads(value)
@@ -11,6 +11,7 @@ from sqlalchemy.orm import Session
 from thymis_controller import crud
 from thymis_controller.config import global_settings
 from thymis_controller.crud import images
+from thymis_controller.task.output_archive import archive_expired_task_output
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +79,7 @@ async def initialize_cleanup(db_engine: Engine):
         enable_auto_vacuum(session)
         await crud.logs.remove_expired_logs(session)
         _delete_expired_metrics(session)
+        await archive_expired_task_output(session)
         compact_database(session)
     # Also do initial image cleanup
     await images.periodic_image_cleanup()
@@ -91,5 +93,6 @@ async def periodic_cleanup_loop(db_engine: Engine):
         with Session(db_engine) as session:
             await crud.logs.remove_expired_logs(session)
             _delete_expired_metrics(session)
+            await archive_expired_task_output(session)
         # Clean up old images periodically
         await images.periodic_image_cleanup()
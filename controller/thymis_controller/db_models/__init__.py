@@ -1,10 +1,18 @@
 from .agent_connection import AgentConnection
 from .agent_token import AccessClientToken, AgentToken
+from .build_result import BuildResult
 from .controller_settings import ControllerSettings
 from .deployment_info import DeploymentInfo
 from .device_metric import DeviceMetric
 from .hardware_device import HardwareDevice
 from .logs import LogEntry
 from .secrets import *
-from .task import Task, TaskProcess
+from .task import (
+    NIX_LOG_STREAMS,
+    Task,
+    TaskNixLogChunk,
+    TaskOutputChunk,
+    TaskProcess,
+    TaskStateCounter,
+)
 from .web_session import WebSession
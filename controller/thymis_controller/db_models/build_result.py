@@ -0,0 +1,17 @@
+from sqlalchemy import Column, DateTime, Integer, String, Uuid
+from thymis_controller.database.base import Base
+
+
+class BuildResult(Base):
+    """Store path a configuration attribute built to at a flake revision"""
+
+    __tablename__ = "build_results"
+
+    flake_rev = Column(String(64), primary_key=True)
+    configuration_id = Column(String(255), primary_key=True)
+    attribute = Column(String(255), primary_key=True)
+    out_path = Column(String, nullable=False)
+    builder_task_id = Column(Uuid(as_uuid=True), nullable=True)
+    created_time = Column(DateTime, nullable=False)
+    last_used_time = Column(DateTime, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
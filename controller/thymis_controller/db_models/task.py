@@ -1,3 +1,6 @@
+import collections
+import datetime
+import uuid
 from typing import TYPE_CHECKING, List, Optional
 
 from sqlalchemy import (
@@ -5,20 +8,38 @@ from sqlalchemy import (
     UUID,
     BigInteger,
     Column,
+    Date,
     DateTime,
+    Float,
     ForeignKey,
+    ForeignKeyConstraint,
+    Index,
     Integer,
     LargeBinary,
     String,
     Text,
     Uuid,
+    event,
+    inspect,
+    select,
 )
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Mapped, Session, deferred, mapped_column, relationship
 from thymis_controller.database.base import Base
+from thymis_controller.database.compression import CompressedJSON, decompress_block
 
 if TYPE_CHECKING:
     from thymis_controller.db_models.agent_token import AccessClientToken
 
+# the error and log lists of a nix process, stored as TaskNixLogChunk rows
+NIX_LOG_STREAMS = (
+    "nix_errors",
+    "nix_error_logs",
+    "nix_warning_logs",
+    "nix_notice_logs",
+    "nix_info_logs",
+)
+
 
 class TaskProcess(Base):
     __tablename__ = "task_processes"
@@ -30,26 +51,149 @@ class TaskProcess(Base):
     process_program = Column(String(255), nullable=True)
     process_args = Column(JSON, nullable=True)
     process_env = Column(JSON, nullable=True)
-    process_stdout = Column(LargeBinary, nullable=True)
-    process_stderr = Column(LargeBinary, nullable=True)
+    # Output written before chunked storage existed, new output is appended
+    # to TaskOutputChunk rows instead of rewriting these blobs
+    legacy_stdout = deferred(
+        Column("process_stdout", LargeBinary, nullable=True), group="output"
+    )
+    legacy_stderr = deferred(
+        Column("process_stderr", LargeBinary, nullable=True), group="output"
+    )
 
     # Nix-Specific Extensions
     nix_status = Column(JSON, nullable=True)
-    nix_errors = Column(JSON, nullable=True)
     nix_files_linked = Column(Integer, nullable=True)
     nix_bytes_linked = Column(BigInteger, nullable=True)
     nix_corrupted_paths = Column(Integer, nullable=True)
     nix_untrusted_paths = Column(Integer, nullable=True)
-    nix_error_logs = Column(JSON, nullable=True)
-    nix_warning_logs = Column(JSON, nullable=True)
-    nix_notice_logs = Column(JSON, nullable=True)
-    nix_info_logs = Column(JSON, nullable=True)
 
     task = relationship("Task", back_populates="processes")
 
+    output_chunks: Mapped[List["TaskOutputChunk"]] = relationship(
+        "TaskOutputChunk",
+        order_by="[TaskOutputChunk.stream, TaskOutputChunk.offset]",
+        viewonly=True,
+    )
+    # only loaded when accessed, listing tasks or sending status updates does
+    # not need them
+    nix_log_chunks: Mapped[List["TaskNixLogChunk"]] = relationship(
+        "TaskNixLogChunk",
+        order_by="[TaskNixLogChunk.stream, TaskNixLogChunk.offset]",
+        viewonly=True,
+    )
+
+    def read_output(self, stream: str) -> Optional[bytes]:
+        legacy = self.legacy_stdout if stream == "stdout" else self.legacy_stderr
+        chunks = [
+            chunk.read() for chunk in self.output_chunks if chunk.stream == stream
+        ]
+        if legacy is None and not chunks:
+            return None
+        return (legacy or b"") + b"".join(chunks)
+
+    @property
+    def process_stdout(self) -> Optional[bytes]:
+        return self.read_output("stdout")
+
+    @property
+    def process_stderr(self) -> Optional[bytes]:
+        return self.read_output("stderr")
+
+    def read_nix_log(self, stream: str) -> Optional[list]:
+        chunks = [chunk for chunk in self.nix_log_chunks if chunk.stream == stream]
+        if not chunks:
+            return None
+        return [entry for chunk in chunks for entry in chunk.entries]
+
+    @property
+    def nix_errors(self) -> Optional[list]:
+        return self.read_nix_log("nix_errors")
+
+    @property
+    def nix_error_logs(self) -> Optional[list]:
+        return self.read_nix_log("nix_error_logs")
+
+    @property
+    def nix_warning_logs(self) -> Optional[list]:
+        return self.read_nix_log("nix_warning_logs")
+
+    @property
+    def nix_notice_logs(self) -> Optional[list]:
+        return self.read_nix_log("nix_notice_logs")
+
+    @property
+    def nix_info_logs(self) -> Optional[list]:
+        return self.read_nix_log("nix_info_logs")
+
+
+class TaskOutputChunk(Base):
+    __tablename__ = "task_output_chunks"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["task_id", "process_index"],
+            ["task_processes.task_id", "task_processes.process_index"],
+        ),
+        # block index, chunks are read in stream order and by range
+        Index(
+            "ix_task_output_chunks_offset",
+            "task_id",
+            "process_index",
+            "stream",
+            "offset",
+        ),
+    )
+
+    task_id = Column(Uuid(as_uuid=True), primary_key=True)
+    process_index = Column(Integer, primary_key=True)
+    stream = Column(String(6), primary_key=True)  # "stdout" or "stderr"
+    # unique within the stream, compaction replaces chunks with blocks
+    # numbered after them, so the stream order is given by offset
+    seq = Column(Integer, primary_key=True)
+    # byte offset of this chunk within the stream, legacy output included
+    offset = Column(BigInteger, nullable=False)
+    # uncompressed length of data
+    length = Column(BigInteger, nullable=False)
+    compression = Column(String(8), nullable=True)
+    data = Column(LargeBinary, nullable=False)
+
+    def read(self) -> bytes:
+        return decompress_block(self.compression, self.data)
+
+
+class TaskNixLogChunk(Base):
+    """Entries appended to one of the nix error and log lists of a process"""
+
+    __tablename__ = "task_nix_log_chunks"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["task_id", "process_index"],
+            ["task_processes.task_id", "task_processes.process_index"],
+        ),
+        Index(
+            "ix_task_nix_log_chunks_offset",
+            "task_id",
+            "process_index",
+            "stream",
+            "offset",
+        ),
+    )
+
+    task_id = Column(Uuid(as_uuid=True), primary_key=True)
+    process_index = Column(Integer, primary_key=True)
+    stream = Column(String(16), primary_key=True)  # one of NIX_LOG_STREAMS
+    seq = Column(Integer, primary_key=True)
+    # index of the first entry within the list, and the number of entries
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+    entries = Column(CompressedJSON, nullable=False)
+
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # counting a state within a time range that is not whole days
+        Index("ix_tasks_state_submitted_time", "state", "submitted_time"),
+    )
 
     id = Column(Uuid(as_uuid=True), primary_key=True, index=True)
     submitted_time = Column(DateTime, nullable=False)
@@ -67,6 +211,23 @@ class Task(Base):
     parent_task_id = Column(Uuid(as_uuid=True), ForeignKey("tasks.id"), nullable=True)
     children = Column(JSON, nullable=True)
 
+    # summary columns kept up to date by maintain_task_summaries
+    last_update_time = Column(DateTime, nullable=True)
+    device_identifier = Column(String(255), nullable=True)
+    error_headline = Column(String(255), nullable=True)
+
+    # output and nix logs were moved to an archive file, or dropped
+    output_archived_time = Column(DateTime, nullable=True)
+    # restored output is kept for the retention period again
+    output_restored_time = Column(DateTime, nullable=True)
+
+    # deploys skipped because the device already ran the configuration, for
+    # a fleet deploy the sum over its devices
+    devices_skipped = Column(Integer, nullable=True)
+    deploy_time_saved_seconds = Column(Float, nullable=True)
+    # what a deploy transferred and how long it took, see ClosureTransferStats
+    closure_transfer_stats = Column(JSON, nullable=True)
+
     access_client_tokens: Mapped[List["AccessClientToken"]] = relationship(
         back_populates="deploy_device_task"
     )
@@ -86,3 +247,113 @@ class Task(Base):
             if process.process_index == process_index:
                 return process
         return None
+
+
+class TaskStateCounter(Base):
+    """Number of tasks in a state, by the UTC day they were submitted on"""
+
+    __tablename__ = "task_state_counters"
+
+    day = Column(Date, primary_key=True)
+    state = Column(String(50), primary_key=True)
+    count = Column(Integer, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+
+def task_device_identifier(submission_data: Optional[dict]) -> Optional[str]:
+    """The device or configuration a task works on, if it is a single one"""
+    if not isinstance(submission_data, dict):
+        return None
+    if isinstance(submission_data.get("device"), dict):
+        return submission_data["device"].get("identifier")
+    if submission_data.get("configuration_id"):
+        return submission_data["configuration_id"]
+    devices = submission_data.get("devices")
+    if isinstance(devices, list) and len(devices) == 1:
+        return devices[0].get("identifier")
+    return None
+
+
+def error_headline(exception: Optional[str]) -> Optional[str]:
+    if not exception:
+        return None
+    for line in exception.splitlines():
+        if line.strip():
+            return line.strip()[:255]
+    return None
+
+
+def _utc_day(time: datetime.datetime) -> datetime.date:
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc)
+    return time.date()
+
+
+def _stored_states(session: Session, tasks: list[Task]) -> dict[uuid.UUID, str]:
+    # the attribute history lacks the old value if the task was expired
+    if not tasks:
+        return {}
+    return dict(
+        session.connection()
+        .execute(
+            select(Task.id, Task.state).where(Task.id.in_([task.id for task in tasks]))
+        )
+        .all()
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def maintain_task_summaries(session: Session, _flush_context, _instances):
+    """
+    Keep the summary columns of tasks and the state counters in step with
+    task state changes, in the same transaction as the change
+    """
+    new = [task for task in session.new if isinstance(task, Task)]
+    dirty = [
+        task
+        for task in session.dirty
+        if isinstance(task, Task) and session.is_modified(task)
+    ]
+    deleted = [task for task in session.deleted if isinstance(task, Task)]
+    if not (new or dirty or deleted):
+        return
+
+    deltas: collections.Counter[tuple[datetime.date, str]] = collections.Counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    state_changed = {
+        task for task in dirty if inspect(task).attrs.state.history.has_changes()
+    }
+    stored_states = _stored_states(session, [*state_changed, *deleted])
+    for task in new:
+        deltas[(_utc_day(task.submitted_time), task.state)] += 1
+        task.device_identifier = task_device_identifier(task.task_submission_data)
+        task.error_headline = error_headline(task.exception)
+        task.last_update_time = now
+    for task in dirty:
+        if task in state_changed:
+            deltas[(_utc_day(task.submitted_time), stored_states.get(task.id))] -= 1
+            deltas[(_utc_day(task.submitted_time), task.state)] += 1
+        if inspect(task).attrs.exception.history.has_changes():
+            task.error_headline = error_headline(task.exception)
+        task.last_update_time = now
+    for task in deleted:
+        deltas[(_utc_day(task.submitted_time), stored_states.get(task.id))] -= 1
+    if not any(deltas.values()):
+        return
+
+    connection = session.connection()
+    for (day, state), delta in deltas.items():
+        if delta == 0:
+            continue
+        statement = sqlite_insert(TaskStateCounter).values(
+            day=day, state=state, count=delta, updated_time=now
+        )
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[TaskStateCounter.day, TaskStateCounter.state],
+                set_={
+                    "count": TaskStateCounter.count + statement.excluded.count,
+                    "updated_time": statement.excluded.updated_time,
+                },
+            )
+        )
@@ -9,11 +9,16 @@ from pydantic import (
     JsonValue,
     ValidationError,
     field_serializer,
+    field_validator,
 )
 from thymis_agent import agent
 from thymis_controller.nix.log_parse import ParsedNixProcess
 
 type TaskState = Literal["pending", "running", "completed", "failed"]
+type DeployStage = Literal["eval", "build", "copy", "activate"]
+# push: nix copy over ssh, substitute: the agent fetches from the binary cache,
+# delta: the agent lists the paths it misses, which are imported over ssh
+type ClosureTransfer = Literal["push", "substitute", "delta"]
 
 if TYPE_CHECKING:
     import thymis_controller.db_models as db_models
@@ -49,24 +54,26 @@ class TaskProcess(BaseModel):
     nix_info_logs: Optional[JsonValue]
 
     @classmethod
-    def from_orm_task(cls, task_process: "db_models.TaskProcess") -> "TaskProcess":
+    def from_orm_task(
+        cls, task_process: "db_models.TaskProcess", include_output: bool = True
+    ) -> "TaskProcess":
         return cls(
             process_index=task_process.process_index,
             process_program=task_process.process_program,
             process_args=task_process.process_args,
             process_env=task_process.process_env,
-            process_stdout=task_process.process_stdout,
-            process_stderr=task_process.process_stderr,
+            process_stdout=task_process.process_stdout if include_output else None,
+            process_stderr=task_process.process_stderr if include_output else None,
             nix_status=task_process.nix_status,
             nix_errors=task_process.nix_errors,
             nix_files_linked=task_process.nix_files_linked,
             nix_bytes_linked=task_process.nix_bytes_linked,
             nix_corrupted_paths=task_process.nix_corrupted_paths,
             nix_untrusted_paths=task_process.nix_untrusted_paths,
-            nix_error_logs=task_process.nix_error_logs,
-            nix_warning_logs=task_process.nix_warning_logs,
-            nix_notice_logs=task_process.nix_notice_logs,
-            nix_info_logs=task_process.nix_info_logs,
+            nix_error_logs=task_process.nix_error_logs if include_output else None,
+            nix_warning_logs=task_process.nix_warning_logs if include_output else None,
+            nix_notice_logs=task_process.nix_notice_logs if include_output else None,
+            nix_info_logs=task_process.nix_info_logs if include_output else None,
         )
 
 
@@ -85,6 +92,13 @@ class Task(BaseModel):
 
     parent_task_id: Optional[uuid.UUID] = None
     children: Optional[list[uuid.UUID]] = None
+    # output was removed by the task retention, see /tasks/{id}/restore-output
+    output_archived: bool = False
+    # deploys of devices already running the configuration, and the copy and
+    # activation time that saved
+    devices_skipped: Optional[int] = None
+    deploy_time_saved_seconds: Optional[float] = None
+    closure_transfer_stats: Optional["ClosureTransferStats"] = None
 
     processes: list[TaskProcess] = []
 
@@ -100,7 +114,9 @@ class Task(BaseModel):
         return dt.isoformat().replace("+00:00", "Z")
 
     @classmethod
-    def from_orm_task(cls, task: "db_models.Task") -> "Task":
+    def from_orm_task(
+        cls, task: "db_models.Task", include_output: bool = True
+    ) -> "Task":
         try:
             # first check wether TaskSubmissionData is still parseable, if not, return None for task_submission_data
             submission_data = TaskSubmissionDataWrapper(
@@ -122,7 +138,13 @@ class Task(BaseModel):
             task_submission_data_raw=submission_data_raw,
             parent_task_id=task.parent_task_id,
             children=task.children,
-            processes=[TaskProcess.from_orm_task(tp) for tp in task.processes],
+            output_archived=task.output_archived_time is not None,
+            devices_skipped=task.devices_skipped,
+            deploy_time_saved_seconds=task.deploy_time_saved_seconds,
+            closure_transfer_stats=task.closure_transfer_stats,
+            processes=[
+                TaskProcess.from_orm_task(tp, include_output) for tp in task.processes
+            ],
         )
 
 
@@ -136,8 +158,13 @@ class TaskShort(BaseModel):
     exception: Optional[str]
     task_submission_data: Optional["TaskSubmissionData"]
     nix_status: Optional[NixProcessStatus]
+    last_update_time: Optional[datetime.datetime] = None
+    device_identifier: Optional[str] = None
+    error_headline: Optional[str] = None
+    devices_skipped: Optional[int] = None
+    deploy_time_saved_seconds: Optional[float] = None
 
-    @field_serializer("submitted_time", "start_time", "end_time")
+    @field_serializer("submitted_time", "start_time", "end_time", "last_update_time")
     def _ser_dt(self, dt: datetime.datetime | None) -> str | None:
         if dt is None:
             return None
@@ -150,6 +177,16 @@ class TaskShort(BaseModel):
 
     @classmethod
     def from_orm_task(cls, task: "db_models.Task") -> "TaskShort":
+        return cls.from_task_columns(
+            task,
+            next(
+                (p.nix_status for p in reversed(task.processes) if p.nix_status), None
+            ),
+        )
+
+    @classmethod
+    def from_task_columns(cls, task, nix_status: Optional[dict]) -> "TaskShort":
+        # task is a Task or a row with the same columns
         try:
             # first check wether TaskSubmissionData is still parseable, if not, return None for task_submission_data
             submission_data = TaskSubmissionDataWrapper(
@@ -166,12 +203,59 @@ class TaskShort(BaseModel):
             end_time=task.end_time,
             exception=task.exception,
             task_submission_data=submission_data,
-            nix_status=next(
-                (p.nix_status for p in reversed(task.processes) if p.nix_status), None
-            ),
+            nix_status=nix_status,
+            last_update_time=task.last_update_time,
+            device_identifier=task.device_identifier,
+            error_headline=task.error_headline,
+            devices_skipped=task.devices_skipped,
+            deploy_time_saved_seconds=task.deploy_time_saved_seconds,
         )
 
 
+class TaskQueueStats(BaseModel):
+    priority: str
+    queued: int
+    running: int
+    started: int
+    oldest_wait_seconds: float
+    mean_wait_seconds: float
+    max_wait_seconds: float
+
+
+class BuildCoordinatorStats(BaseModel):
+    in_flight: int
+    waiting: int
+    builds_started: int
+    # claims answered by a build another task ran
+    builds_shared: int
+    # claims answered by, or without, a result of an earlier build
+    cache_hits: int
+    cache_misses: int
+    # cached results the claiming task found no longer valid
+    cache_invalid: int
+    cache_entries: int = 0
+
+
+class DeployStageStats(BaseModel):
+    stage: str
+    limit: int
+    running: int
+    waiting: int
+    started: int
+    mean_wait_seconds: float
+    mean_run_seconds: float
+
+
+class WorkerPoolStats(BaseModel):
+    pool: str
+    workers: int
+    tasks_started: int
+    start_latency_median_seconds: Optional[float]
+    start_latency_max_seconds: Optional[float]
+    # peak RSS of the most recently reporting workers, by pid
+    worker_max_rss_bytes: dict[int, int]
+
+
 # sent from frontend to controller
 
 # none yet
@@ -212,6 +296,16 @@ class DeployDeviceInformation(BaseModel):
     secrets: list[agent.SecretForDevice] = []
 
 
+def parse_wave_size(spec: str) -> tuple[float, bool]:
+    """A number of devices, or a percentage of the fleet if it ends with %"""
+    spec = spec.strip()
+    percent = spec.endswith("%")
+    value = float(spec.removesuffix("%")) if percent else int(spec)
+    if value <= 0 or (percent and value > 100):
+        raise ValueError(f"Invalid rollout wave size: {spec}")
+    return value, percent
+
+
 class DeployDevicesTaskSubmission(BaseModel):
     type: Literal["deploy_devices_task"] = "deploy_devices_task"
     devices: list[DeployDeviceInformation]
@@ -221,6 +315,15 @@ class DeployDevicesTaskSubmission(BaseModel):
     controller_ssh_pubkey: str
     config_commit: str
     parent_task_id: Optional[uuid.UUID] = None
+    # sizes of the rollout waves, see DEPLOY_ROLLOUT_WAVES, which is used if None
+    rollout_waves: Optional[list[str]] = None
+
+    @field_validator("rollout_waves")
+    @classmethod
+    def validate_rollout_waves(cls, value: Optional[list[str]]):
+        for spec in value or []:
+            parse_wave_size(spec)
+        return value
 
 
 class DeployDeviceTaskSubmission(BaseModel):
@@ -234,6 +337,9 @@ class DeployDeviceTaskSubmission(BaseModel):
     access_client_token: str
     config_commit: str
     parent_task_id: Optional[uuid.UUID] = None
+    # activates after the earlier waves of the rollout, see RolloutGate
+    rollout_wave: Optional[int] = None
+    closure_transfer: ClosureTransfer = "push"
 
 
 class ProjectFlakeUpdateTaskSubmission(BaseModel):
@@ -309,11 +415,21 @@ TaskUpdate = Union[
     "AgentShouldSwitchToNewConfigurationUpdate",
     "WorkerRequestsSecretsUpdate",
     "AgentShouldReceiveNewSecretsUpdate",
+    "BuildClaimUpdate",
+    "BuildFinishedUpdate",
+    "DeployStageClaimUpdate",
+    "DeployStageFinishedUpdate",
+    "AgentShouldFetchClosureUpdate",
+    "DeployUpToDateCheckUpdate",
+    "AgentQueryStorePathsUpdate",
+    "ClosureTransferStatsUpdate",
 ]
 
 
 class TaskPickedUpdate(BaseModel):
     type: Literal["task_picked"] = "task_picked"
+    worker_pid: Optional[int] = None
+    worker_max_rss: Optional[int] = None
 
 
 class TaskRejectedUpdate(BaseModel):
@@ -331,7 +447,7 @@ class TaskStdOutErrUpdate(BaseModel):
 class TaskNixStatusUpdate(BaseModel):
     type: Literal["task_nix_status"] = "task_nix_status"
     process_index: int
-    status: ParsedNixProcess
+    status: ParsedNixProcess  # errors and logs added since the previous update
 
 
 class TaskCompletedUpdate(BaseModel):
@@ -392,6 +508,73 @@ class AgentShouldReceiveNewSecretsUpdate(BaseModel):
     target_recipient_ssh_pubkey: str
 
 
+class BuildClaimUpdate(BaseModel):
+    # the worker wants to build a configuration, see BuildCoordinator
+    type: Literal["build_claim"] = "build_claim"
+    flake_rev: str
+    configuration_id: str
+    attribute: str = "toplevel"
+    # a cached out path that is no longer valid, claim without it
+    invalid_out_path: Optional[str] = None
+
+
+class BuildFinishedUpdate(BaseModel):
+    type: Literal["build_finished"] = "build_finished"
+    out_path: Optional[str]  # None if the build failed
+
+
+class DeployStageClaimUpdate(BaseModel):
+    # the worker waits for DeployStageGranted, see DeployStageLimiter
+    type: Literal["deploy_stage_claim"] = "deploy_stage_claim"
+    stage: DeployStage
+
+
+class DeployStageFinishedUpdate(BaseModel):
+    type: Literal["deploy_stage_finished"] = "deploy_stage_finished"
+    stage: DeployStage
+
+
+class DeployUpToDateCheckUpdate(BaseModel):
+    # whether the device already runs the built toplevel
+    type: Literal["deploy_up_to_date_check"] = "deploy_up_to_date_check"
+    deployment_info_id: uuid.UUID
+    toplevel: str
+
+
+class AgentQueryStorePathsUpdate(BaseModel):
+    # answered with one AgentStorePathsResult per batch the paths are sent in
+    type: Literal["agent_query_store_paths"] = "agent_query_store_paths"
+    deployment_info_id: uuid.UUID
+    paths: list[str]
+    query_id: uuid.UUID = Field(default_factory=uuid.uuid4)
+
+
+class ClosureTransferStats(BaseModel):
+    mode: ClosureTransfer
+    paths: int
+    missing_paths: int
+    nar_bytes: int
+    query_seconds: float
+    transfer_seconds: float
+    # NAR bytes streamed so far, by interrupted attempts too
+    bytes_transferred: int = 0
+    attempts: int = 1
+    # missing paths an interrupted attempt imported, they are not sent again
+    resumed_paths: int = 0
+
+
+class ClosureTransferStatsUpdate(BaseModel):
+    type: Literal["closure_transfer_stats"] = "closure_transfer_stats"
+    stats: ClosureTransferStats
+
+
+class AgentShouldFetchClosureUpdate(BaseModel):
+    # the agent substitutes store_path from the binary cache of the controller
+    type: Literal["agent_should_fetch_closure"] = "agent_should_fetch_closure"
+    deployment_info_id: uuid.UUID
+    store_path: str
+
+
 # sent from controller to task runner
 class ControllerToRunnerTaskUpdate(BaseModel):
     inner: Union[
@@ -399,6 +582,11 @@ class ControllerToRunnerTaskUpdate(BaseModel):
         "AgentSwitchToNewConfigurationResult",
         "AgentGotNewSecretsResult",
         "SecretsResult",
+        "BuildClaimResult",
+        "DeployStageGranted",
+        "AgentFetchClosureResult",
+        "DeployUpToDateResult",
+        "AgentStorePathsResult",
     ] = Field(discriminator="kind")
 
 
@@ -426,11 +614,54 @@ class SecretsResult(BaseModel):
     secrets: dict[uuid.UUID, bytes]
 
 
+class BuildClaimResult(BaseModel):
+    kind: Literal["build_claim_result"] = "build_claim_result"
+    # build: run the build and report it with BuildFinishedUpdate
+    # wait: another task is building it, a second result follows
+    # built, failed: the build of builder_task_id finished
+    # cached: builder_task_id built it earlier, the path may be gone since
+    status: Literal["build", "wait", "built", "failed", "cached"]
+    builder_task_id: Optional[uuid.UUID] = None
+    out_path: Optional[str] = None
+
+
+class DeployStageGranted(BaseModel):
+    kind: Literal["deploy_stage_granted"] = "deploy_stage_granted"
+    stage: DeployStage
+
+
+class DeployUpToDateResult(BaseModel):
+    kind: Literal["deploy_up_to_date_result"] = "deploy_up_to_date_result"
+    up_to_date: bool
+
+
+class AgentStorePathsResult(BaseModel):
+    kind: Literal["agent_store_paths_result"] = "agent_store_paths_result"
+    # number of queried paths this result covers, and those the device lacks
+    checked: int
+    missing: list[str]
+    error: Optional[str] = None
+    query_id: Optional[uuid.UUID] = None
+
+
+class AgentFetchClosureResult(BaseModel):
+    kind: Literal["agent_fetch_closure_result"] = "agent_fetch_closure_result"
+    success: bool
+    stdout: str
+    stderr: str
+
+
 __all__ = [
     "TaskState",
+    "DeployStage",
+    "ClosureTransfer",
     "Task",
     "NixProcessStatus",
     "TaskShort",
+    "TaskQueueStats",
+    "WorkerPoolStats",
+    "BuildCoordinatorStats",
+    "DeployStageStats",
     "TaskSubmission",
     "TaskSubmissionData",
     "DeployDeviceInformation",
@@ -459,4 +690,18 @@ __all__ = [
     "AgentShouldReceiveNewSecretsUpdate",
     "AgentGotNewSecretsResult",
     "SecretsResult",
+    "BuildClaimUpdate",
+    "BuildFinishedUpdate",
+    "BuildClaimResult",
+    "DeployStageClaimUpdate",
+    "DeployStageFinishedUpdate",
+    "DeployStageGranted",
+    "AgentShouldFetchClosureUpdate",
+    "AgentFetchClosureResult",
+    "DeployUpToDateCheckUpdate",
+    "DeployUpToDateResult",
+    "AgentQueryStorePathsUpdate",
+    "AgentStorePathsResult",
+    "ClosureTransferStats",
+    "ClosureTransferStatsUpdate",
 ]
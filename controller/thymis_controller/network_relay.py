@@ -112,6 +112,12 @@ class NetworkRelay(nr.NetworkRelay):
                         config_commit=None,
                         task_id=inner.task_id,
                     )
+                # the agent may stay connected across switches, the hash of its
+                # start message is replaced for the up-to-date check of deploys.
+                # Agents that do not report it are never considered up to date
+                start_message = self.connection_id_to_start_message.get(connection_id)
+                if start_message is not None:
+                    start_message.build_hash = inner.build_hash
                 # update deployment_info
                 with sqlalchemy.orm.Session(self.db_engine) as db_session:
                     deployment_info = crud_deployment_info.get_by_ssh_public_key(
@@ -156,6 +162,31 @@ class NetworkRelay(nr.NetworkRelay):
                         )
                     ),
                 )
+            case agent.EtRStorePathsResultMessage():
+                inner = message.inner
+                self.task_controller.executor.send_message_to_task(
+                    inner.task_id,
+                    models_task.ControllerToRunnerTaskUpdate(
+                        inner=models_task.AgentStorePathsResult(
+                            checked=inner.checked,
+                            missing=inner.missing,
+                            error=inner.error,
+                            query_id=inner.query_id,
+                        )
+                    ),
+                )
+            case agent.EtRFetchClosureResultMessage():
+                inner = message.inner
+                self.task_controller.executor.send_message_to_task(
+                    inner.task_id,
+                    models_task.ControllerToRunnerTaskUpdate(
+                        inner=models_task.AgentFetchClosureResult(
+                            success=inner.success,
+                            stdout=inner.stdout,
+                            stderr=inner.stderr,
+                        )
+                    ),
+                )
             case agent.EtRMetricsMessage():
                 inner = message.inner
                 with sqlalchemy.orm.Session(self.db_engine) as db_session:
@@ -314,6 +345,12 @@ class NetworkRelay(nr.NetworkRelay):
         self.connection_id_to_start_message[connection_id] = start_message
         return connection_id
 
+    def running_build_hash(self, public_key: str) -> Optional[str]:
+        """Hash of the system the connected agent runs, None for older agents"""
+        connection_id = self.public_key_to_connection_id.get(public_key)
+        start_message = self.connection_id_to_start_message.get(connection_id)
+        return start_message.build_hash if start_message else None
+
     async def accept_ws_and_start_msg_loop_for_edge_agents(
         self,
         edge_agent_connection: WebSocket,
@@ -536,6 +573,11 @@ class NetworkRelay(nr.NetworkRelay):
                     ).model_dump_json()
                 )
 
+        # resume closure transfers that were interrupted by the disconnect
+        self.task_controller.executor.agent_connected(
+            self.connection_id_to_public_key[connection_id]
+        )
+
         async def msg_loop_but_close_connection_at_end():
             try:
                 await msg_loop
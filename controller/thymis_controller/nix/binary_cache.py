@@ -0,0 +1,248 @@
+import base64
+import binascii
+import dataclasses
+import json
+import logging
+import lzma
+import os
+import pathlib
+import subprocess
+import threading
+from typing import Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from thymis_controller.nix import NIX_CMD, nix_subprocess_env
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "/nix/store"
+KEY_NAME = "thymis-controller-1"
+NIX_CACHE_INFO = f"StoreDir: {STORE_DIR}\nWantMassQuery: 1\nPriority: 30\n"
+NAR_READ_SIZE = 1024 * 1024
+# alphabet of nix's base32, which leaves out e, o, u and t
+NIX32_ALPHABET = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def nix32_encode(data: bytes) -> str:
+    length = (len(data) * 8 - 1) // 5 + 1
+    chars = []
+    for n in range(length - 1, -1, -1):
+        bit = n * 5
+        i, j = divmod(bit, 8)
+        c = data[i] >> j
+        if i + 1 < len(data):
+            c |= data[i + 1] << (8 - j)
+        chars.append(NIX32_ALPHABET[c & 0x1F])
+    return "".join(chars)
+
+
+def nar_hash_nix32(nar_hash: str) -> str:
+    """sha256:<nix32> as narinfo files use it, from any format nix prints"""
+    if nar_hash.startswith("sha256-"):
+        digest = base64.b64decode(nar_hash.removeprefix("sha256-"))
+        return f"sha256:{nix32_encode(digest)}"
+    value = nar_hash.removeprefix("sha256:")
+    if len(value) == 64:
+        return f"sha256:{nix32_encode(binascii.unhexlify(value))}"
+    return f"sha256:{value}"
+
+
+def store_path_hash(path: str) -> str:
+    return pathlib.PurePosixPath(path).name.split("-", 1)[0]
+
+
+def full_store_path(path: str) -> str:
+    return path if path.startswith("/") else f"{STORE_DIR}/{path}"
+
+
+@dataclasses.dataclass
+class PathInfo:
+    path: str
+    nar_hash: str
+    nar_size: int
+    references: list[str]
+    deriver: Optional[str]
+
+    def fingerprint(self) -> str:
+        return ";".join(
+            [
+                "1",
+                self.path,
+                self.nar_hash,
+                str(self.nar_size),
+                ",".join(sorted(self.references)),
+            ]
+        )
+
+
+def parse_path_infos(output: str) -> list[PathInfo]:
+    # a list of objects before nix 2.19, an object keyed by path since
+    data = json.loads(output)
+    if isinstance(data, dict):
+        data = [
+            {"path": path, **(info or {"valid": False})} for path, info in data.items()
+        ]
+    return [
+        PathInfo(
+            path=info["path"],
+            nar_hash=nar_hash_nix32(info["narHash"]),
+            nar_size=info["narSize"],
+            references=[full_store_path(ref) for ref in info.get("references", [])],
+            deriver=full_store_path(info["deriver"]) if info.get("deriver") else None,
+        )
+        for info in data
+        if info.get("valid", True)
+    ]
+
+
+class NixSigningKey:
+    """An ed25519 key in the format of nix key generate-secret"""
+
+    def __init__(self, name: str, private_key: Ed25519PrivateKey):
+        self.name = name
+        self.private_key = private_key
+
+    @classmethod
+    def load_or_create(cls, path: pathlib.Path, name: str = KEY_NAME):
+        if path.exists():
+            name, _, encoded = path.read_text().strip().partition(":")
+            seed = base64.b64decode(encoded)[:32]
+            return cls(name, Ed25519PrivateKey.from_private_bytes(seed))
+        key = cls(name, Ed25519PrivateKey.generate())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        seed = key.private_key.private_bytes(
+            serialization.Encoding.Raw,
+            serialization.PrivateFormat.Raw,
+            serialization.NoEncryption(),
+        )
+        secret = base64.b64encode(seed + key._public_bytes()).decode()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as key_file:
+            key_file.write(f"{name}:{secret}")
+        logger.info("Created binary cache signing key %s", key.public_key)
+        return key
+
+    def _public_bytes(self) -> bytes:
+        return self.private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+
+    @property
+    def public_key(self) -> str:
+        return f"{self.name}:{base64.b64encode(self._public_bytes()).decode()}"
+
+    def sign(self, fingerprint: str) -> str:
+        signature = self.private_key.sign(fingerprint.encode())
+        return f"{self.name}:{base64.b64encode(signature).decode()}"
+
+
+class BinaryCache:
+    """
+    Serves the closures of deployed configurations as a signed nix binary cache.
+
+    Only paths of published closures are served. Their NARs are compressed
+    with xz once, on first request, and kept below the cache directory,
+    least recently used files beyond max_bytes are removed. Requests for
+    different paths are served in parallel, each NAR file supports range
+    requests.
+    """
+
+    def __init__(self, directory: pathlib.Path, compression_level: int, max_bytes: int):
+        self.directory = directory
+        self.compression_level = compression_level
+        self.max_bytes = max_bytes
+        self._key: Optional[NixSigningKey] = None
+        self._lock = threading.Lock()
+        self._paths: dict[str, PathInfo] = {}
+        self._nar_locks: dict[str, threading.Lock] = {}
+
+    @property
+    def signing_key(self) -> NixSigningKey:
+        with self._lock:
+            if self._key is None:
+                self._key = NixSigningKey.load_or_create(self.directory / "signing-key")
+            return self._key
+
+    def publish(self, store_path: str) -> int:
+        """Serve the closure of a store path, returns the number of its paths"""
+        result = subprocess.run(
+            [*NIX_CMD, "path-info", "--json", "--recursive", store_path],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=nix_subprocess_env(),
+        )
+        infos = parse_path_infos(result.stdout)
+        with self._lock:
+            for info in infos:
+                self._paths[store_path_hash(info.path)] = info
+        return len(infos)
+
+    def narinfo(self, path_hash: str) -> Optional[str]:
+        with self._lock:
+            info = self._paths.get(path_hash)
+        if info is None:
+            return None
+        lines = [
+            f"StorePath: {info.path}",
+            f"URL: nar/{path_hash}.nar.xz",
+            "Compression: xz",
+            f"NarHash: {info.nar_hash}",
+            f"NarSize: {info.nar_size}",
+            "References: "
+            + " ".join(pathlib.PurePosixPath(ref).name for ref in info.references),
+        ]
+        if info.deriver:
+            lines.append(f"Deriver: {pathlib.PurePosixPath(info.deriver).name}")
+        lines.append(f"Sig: {self.signing_key.sign(info.fingerprint())}")
+        return "\n".join(lines) + "\n"
+
+    def nar_file(self, path_hash: str) -> Optional[pathlib.Path]:
+        """The compressed NAR of a published path, written on first use"""
+        with self._lock:
+            info = self._paths.get(path_hash)
+            if info is None:
+                return None
+            nar_lock = self._nar_locks.setdefault(path_hash, threading.Lock())
+        path = self.directory / "nar" / f"{path_hash}.nar.xz"
+        with nar_lock:
+            if path.exists():
+                path.touch()
+                return path
+            self._write_nar(info.path, path)
+        self._evict(keep=path)
+        return path
+
+    def _write_nar(self, store_path: str, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_suffix(".tmp")
+        compressor = lzma.LZMACompressor(preset=self.compression_level)
+        with (
+            subprocess.Popen(
+                ["nix-store", "--dump", store_path],
+                stdout=subprocess.PIPE,
+                env=nix_subprocess_env(),
+            ) as dump,
+            open(temporary_path, "wb") as nar_file,
+        ):
+            while chunk := dump.stdout.read(NAR_READ_SIZE):
+                nar_file.write(compressor.compress(chunk))
+            nar_file.write(compressor.flush())
+        if dump.returncode != 0:
+            temporary_path.unlink(missing_ok=True)
+            raise RuntimeError(f"nix-store --dump {store_path} failed")
+        os.replace(temporary_path, path)
+
+    def _evict(self, keep: pathlib.Path):
+        files = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in (self.directory / "nar").glob("*.nar.xz")
+        ]
+        total = sum(size for _, size, _ in files)
+        for _, size, entry in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if entry != keep:
+                entry.unlink(missing_ok=True)
+                total -= size
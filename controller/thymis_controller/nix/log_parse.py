@@ -1,4 +1,6 @@
+import collections
 import dataclasses
+import itertools
 import json
 import logging
 import re
@@ -176,28 +178,110 @@ class ActivityInfo:
     last_line: Optional[str] = None
 
 
+# per level, older lines are dropped once a log holds this many
+MAX_LOG_LINES = 10000
+MAX_MSG_OUTPUT_CHARS = 4 * 1024 * 1024
+
+
+class BoundedLog:
+    """Keeps the last `max_lines` appended lines and counts the dropped ones"""
+
+    def __init__(self, max_lines: int = MAX_LOG_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    @property
+    def total(self) -> int:
+        return self.dropped + len(self.lines)
+
+    def since(self, total: int) -> list:
+        """Lines appended after the first `total` ones, as far as they are kept"""
+        return list(itertools.islice(self.lines, max(total - self.dropped, 0), None))
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index: int):
+        return self.lines[index]
+
+
+def dropped_lines_note(dropped: int) -> str:
+    return f"[{dropped} earlier lines dropped]"
+
+
 class NixParser:
-    def __init__(self):
+    def __init__(
+        self,
+        validate: bool = False,
+        max_log_lines: int = MAX_LOG_LINES,
+        max_msg_output_chars: int = MAX_MSG_OUTPUT_CHARS,
+    ):
+        # validate every line with the pydantic models, slower but strict
+        self.validate = validate
         self.activity_info_by_id: dict[int, ActivityInfo] = {}
         self.activities_done_expect_failed_by_type: dict[
             int, ActivitiesDoneExpectedFailed
         ] = {}
-        self.error_logs = []  # level 0
-        self.warnings = []  # level 1
-        self.notices = []  # level 2
-        self.infos = []  # level 3
-        self.other_messages = []  # level 4 and above
+        self.error_logs = BoundedLog(max_log_lines)  # level 0
+        self.warnings = BoundedLog(max_log_lines)  # level 1
+        self.notices = BoundedLog(max_log_lines)  # level 2
+        self.infos = BoundedLog(max_log_lines)  # level 3
+        self.other_messages = BoundedLog(max_log_lines)  # level 4 and above
 
-        self.errors = []
+        self.errors = BoundedLog(max_log_lines)
 
         self.files_linked = 0
         self.bytes_linked = 0
         self.corrupted_paths = 0
         self.untrusted_paths = 0
 
-        self.msg_output = ""
+        # joined on demand by the msg_output property
+        self.msg_output_chunks: collections.deque[str] = collections.deque()
+        self.msg_output_chars = 0
+        self.msg_output_dropped_chars = 0
+        self.max_msg_output_chars = max_msg_output_chars
+
+        # totals over all activities, kept up to date on every start, stop and
+        # result line instead of being recomputed for every status update
+        self.done = 0
+        self.expected = 0
+        self.running = 0
+        self.failed = 0
+
+        # amount of errors and log lines per level already sent as status update
+        self.sent_errors = 0
+        self.sent_logs_by_level = {0: 0, 1: 0, 2: 0, 3: 0}
+
+    @property
+    def msg_output(self) -> str:
+        output = "".join(self.msg_output_chunks)
+        if self.msg_output_dropped_chars:
+            return (
+                f"[{self.msg_output_dropped_chars} earlier characters dropped]\n"
+                + output
+            )
+        return output
 
-    def get_log_by_level(self, level):
+    def append_msg_output(self, text: str):
+        self.msg_output_chunks.append(text)
+        self.msg_output_chars += len(text)
+        while (
+            self.msg_output_chars > self.max_msg_output_chars
+            and len(self.msg_output_chunks) > 1
+        ):
+            dropped = self.msg_output_chunks.popleft()
+            self.msg_output_chars -= len(dropped)
+            self.msg_output_dropped_chars += len(dropped)
+
+    def get_log_by_level(self, level) -> BoundedLog:
         if level < 4:
             return {
                 0: self.error_logs,
@@ -218,7 +302,7 @@ class NixParser:
         return output
 
     def process_buffer(self, buffer: bytearray):
-        normal_stderr = bytearray()
+        normal_stderr: list[bytes] = []
         has_handled_nix_lines = False
         lines = buffer.splitlines(keepends=True)
         for i, line in enumerate(lines):
@@ -226,12 +310,12 @@ class NixParser:
                 # Check if line ends with newline, otherwise it's incomplete
                 if not line.endswith(b"\n"):
                     # Keep incomplete @nix line in buffer for next iteration
-                    normal_stderr += line
+                    normal_stderr.append(line)
                     continue
                 try:
-                    parsed = self.handle_line(line)
-                    if hasattr(parsed.nix_line, "msg") and parsed.nix_line.msg:
-                        self.msg_output += str(parsed.nix_line.msg) + "\n"
+                    msg = self.handle_line(line)
+                    if msg:
+                        self.append_msg_output(str(msg) + "\n")
                 except (json.JSONDecodeError, Exception) as e:
                     logger.warning(
                         "Failed to parse @nix line (len=%d): %s",
@@ -239,161 +323,197 @@ class NixParser:
                         e,
                     )
                     # Treat as normal stderr
-                    normal_stderr += line
-                    self.msg_output += line.decode("utf-8", errors="replace")
+                    normal_stderr.append(line)
+                    self.append_msg_output(line.decode("utf-8", errors="replace"))
                     continue
                 has_handled_nix_lines = True
             else:
-                normal_stderr += line
-                self.msg_output += line.decode("utf-8", errors="replace")
-        buffer[:] = normal_stderr
+                normal_stderr.append(line)
+                self.append_msg_output(line.decode("utf-8", errors="replace"))
+        buffer[:] = b"".join(normal_stderr)
         return has_handled_nix_lines
 
-    def handle_line(self, line):
-        # expect: line is "@nix {jsonjson}"
+    def handle_line(self, line: bytes) -> Optional[str]:
+        """Handle a "@nix {json}" line, returns the message of msg lines"""
         if not line.startswith(b"@nix "):
             raise ValueError(f"Unexpected line: {line}")
-        parsed = parse_nix_line(line)
-        # logger.info("Parsed lineA: %s", parsed)
-
-        if isinstance(parsed.nix_line, StartActivityNixLine):
-            self.activity_info_by_id[parsed.nix_line.id] = ActivityInfo(
-                parsed.nix_line.type
-            )
-            self.activities_done_expect_failed_by_type.setdefault(
-                parsed.nix_line.type, ActivitiesDoneExpectedFailed()
-            )
-            self.activities_done_expect_failed_by_type[
-                parsed.nix_line.type
-            ].activity_info_by_id[parsed.nix_line.id] = self.activity_info_by_id[
-                parsed.nix_line.id
-            ]
-            if parsed.nix_line.text:
-                if parsed.nix_line.level < 4:
-                    self.get_log_by_level(parsed.nix_line.level).append(
-                        f"{parsed.nix_line.text}..."
-                    )
+        if self.validate:
+            return self.handle_parsed_line(parse_nix_line(line))
+
+        # dispatch on the raw json, without a pydantic model per line
+        data = json.loads(line[len(b"@nix ") :])
+        match data["action"]:
+            case "start":
+                self.handle_start(data["id"], data["level"], data["type"], data["text"])
+            case "stop":
+                self.handle_stop(data["id"])
+            case "result":
+                self.handle_result(data["id"], data["type"], data.get("fields"))
+            case "msg":
+                msg = data["msg"]
+                if "\x1b" in msg:
+                    msg = ansi_escape.sub("", msg)
+                if "raw_msg" in data:
+                    data["msg"] = msg
+                    self.errors.append(ErrorInfoNixLine.model_validate(data))
                 else:
-                    self.other_messages.append(f"{parsed.nix_line.text}...")
-        elif isinstance(parsed.nix_line, StopActivityNixLine):
-            activity_info = self.activity_info_by_id[parsed.nix_line.id]
-            activity_by_type = self.activities_done_expect_failed_by_type[
-                activity_info.type
-            ]
-            activity_by_type.done += activity_info.done
-            activity_by_type.failed += activity_info.failed
-
-            for type_, count in activity_info.expected_by_type.items():
-                self.activities_done_expect_failed_by_type[type_].expected -= count
-
-            del activity_by_type.activity_info_by_id[parsed.nix_line.id]
-            del self.activity_info_by_id[parsed.nix_line.id]
-        elif isinstance(parsed.nix_line, ResultNixLine):
-            line_type = parsed.nix_line.type
-            if line_type == ResultType.FILE_LINKED:
-                self.files_linked += 1
-                self.bytes_linked += int(parsed.nix_line.fields[0])
-                logger.info("Linked %s bytes", parsed.nix_line.fields[0])
-                logger.info("Linked %s files", self.files_linked)
-            elif (
-                line_type == ResultType.BUILD_LOG_LINE
-                or line_type == ResultType.POST_BUILD_LOG_LINE
-            ):
-                last_line = str(parsed.nix_line.fields[0]).rstrip(" \n\r\t")
-                activity_info = self.activity_info_by_id[parsed.nix_line.id]
-                activity_info.last_line = last_line
-            elif line_type == ResultType.UNTRUSTED_PATH:
-                self.untrusted_paths += 1
-            elif line_type == ResultType.CORRUPTED_PATH:
-                self.corrupted_paths += 1
-            elif line_type == ResultType.SET_PHASE:
-                activity_info = self.activity_info_by_id[parsed.nix_line.id]
-                activity_info.phase = parsed.nix_line.fields[0]
-            elif line_type == ResultType.PROGRESS:
-                activity_info = self.activity_info_by_id[parsed.nix_line.id]
-                activity_info.done = parsed.nix_line.fields[0]
-                activity_info.expected = parsed.nix_line.fields[1]
-                activity_info.running = parsed.nix_line.fields[2]
-                activity_info.failed = parsed.nix_line.fields[3]
-            elif line_type == ResultType.SET_EXPECTED:
-                activity_info = self.activity_info_by_id[parsed.nix_line.id]
-                set_for_type = parsed.nix_line.fields[0]
-                self.activities_done_expect_failed_by_type.setdefault(
-                    set_for_type, ActivitiesDoneExpectedFailed()
-                )
-                self.activities_done_expect_failed_by_type[
-                    set_for_type
-                ].expected -= activity_info.expected_by_type.get(set_for_type, 0)
-                activity_info.expected_by_type[set_for_type] = int(
-                    parsed.nix_line.fields[1]
-                )
-                self.activities_done_expect_failed_by_type[
-                    set_for_type
-                ].expected += activity_info.expected_by_type[set_for_type]
-            elif line_type == ResultType.FETCH_STATUS:
-                last_line = str(parsed.nix_line.fields[0])
-                activity_info = self.activity_info_by_id[parsed.nix_line.id]
-                activity_info.last_line = last_line
-            else:
-                logger.info("Unhandled result: %s", parsed)
-        elif isinstance(parsed.nix_line, MessageNixLine):
-            if parsed.nix_line.level == 0:
-                self.error_logs.append(parsed.nix_line.msg)
-            elif parsed.nix_line.level == 1:
-                self.warnings.append(parsed.nix_line.msg)
-            elif parsed.nix_line.level == 2:
-                self.notices.append(parsed.nix_line.msg)
-            elif parsed.nix_line.level == 3:
-                self.infos.append(parsed.nix_line.msg)
-            elif parsed.nix_line.level >= 4:
-                self.other_messages.append(parsed.nix_line.msg)
-        elif isinstance(parsed.nix_line, ErrorInfoNixLine):
-            self.errors.append(parsed.nix_line)
+                    self.handle_message(data["level"], msg)
+                return msg
+            case action:
+                raise ValueError(f"Unexpected action: {action}")
+        return None
+
+    def handle_parsed_line(self, parsed: ParsedNixLineModel) -> Optional[str]:
+        nix_line = parsed.nix_line
+        if isinstance(nix_line, StartActivityNixLine):
+            self.handle_start(nix_line.id, nix_line.level, nix_line.type, nix_line.text)
+        elif isinstance(nix_line, StopActivityNixLine):
+            self.handle_stop(nix_line.id)
+        elif isinstance(nix_line, ResultNixLine):
+            self.handle_result(nix_line.id, nix_line.type, nix_line.fields)
+        elif isinstance(nix_line, MessageNixLine):
+            self.handle_message(nix_line.level, nix_line.msg)
+            return nix_line.msg
+        elif isinstance(nix_line, ErrorInfoNixLine):
+            self.errors.append(nix_line)
+            return nix_line.msg
         else:
             logger.info("Unhandled line: %s", parsed)
-
-        return parsed
+        return None
+
+    def handle_start(self, id: int, level: int, type_: int, text: str):
+        activity_info = ActivityInfo(type_)
+        self.activity_info_by_id[id] = activity_info
+        self.activities_done_expect_failed_by_type.setdefault(
+            type_, ActivitiesDoneExpectedFailed()
+        ).activity_info_by_id[id] = activity_info
+        if text:
+            if level < 4:
+                self.get_log_by_level(level).append(f"{text}...")
+            else:
+                self.other_messages.append(f"{text}...")
+
+    def handle_stop(self, id: int):
+        activity_info = self.activity_info_by_id[id]
+        activity_by_type = self.activities_done_expect_failed_by_type[
+            activity_info.type
+        ]
+        activity_by_type.done += activity_info.done
+        activity_by_type.failed += activity_info.failed
+        # done and failed move from the activity to its type, expected
+        # of a stopped activity is counted as its done
+        self.expected += activity_info.done - activity_info.expected
+        self.running -= activity_info.running
+
+        for type_, count in activity_info.expected_by_type.items():
+            self.activities_done_expect_failed_by_type[type_].expected -= count
+
+        del activity_by_type.activity_info_by_id[id]
+        del self.activity_info_by_id[id]
+
+    def handle_result(
+        self, id: int, line_type: int, fields: Optional[List[Union[int, str]]]
+    ):
+        if line_type == ResultType.FILE_LINKED:
+            self.files_linked += 1
+            self.bytes_linked += int(fields[0])
+            logger.info("Linked %s bytes", fields[0])
+            logger.info("Linked %s files", self.files_linked)
+        elif (
+            line_type == ResultType.BUILD_LOG_LINE
+            or line_type == ResultType.POST_BUILD_LOG_LINE
+        ):
+            last_line = str(fields[0]).rstrip(" \n\r\t")
+            activity_info = self.activity_info_by_id[id]
+            activity_info.last_line = last_line
+        elif line_type == ResultType.UNTRUSTED_PATH:
+            self.untrusted_paths += 1
+        elif line_type == ResultType.CORRUPTED_PATH:
+            self.corrupted_paths += 1
+        elif line_type == ResultType.SET_PHASE:
+            activity_info = self.activity_info_by_id[id]
+            activity_info.phase = fields[0]
+        elif line_type == ResultType.PROGRESS:
+            activity_info = self.activity_info_by_id[id]
+            done, expected, running, failed = fields[:4]
+            self.done += done - activity_info.done
+            self.expected += expected - activity_info.expected
+            self.running += running - activity_info.running
+            self.failed += failed - activity_info.failed
+            activity_info.done = done
+            activity_info.expected = expected
+            activity_info.running = running
+            activity_info.failed = failed
+        elif line_type == ResultType.SET_EXPECTED:
+            activity_info = self.activity_info_by_id[id]
+            set_for_type = fields[0]
+            activities_for_type = self.activities_done_expect_failed_by_type.setdefault(
+                set_for_type, ActivitiesDoneExpectedFailed()
+            )
+            activities_for_type.expected -= activity_info.expected_by_type.get(
+                set_for_type, 0
+            )
+            activity_info.expected_by_type[set_for_type] = int(fields[1])
+            activities_for_type.expected += activity_info.expected_by_type[set_for_type]
+        elif line_type == ResultType.FETCH_STATUS:
+            last_line = str(fields[0])
+            activity_info = self.activity_info_by_id[id]
+            activity_info.last_line = last_line
+        else:
+            logger.info("Unhandled result: %s %s %s", id, line_type, fields)
+
+    def handle_message(self, level: int, msg: str):
+        if level == 0:
+            self.error_logs.append(msg)
+        elif level == 1:
+            self.warnings.append(msg)
+        elif level == 2:
+            self.notices.append(msg)
+        elif level == 3:
+            self.infos.append(msg)
+        elif level >= 4:
+            self.other_messages.append(msg)
 
     def calc_activities_done_expected_failed(self):
-        global_done = 0
-        global_running = 0
-        global_expected = 0
-        global_failed = 0
-        for type_, activities in self.activities_done_expect_failed_by_type.items():
-            done = activities.done
-            excepted = activities.done
-            running = 0
-            failed = activities.failed
-            for activity in activities.activity_info_by_id.values():
-                done += activity.done
-                excepted += activity.expected
-                running += activity.running
-                failed += activity.failed
-            global_done += done
-            global_running += running
-            global_expected += excepted
-            global_failed += failed
-        return global_done, global_expected, global_running, global_failed
+        return self.done, self.expected, self.running, self.failed
 
-    def get_model(self) -> ParsedNixProcess:
-        (
-            global_done,
-            global_expected,
-            global_running,
-            global_failed,
-        ) = self.calc_activities_done_expected_failed()
+    def logs_with_dropped_note(self, log: BoundedLog, since: int = 0) -> list:
+        lines = log.since(since)
+        dropped = log.total - since - len(lines)
+        if dropped:
+            return [dropped_lines_note(dropped), *lines]
+        return lines
 
+    def get_model(self) -> ParsedNixProcess:
         return ParsedNixProcess(
-            done=global_done,
-            expected=global_expected,
-            running=global_running,
-            failed=global_failed,
-            errors=self.errors,
+            done=self.done,
+            expected=self.expected,
+            running=self.running,
+            failed=self.failed,
+            errors=list(self.errors),
             logs_by_level={
-                0: self.error_logs,
-                1: self.warnings,
-                2: self.notices,
-                3: self.infos,
+                0: self.logs_with_dropped_note(self.error_logs),
+                1: self.logs_with_dropped_note(self.warnings),
+                2: self.logs_with_dropped_note(self.notices),
+                3: self.logs_with_dropped_note(self.infos),
                 # 4: self.other_messages,
             },
         )
+
+    def take_status_update(self) -> ParsedNixProcess:
+        """Like get_model, but only with the errors and logs added since the last call"""
+        logs_by_level = {}
+        for level, sent in self.sent_logs_by_level.items():
+            logs = self.get_log_by_level(level)
+            logs_by_level[level] = self.logs_with_dropped_note(logs, sent)
+            self.sent_logs_by_level[level] = logs.total
+        errors = self.errors.since(self.sent_errors)
+        self.sent_errors = self.errors.total
+        return ParsedNixProcess(
+            done=self.done,
+            expected=self.expected,
+            running=self.running,
+            failed=self.failed,
+            errors=errors,
+            logs_by_level=logs_by_level,
+        )
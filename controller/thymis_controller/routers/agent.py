@@ -1,7 +1,9 @@
 import logging
 from typing import Annotated, List
 
-from fastapi import APIRouter, Header, HTTPException, Request, WebSocket
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, WebSocket
+from fastapi.responses import FileResponse, PlainTextResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 from starlette.requests import ClientDisconnect
@@ -12,10 +14,13 @@ from thymis_controller.dependencies import (
     EngineAD,
     NetworkRelayAD,
     ProjectAD,
+    TaskControllerAD,
 )
+from thymis_controller.nix.binary_cache import NIX_CACHE_INFO
 
 logger = logging.getLogger(__name__)
 ta = TypeAdapter(List[models.LogEntry])
+nix_cache_auth = HTTPBasic(auto_error=False)
 
 router = APIRouter()
 
@@ -105,3 +110,49 @@ async def logs(
     # parse as json
     log_entries = ta.validate_json(data)
     crud.logs.create_batch(db_session, log_entries, x_thymis_ssh_pubkey)
+
+
+def check_nix_cache_credentials(
+    request: Request,
+    db_session: DBSessionAD,
+    credentials: Annotated[HTTPBasicCredentials | None, Depends(nix_cache_auth)],
+):
+    # agents authenticate with their token as password, see Agent.fetch_closure
+    if credentials is None or not check_token_validity(
+        db_session, credentials.password
+    ):
+        logger.warning(f"Invalid binary cache credentials from {request.client.host}")
+        raise HTTPException(status_code=401, headers={"WWW-Authenticate": "Basic"})
+
+
+@router.get(
+    "/nix-cache/nix-cache-info",
+    dependencies=[Depends(check_nix_cache_credentials)],
+    response_class=PlainTextResponse,
+)
+def nix_cache_info():
+    return NIX_CACHE_INFO
+
+
+@router.get(
+    "/nix-cache/{path_hash}.narinfo",
+    dependencies=[Depends(check_nix_cache_credentials)],
+    response_class=PlainTextResponse,
+)
+def nix_cache_narinfo(path_hash: str, task_controller: TaskControllerAD):
+    narinfo = task_controller.executor.binary_cache.narinfo(path_hash)
+    if narinfo is None:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(narinfo, media_type="text/x-nix-narinfo")
+
+
+@router.get(
+    "/nix-cache/nar/{path_hash}.nar.xz",
+    dependencies=[Depends(check_nix_cache_credentials)],
+)
+def nix_cache_nar(path_hash: str, task_controller: TaskControllerAD):
+    # compressed on first request, sync so that requests run in parallel threads
+    path = task_controller.executor.binary_cache.nar_file(path_hash)
+    if path is None:
+        raise HTTPException(status_code=404)
+    return FileResponse(path, media_type="application/x-nix-nar")
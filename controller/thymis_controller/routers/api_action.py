@@ -5,6 +5,7 @@ import uuid
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from fastapi.responses import FileResponse, RedirectResponse
+from pydantic import ValidationError
 from thymis_agent import agent
 from thymis_controller import crud, dependencies, models
 from thymis_controller.config import global_settings
@@ -51,6 +52,7 @@ async def deploy(
     db_session: DBSessionAD,
     configs: list[str] = Query(None, alias="config"),
     deployment_info_ids: list[str] = Query(None, alias="deployment_info_id"),
+    rollout_waves: list[str] = Query(None, alias="rollout_wave"),
 ):
     if project.repo.is_dirty():
         raise HTTPException(
@@ -100,15 +102,21 @@ async def deploy(
 
     project.update_known_hosts(session)
 
-    task_controller.submit(
-        models.DeployDevicesTaskSubmission(
+    try:
+        submission = models.DeployDevicesTaskSubmission(
             devices=devices,
             project_path=str(project.path),
             ssh_key_path=str(global_settings.PROJECT_PATH / "id_thymis"),
             known_hosts_path=str(project.known_hosts_path),
             controller_ssh_pubkey=project.public_key,
             config_commit=project.repo.head_commit(),
-        ),
+            rollout_waves=rollout_waves,
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    task_controller.submit(
+        submission,
         user_session_id=user_session_id,
         db_session=session,
     )
@@ -358,6 +366,7 @@ async def switch_config(
             controller_access_client_endpoint=task_controller.access_client_endpoint,
             access_client_token=access_client_token.token,
             config_commit=project.repo.head_commit(),
+            closure_transfer=global_settings.DEPLOY_CLOSURE_TRANSFER,
         ),
         user_session_id=user_session_id,
         db_session=session,
@@ -63,12 +63,14 @@ def thymis_statistics(
     max_concurrent_connected = crud.agent_connection.get_max_concurrent_connections(
         db_session, date_from, date_to
     )
-    tasks_completed = crud.task.get_tasks_with_state(
+    tasks_completed = crud.task.count_tasks_with_state(
         db_session, "completed", date_from, date_to
     )
-    tasks_failed = crud.task.get_tasks_with_state(
+    tasks_failed = crud.task.count_tasks_with_state(
         db_session, "failed", date_from, date_to
     )
+    task_state_counts = crud.task.get_task_state_counts(db_session)
+    task_counts_updated_time = crud.task.get_task_counters_updated_time(db_session)
     state = project.read_state()
 
     return [
@@ -96,16 +98,21 @@ def thymis_statistics(
         },
         {
             "name": "tasks_completed_count",
-            "value": len(tasks_completed),
+            "value": tasks_completed,
             "date_from": date_from,
             "date_to": date_to,
         },
         {
             "name": "tasks_failed_count",
-            "value": len(tasks_failed),
+            "value": tasks_failed,
             "date_from": date_from,
             "date_to": date_to,
         },
+        {
+            "name": "tasks_state_counts",
+            "value": task_state_counts,
+            "time": task_counts_updated_time,
+        },
         {
             "name": "project_tags_count",
             "value": len(state.tags),
@@ -1,8 +1,10 @@
 import traceback
 import uuid
+from typing import Annotated, Literal, Optional
 
-from fastapi import APIRouter, Response, WebSocket
-from thymis_controller import db_models
+from fastapi import APIRouter, Header, Query, Response, WebSocket
+from fastapi.responses import StreamingResponse
+from thymis_controller import crud, db_models
 from thymis_controller.dependencies import (
     DBSessionAD,
     EngineAD,
@@ -11,6 +13,11 @@ from thymis_controller.dependencies import (
     TaskControllerAD,
 )
 from thymis_controller.routers.frontend import is_running_in_playwright
+from thymis_controller.task.output_stream import (
+    TaskOutputFollower,
+    content_range,
+    resolve_output_range,
+)
 from thymis_controller.task.subscribe_ui import TaskWebsocketSubscriber
 
 router = APIRouter()
@@ -39,12 +46,35 @@ def get_tasks(
     return task_controller.get_tasks(session, limit, offset)
 
 
+@router.get("/tasks/queue")
+def get_task_queue(task_controller: TaskControllerAD):
+    return task_controller.get_queue_stats()
+
+
+@router.get("/tasks/workers")
+def get_task_workers(task_controller: TaskControllerAD):
+    return task_controller.get_worker_stats()
+
+
+@router.get("/tasks/builds")
+def get_task_builds(task_controller: TaskControllerAD, db_session: DBSessionAD):
+    return task_controller.get_build_stats(db_session)
+
+
+@router.get("/tasks/deploy-stages")
+def get_task_deploy_stages(task_controller: TaskControllerAD):
+    return task_controller.get_deploy_stage_stats()
+
+
 @router.get("/tasks/{task_id}")
 async def get_task(
-    task_id: uuid.UUID, task_controller: TaskControllerAD, db_session: DBSessionAD
+    task_id: uuid.UUID,
+    task_controller: TaskControllerAD,
+    db_session: DBSessionAD,
+    include_output: bool = True,
 ):
     try:
-        return task_controller.get_task(task_id, db_session)
+        return task_controller.get_task(task_id, db_session, include_output)
     except ValueError:
         traceback.print_exc()
         return Response(
@@ -53,6 +83,66 @@ async def get_task(
         )
 
 
+@router.get("/tasks/{task_id}/processes/{process_index}/{stream}")
+def get_task_output(
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: Literal["stdout", "stderr"],
+    db_session: DBSessionAD,
+    start: Annotated[Optional[int], Query(ge=0)] = None,
+    end: Annotated[Optional[int], Query(ge=0)] = None,
+    tail: Annotated[Optional[int], Query(ge=0)] = None,
+):
+    if crud.task.get_task_state(db_session, task_id) is None:
+        return Response(
+            content=f"Task with id {task_id} not found",
+            status_code=404,
+        )
+    length = crud.task.process_output_length(db_session, task_id, process_index, stream)
+    start, end = resolve_output_range(length, start, end, tail)
+    return Response(
+        content=crud.task.read_process_output(
+            db_session, task_id, process_index, stream, start, end
+        ),
+        media_type="application/octet-stream",
+        headers={"content-range": content_range(start, end, length)},
+    )
+
+
+@router.get("/tasks/{task_id}/processes/{process_index}/{stream}/follow")
+async def follow_task_output(
+    task_id: uuid.UUID,
+    process_index: int,
+    stream: Literal["stdout", "stderr"],
+    db_engine: EngineAD,
+    db_session: DBSessionAD,
+    task_controller: TaskControllerAD,
+    start: Annotated[Optional[int], Query(ge=0)] = None,
+    tail: Annotated[Optional[int], Query(ge=0)] = None,
+    last_event_id: Annotated[Optional[str], Header()] = None,
+):
+    if crud.task.get_task_state(db_session, task_id) is None:
+        return Response(
+            content=f"Task with id {task_id} not found",
+            status_code=404,
+        )
+    if last_event_id is not None and last_event_id.isdigit():
+        start = int(last_event_id)
+    elif start is None:
+        length = crud.task.process_output_length(
+            db_session, task_id, process_index, stream
+        )
+        start = max(length - tail, 0) if tail is not None else 0
+    follower = TaskOutputFollower(
+        db_engine, task_controller.executor, task_id, process_index, stream, start
+    )
+    return StreamingResponse(
+        follower.events(),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache"},
+    )
+
+
 @router.post("/tasks/{task_id}/cancel")
 async def cancel_task(task_controller: TaskControllerAD, task_id: uuid.UUID):
     task_controller.cancel_task(task_id)
@@ -67,6 +157,20 @@ async def retry_task(
     return {"message": "Task retried"}
 
 
+@router.post("/tasks/{task_id}/restore-output")
+def restore_task_output(
+    task_controller: TaskControllerAD, db_session: DBSessionAD, task_id: uuid.UUID
+):
+    try:
+        task_controller.restore_task_output(task_id, db_session)
+    except ValueError:
+        return Response(
+            content=f"Task with id {task_id} not found",
+            status_code=404,
+        )
+    return {"message": "Task output restored"}
+
+
 if is_running_in_playwright():
 
     @router.post("/tasks/delete_all")
@@ -0,0 +1,139 @@
+import dataclasses
+import logging
+import threading
+import uuid
+from typing import Optional
+
+import thymis_controller.models.task as models_task
+
+logger = logging.getLogger(__name__)
+
+# flake revision, configuration identifier and attribute of its config.system.build
+type BuildKey = tuple[str, str, str]
+
+type BuildReplies = list[tuple[uuid.UUID, models_task.BuildClaimResult]]
+
+
+@dataclasses.dataclass
+class InFlightBuild:
+    key: BuildKey
+    builder: uuid.UUID
+    waiters: list[uuid.UUID] = dataclasses.field(default_factory=list)
+
+
+class BuildCoordinator:
+    """
+    Runs at most one build of a configuration at a commit at a time.
+
+    The first task to claim a build runs it, tasks claiming the same build
+    while it runs wait for its result and use the same output path. If the
+    building task ends without a result, the first waiting task builds next.
+
+    A result cached from an earlier build is handed out as is, the task
+    checks that the path is still valid and claims again without it if not.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._builds: dict[BuildKey, InFlightBuild] = {}
+        self._by_task: dict[uuid.UUID, InFlightBuild] = {}
+        self.builds_started = 0
+        self.builds_shared = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_invalid = 0
+
+    def claim(
+        self,
+        task_id: uuid.UUID,
+        key: BuildKey,
+        cached: Optional[tuple[str, Optional[uuid.UUID]]] = None,
+    ) -> models_task.BuildClaimResult:
+        """cached: the out path and builder task of an earlier build of key"""
+        with self._lock:
+            build = self._builds.get(key)
+            if build is None and cached is not None:
+                self.cache_hits += 1
+                out_path, builder_task_id = cached
+                return models_task.BuildClaimResult(
+                    status="cached", builder_task_id=builder_task_id, out_path=out_path
+                )
+            if build is None:
+                self.cache_misses += 1
+                build = InFlightBuild(key=key, builder=task_id)
+                self._builds[key] = build
+                self._by_task[task_id] = build
+                self.builds_started += 1
+                return models_task.BuildClaimResult(status="build")
+            build.waiters.append(task_id)
+            self._by_task[task_id] = build
+            logger.info(
+                "Task %s waits for the build of %s in task %s",
+                task_id,
+                key,
+                build.builder,
+            )
+            return models_task.BuildClaimResult(
+                status="wait", builder_task_id=build.builder
+            )
+
+    def cached_result_invalid(self):
+        with self._lock:
+            self.cache_invalid += 1
+
+    def building(self, task_id: uuid.UUID) -> Optional[BuildKey]:
+        """The key of the build task_id runs, if any"""
+        with self._lock:
+            build = self._by_task.get(task_id)
+            if build is None or build.builder != task_id:
+                return None
+            return build.key
+
+    def finish(self, task_id: uuid.UUID, out_path: Optional[str]) -> BuildReplies:
+        """The builder reported its result, returns the replies for the waiters"""
+        with self._lock:
+            build = self._by_task.get(task_id)
+            if build is None or build.builder != task_id:
+                return []
+            self._remove(build)
+            self.builds_shared += len(build.waiters)
+            result = models_task.BuildClaimResult(
+                status="built" if out_path else "failed",
+                builder_task_id=task_id,
+                out_path=out_path,
+            )
+            return [(waiter, result) for waiter in build.waiters]
+
+    def task_finished(self, task_id: uuid.UUID) -> BuildReplies:
+        """A task ended, hands its unfinished build to the next waiting task"""
+        with self._lock:
+            build = self._by_task.pop(task_id, None)
+            if build is None:
+                return []
+            if build.builder != task_id:
+                build.waiters.remove(task_id)
+                return []
+            if not build.waiters:
+                del self._builds[build.key]
+                return []
+            build.builder = build.waiters.pop(0)
+            self.builds_started += 1
+            return [(build.builder, models_task.BuildClaimResult(status="build"))]
+
+    def _remove(self, build: InFlightBuild):
+        del self._builds[build.key]
+        self._by_task.pop(build.builder, None)
+        for waiter in build.waiters:
+            self._by_task.pop(waiter, None)
+
+    def stats(self) -> models_task.BuildCoordinatorStats:
+        with self._lock:
+            return models_task.BuildCoordinatorStats(
+                in_flight=len(self._builds),
+                waiting=sum(len(build.waiters) for build in self._builds.values()),
+                builds_started=self.builds_started,
+                builds_shared=self.builds_shared,
+                cache_hits=self.cache_hits,
+                cache_misses=self.cache_misses,
+                cache_invalid=self.cache_invalid,
+            )
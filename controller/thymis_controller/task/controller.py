@@ -9,6 +9,7 @@ from typing import TYPE_CHECKING
 import sqlalchemy
 from sqlalchemy.orm import Session
 from thymis_controller import crud, db_models, models
+from thymis_controller.config import global_settings
 from thymis_controller.crud.agent_token import get_or_create_access_client_token
 from thymis_controller.crud.task import get_tasks_short
 from thymis_controller.models.task import (
@@ -16,7 +17,9 @@ from thymis_controller.models.task import (
     TaskSubmission,
     TaskSubmissionData,
 )
+from thymis_controller.task import output_archive
 from thymis_controller.task.executor import TaskWorkerPoolManager
+from thymis_controller.task.rollout import rollout_wave_sizes
 
 if TYPE_CHECKING:
     from thymis_controller.network_relay import NetworkRelay
@@ -73,7 +76,17 @@ class TaskController:
 
         if task.type == "deploy_devices_task":
             children_uids = []
-            for device in task.devices:
+            wave_sizes = rollout_wave_sizes(
+                len(task.devices),
+                (
+                    task.rollout_waves
+                    if task.rollout_waves is not None
+                    else global_settings.DEPLOY_ROLLOUT_WAVES
+                ),
+            )
+            # devices in submission order, the first ones in the first wave
+            waves = [wave for wave, size in enumerate(wave_sizes) for _ in range(size)]
+            for device, wave in zip(task.devices, waves):
                 access_client_token = get_or_create_access_client_token(
                     db_session,
                     deployment_info_id=device.deployment_info_id,
@@ -88,6 +101,8 @@ class TaskController:
                     parent_task_id=task_db.id,
                     access_client_token=access_client_token.token,
                     config_commit=task.config_commit,
+                    rollout_wave=wave if len(wave_sizes) > 1 else None,
+                    closure_transfer=global_settings.DEPLOY_CLOSURE_TRANSFER,
                 )
                 subtask = crud.task.create(
                     db_session,
@@ -106,20 +121,40 @@ class TaskController:
             task_db.children = children_uids
             db_session.commit()
 
-        self.executor.submit(TaskSubmission(id=task_db.id, data=task))
+        self.executor.submit(TaskSubmission(id=task_db.id, data=task), user_session_id)
 
         for subtask in subtasks:
             self.executor.submit(
-                TaskSubmission(id=subtask.id, data=subtask.task_submission_data)
+                TaskSubmission(id=subtask.id, data=subtask.task_submission_data),
+                user_session_id,
             )
 
         return task_db
 
-    def get_task(self, task_id: str, db_session: Session) -> models.Task:
+    def get_task(
+        self, task_id: str, db_session: Session, include_output: bool = True
+    ) -> models.Task:
         return models.task.Task.from_orm_task(
-            crud.task.get_task_by_id(db_session, task_id),
+            crud.task.get_task_by_id(db_session, task_id), include_output
         )
 
+    def restore_task_output(self, task_id: uuid.UUID, db_session: Session):
+        output_archive.restore_task_output(db_session, task_id)
+
+    def get_queue_stats(self) -> list[models.TaskQueueStats]:
+        return self.executor.scheduler.stats()
+
+    def get_build_stats(self, db_session: Session) -> models.BuildCoordinatorStats:
+        stats = self.executor.build_coordinator.stats()
+        stats.cache_entries = crud.build_result.count(db_session)
+        return stats
+
+    def get_deploy_stage_stats(self) -> list[models.DeployStageStats]:
+        return self.executor.deploy_stages.stats()
+
+    def get_worker_stats(self) -> list[models.WorkerPoolStats]:
+        return self.executor.worker_metrics.stats()
+
     def cancel_task(self, task_id: str):
         self.executor.cancel_task(task_id)
 
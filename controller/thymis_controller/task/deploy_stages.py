@@ -0,0 +1,141 @@
+import collections
+import dataclasses
+import logging
+import threading
+import time
+import uuid
+from typing import Optional
+
+import thymis_controller.models.task as models_task
+from thymis_controller.models.task import DeployStage
+from thymis_controller.task.scheduler import ResourceSlots
+
+logger = logging.getLogger(__name__)
+
+# in the order a deploy runs them
+DEPLOY_STAGES: tuple[DeployStage, ...] = ("eval", "build", "copy", "activate")
+
+type StageGrants = list[tuple[uuid.UUID, models_task.DeployStageGranted]]
+
+
+@dataclasses.dataclass
+class StageStats:
+    started: int = 0
+    total_wait: float = 0.0
+    total_run: float = 0.0
+    finished: int = 0
+
+
+class DeployStageLimiter:
+    """
+    Limits how many deploy tasks run each stage of a deploy at the same time.
+
+    Every device of a fleet deploy is its own task, the task asks for a slot
+    of a stage before running it and gives it back afterwards. Each stage has
+    its own limit, so copies to devices whose configuration is built overlap
+    with the evaluation and builds of the next devices and a fleet deploy
+    takes about as long as its slowest stage. Waiting tasks get slots in the
+    order they asked for them. A stage in `shared` also needs a slot of its
+    ResourceSlots, which other tasks use too.
+    """
+
+    def __init__(
+        self,
+        limits: dict[DeployStage, int],
+        shared: Optional[dict[DeployStage, ResourceSlots]] = None,
+    ):
+        self.limits = limits
+        self.shared = shared or {}
+        self._lock = threading.Lock()
+        # time the task asked for the slot, in that order
+        self._waiting: dict[DeployStage, collections.OrderedDict[uuid.UUID, float]] = {
+            stage: collections.OrderedDict() for stage in DEPLOY_STAGES
+        }
+        # time the task got the slot
+        self._running: dict[DeployStage, dict[uuid.UUID, float]] = {
+            stage: {} for stage in DEPLOY_STAGES
+        }
+        self._stats = {stage: StageStats() for stage in DEPLOY_STAGES}
+
+    def acquire(self, task_id: uuid.UUID, stage: DeployStage) -> bool:
+        """Whether the task got the slot now, otherwise it is granted later"""
+        with self._lock:
+            self._waiting[stage][task_id] = time.monotonic()
+            # slots are granted whenever they free up, only this task can get one
+            self._grant(stage)
+            return task_id in self._running[stage]
+
+    def release(self, task_id: uuid.UUID, stage: DeployStage) -> StageGrants:
+        with self._lock:
+            self._finish(task_id, stage)
+            return self._grant(stage)
+
+    def grant_waiting(self, stage: DeployStage) -> StageGrants:
+        """Grant slots of a shared stage, after a task outside the limiter released one"""
+        with self._lock:
+            return self._grant(stage)
+
+    def task_finished(self, task_id: uuid.UUID) -> StageGrants:
+        """A task ended, frees the slots it held and stops it waiting"""
+        grants = []
+        with self._lock:
+            for stage in DEPLOY_STAGES:
+                self._waiting[stage].pop(task_id, None)
+                if task_id in self._running[stage]:
+                    logger.info("Task %s ended in deploy stage %s", task_id, stage)
+                    self._finish(task_id, stage)
+                    grants += self._grant(stage)
+        return grants
+
+    def _finish(self, task_id: uuid.UUID, stage: DeployStage):
+        started = self._running[stage].pop(task_id, None)
+        if started is not None:
+            if stage in self.shared:
+                self.shared[stage].release(task_id)
+            stats = self._stats[stage]
+            stats.finished += 1
+            stats.total_run += time.monotonic() - started
+
+    def _grant(self, stage: DeployStage) -> StageGrants:
+        grants = []
+        waiting = self._waiting[stage]
+        running = self._running[stage]
+        now = time.monotonic()
+        shared = self.shared.get(stage)
+        while waiting and len(running) < self.limits.get(stage, 1):
+            task_id = next(iter(waiting))
+            if shared is not None and not shared.acquire(task_id):
+                break
+            asked = waiting.pop(task_id)
+            running[task_id] = now
+            stats = self._stats[stage]
+            stats.started += 1
+            stats.total_wait += now - asked
+            grants.append((task_id, models_task.DeployStageGranted(stage=stage)))
+        return grants
+
+    def mean_run_seconds(self, stage: DeployStage) -> float:
+        """How long the stage took on average since the controller started"""
+        with self._lock:
+            return self._mean_run_seconds(stage)
+
+    def _mean_run_seconds(self, stage: DeployStage) -> float:
+        stats = self._stats[stage]
+        return stats.total_run / stats.finished if stats.finished else 0.0
+
+    def stats(self) -> list[models_task.DeployStageStats]:
+        with self._lock:
+            return [
+                models_task.DeployStageStats(
+                    stage=stage,
+                    limit=self.limits.get(stage, 1),
+                    running=len(self._running[stage]),
+                    waiting=len(self._waiting[stage]),
+                    started=stats.started,
+                    mean_wait_seconds=(
+                        stats.total_wait / stats.started if stats.started else 0.0
+                    ),
+                    mean_run_seconds=self._mean_run_seconds(stage),
+                )
+                for stage, stats in self._stats.items()
+            ]
@@ -0,0 +1,147 @@
+import dataclasses
+import functools
+import logging
+import threading
+import traceback
+import uuid
+from multiprocessing.connection import Connection, Pipe, wait
+from typing import TYPE_CHECKING, Optional
+
+import thymis_controller.models.task as models_task
+from thymis_controller.task.output_channel import TaskOutputFrame, decode_message
+
+if TYPE_CHECKING:
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class TaskListener:
+    task_id: uuid.UUID
+    conn: Connection
+    # set once the connection is closed and all of its updates are committed
+    drained: threading.Event = dataclasses.field(default_factory=threading.Event)
+
+
+class TaskMessageDispatcher:
+    """
+    Receives messages from all worker connections on a single thread.
+
+    The thread blocks in `multiprocessing.connection.wait` on every registered
+    connection, so the number of threads does not grow with the number of
+    running tasks. Updates are handed to the task update writer.
+    """
+
+    def __init__(self, manager: "TaskWorkerPoolManager"):
+        self.manager = manager
+        self.thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pending: list[TaskListener] = []
+        self._stopping = False
+        self._wakeup_reader, self._wakeup_writer = Pipe(duplex=False)
+
+    def start(self):
+        with self._lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self._stopping = False
+            self.thread = threading.Thread(
+                target=self.run, name="task-message-dispatcher", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        with self._lock:
+            self._stopping = True
+        self._wakeup_writer.send_bytes(b"")
+        self.thread.join()
+        self.thread = None
+
+    def register(self, task_id: uuid.UUID, conn: Connection) -> TaskListener:
+        listener = TaskListener(task_id=task_id, conn=conn)
+        with self._lock:
+            self._pending.append(listener)
+        self.start()
+        self._wakeup_writer.send_bytes(b"")
+        return listener
+
+    def run(self):
+        connections: dict[Connection, TaskListener] = {}
+        while True:
+            ready = wait([self._wakeup_reader, *connections])
+            for conn in ready:
+                if conn is self._wakeup_reader:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv_bytes()
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                        stopping = self._stopping
+                    for listener in pending:
+                        connections[listener.conn] = listener
+                        self.manager.update_writer.after_commit(
+                            functools.partial(
+                                self.manager.notify_new_task, listener.task_id
+                            )
+                        )
+                    if stopping:
+                        for listener in list(connections.values()):
+                            self.close(connections, listener)
+                        return
+                else:
+                    listener = connections[conn]
+                    try:
+                        keep_open = self.receive(listener)
+                    except Exception:
+                        # after a corrupt frame the rest of the stream cannot be
+                        # trusted, the task fails once its worker notices
+                        logger.exception(
+                            "Invalid message from the worker of task %s, "
+                            "closing its connection",
+                            listener.task_id,
+                        )
+                        keep_open = False
+                    if not keep_open:
+                        self.close(connections, listener)
+
+    def receive(self, listener: TaskListener) -> bool:
+        """Receive one message, returns False once the connection is done"""
+        try:
+            message = decode_message(listener.conn.recv_bytes())
+        except EOFError:
+            logger.info("Worker connection of task %s closed", listener.task_id)
+            return False
+        except OSError as e:
+            logger.info("Worker connection of task %s closed: %s", listener.task_id, e)
+            return False
+        if isinstance(message, TaskOutputFrame):
+            self.manager.update_writer.put_output(message)
+            return True
+        if not isinstance(message, models_task.RunnerToControllerTaskUpdate):
+            logger.error("Received invalid message from worker: %s", message)
+            return True
+        if isinstance(message.update, models_task.TaskPickedUpdate):
+            self.manager.worker_metrics.task_picked(
+                listener.task_id,
+                message.update.worker_pid,
+                message.update.worker_max_rss,
+            )
+        try:
+            self.manager.update_writer.put(listener.conn, message)
+        except Exception as e:
+            traceback.print_exc()
+            logger.error("Error processing message from worker: %s", e)
+        return not isinstance(
+            message.update,
+            (models_task.TaskCompletedUpdate, models_task.TaskFailedUpdate),
+        )
+
+    def close(
+        self, connections: dict[Connection, TaskListener], listener: TaskListener
+    ):
+        connections.pop(listener.conn, None)
+        listener.conn.close()
+        # finish_task relies on the final state being committed
+        self.manager.update_writer.after_commit(listener.drained.set)
@@ -5,40 +5,151 @@ import logging
 import os
 import sys
 import threading
-import traceback
 import uuid
 from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime, timezone
 from multiprocessing.connection import Connection, Pipe
-from typing import TYPE_CHECKING, assert_never
+from typing import TYPE_CHECKING, Callable, assert_never
 
+import sqlalchemy.event
 import sqlalchemy.orm
 import thymis_agent.agent as agent
 import thymis_controller.crud as crud
 import thymis_controller.crud.task as crud_task
 import thymis_controller.db_models as db_models
 import thymis_controller.models.task as models_task
+from pydantic import BaseModel
 from pyrage import ssh
+from thymis_controller.config import global_settings
+from thymis_controller.nix.binary_cache import BinaryCache, store_path_hash
+from thymis_controller.nix.log_parse import ParsedNixProcess
 from thymis_controller.notifier import Notifier
+from thymis_controller.task.build_coordinator import (
+    BuildCoordinator,
+    BuildKey,
+    BuildReplies,
+)
+from thymis_controller.task.deploy_stages import DeployStageLimiter, StageGrants
+from thymis_controller.task.dispatcher import TaskMessageDispatcher
+from thymis_controller.task.output_compactor import TaskOutputCompactor
+from thymis_controller.task.rollout import RolloutGate
+from thymis_controller.task.scheduler import (
+    ResourceSlots,
+    TaskScheduler,
+    task_worker_pool,
+)
+from thymis_controller.task.update_writer import TaskUpdateWriter
 from thymis_controller.task.worker import worker_run_task
+from thymis_controller.task.worker_pool import (
+    WorkerPoolKind,
+    WorkerPoolMetrics,
+    create_worker_pool,
+    start_forkserver,
+)
 
 if TYPE_CHECKING:
     from thymis_controller.task.controller import TaskController
 
 logger = logging.getLogger(__name__)
 
+# store paths per query sent to an agent, keeps messages below the 1 MiB
+# default message size limit of websockets
+STORE_PATH_QUERY_BATCH_SIZE = 2000
+
+# seconds finish_task waits for the updates of a finished worker to be
+# committed, a connection that never closes must not stall the pool
+WORKER_UPDATES_DRAIN_TIMEOUT = 60
+
+
+def after_commit(db_session: sqlalchemy.orm.Session, callback: Callable[[], None]):
+    """
+    Run callback once the transaction of db_session is committed, never if it
+    is rolled back. Replies and messages to agents go out this way, so a batch
+    of updates that is retried does not send them twice.
+    """
+
+    def run(_session):
+        try:
+            callback()
+        except Exception:
+            logger.exception("Error running task update side effect")
+
+    sqlalchemy.event.listen(db_session, "after_commit", run, once=True)
+
 
 class TaskWorkerPoolManager:
     def __init__(self, controller: "TaskController"):
-        self.pool = ProcessPoolExecutor()
+        workers = {
+            "cpu": global_settings.TASK_CPU_WORKERS or os.cpu_count() or 1,
+            "io": global_settings.TASK_IO_WORKERS,
+        }
+        waiting_workers = {"io": global_settings.TASK_DEPLOY_WAITING_WORKERS}
+        # workers are only started once the pools get tasks
+        self.pools: dict[WorkerPoolKind, ProcessPoolExecutor] = {
+            kind: create_worker_pool(
+                count + waiting_workers.get(kind, 0),
+                global_settings.TASK_WORKER_MAX_TASKS,
+            )
+            for kind, count in workers.items()
+        }
+        self.worker_metrics = WorkerPoolMetrics(
+            {
+                kind: count + waiting_workers.get(kind, 0)
+                for kind, count in workers.items()
+            }
+        )
+        self.build_coordinator = BuildCoordinator()
+        # build tasks and deploys in their build stage share one limit
+        build_slots = ResourceSlots(global_settings.TASK_MAX_CONCURRENT_BUILDS)
+        self.deploy_stages = DeployStageLimiter(
+            {
+                "eval": global_settings.TASK_DEPLOY_EVAL_CONCURRENCY
+                or os.cpu_count()
+                or 1,
+                "build": global_settings.TASK_MAX_CONCURRENT_BUILDS,
+                "copy": global_settings.TASK_MAX_CONCURRENT_COPIES,
+                "activate": global_settings.TASK_DEPLOY_ACTIVATE_CONCURRENCY,
+            },
+            {"build": build_slots},
+        )
+        self.rollout_gate = RolloutGate(self)
+        # by public key of the agent they wait for
+        self._pending_store_queries: dict[
+            str, list[tuple[uuid.UUID, models_task.AgentQueryStorePathsUpdate]]
+        ] = {}
+        self._pending_store_queries_lock = threading.Lock()
+        self.binary_cache = BinaryCache(
+            global_settings.PROJECT_PATH / "nix-cache",
+            global_settings.NIX_CACHE_COMPRESSION_LEVEL,
+            global_settings.NIX_CACHE_MAX_BYTES,
+        )
+        self.scheduler = TaskScheduler(
+            self.start_task,
+            workers,
+            {
+                "nix_build": build_slots,
+                "nixos_vm": ResourceSlots(global_settings.TASK_MAX_CONCURRENT_VMS),
+            },
+            global_settings.TASK_INTERACTIVE_WORKERS,
+            waiting_workers,
+            self.fail_task_start,
+        )
         self.futures = {}
         self.future_to_id = {}
-        self.listen_threads = {}
+        self.listeners = {}
+        # the worker's end of each task connection, closed once the worker is
+        # done so the dispatcher sees the end of the connection
+        self.worker_connections = {}
         self.controller = controller
         self._db_engine = None
         self.on_new_task = Notifier()
         self.on_task_update = Notifier()
         self.on_task_output = Notifier()
+        self.update_writer = TaskUpdateWriter(
+            self, global_settings.TASK_UPDATE_COMMIT_LATENCY_MS / 1000
+        )
+        self.dispatcher = TaskMessageDispatcher(self)
+        self.output_compactor = TaskOutputCompactor(self)
 
     @property
     def db_engine(self):
@@ -46,28 +157,56 @@ class TaskWorkerPoolManager:
             raise ValueError("TaskWorkerPoolManager not started")
         return self._db_engine
 
-    def submit(self, task_submission: models_task.TaskSubmission):
+    def submit(
+        self,
+        task_submission: models_task.TaskSubmission,
+        user_session_id: uuid.UUID | None = None,
+    ):
+        self.scheduler.submit(task_submission, user_session_id)
+
+    def start_task(self, task_submission: models_task.TaskSubmission):
         executor_side, worker_side = Pipe()
+        kind = task_worker_pool(task_submission.data.type)
+        self.worker_metrics.task_submitted(task_submission.id, kind)
         try:
-            future = self.pool.submit(worker_run_task, task_submission, worker_side)
+            future = self.pools[kind].submit(
+                worker_run_task, task_submission, worker_side
+            )
         except concurrent.futures.process.BrokenProcessPool:
             logger.error("Failed to submit task, process pool is closed")
             import signal
 
             os.kill(os.getpid(), signal.SIGINT)
             sys.exit(1)
-        future.add_done_callback(self.finish_task)
+        self.listeners[task_submission.id] = self.dispatcher.register(
+            task_submission.id, executor_side
+        )
+        # the pool sends the connection to the worker from its own thread, so it
+        # can only be closed here once the worker is done
+        self.worker_connections[task_submission.id] = worker_side
         self.futures[task_submission.id] = (future, executor_side)
         self.future_to_id[future] = task_submission.id
-        thread = threading.Thread(
-            target=self.listen_child_messages,
-            args=(executor_side, task_submission.id),
-        )
-        thread.start()
-        self.listen_threads[task_submission.id] = thread
+        # runs right away if the worker is done already
+        future.add_done_callback(self.finish_task)
+
+    def fail_task_start(
+        self, task_submission: models_task.TaskSubmission, exception: Exception
+    ):
+        with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
+            task = crud_task.get_task_by_id(db_session, task_submission.id)
+            task.state = "failed"
+            task.end_time = datetime.now(timezone.utc)
+            task.add_exception(f"Failed to start task: {exception}")
+            db_session.commit()
+            self.on_task_update.notify(task)
+            parent_task_id = task.parent_task_id
+        if parent_task_id:
+            self.update_composite_task(parent_task_id)
 
     async def start(self, db_engine: sqlalchemy.Engine):
         self._db_engine = db_engine
+        # importing the worker modules takes a while, do it before the first task
+        threading.Thread(target=start_forkserver, daemon=True).start()
 
         with (sqlalchemy.orm.Session(bind=self.db_engine) as db_session,):
             amount_running_when_shut_down = crud_task.fail_running_tasks(db_session)
@@ -76,8 +215,11 @@ class TaskWorkerPoolManager:
                 amount_running_when_shut_down,
             )
             pending_tasks = crud_task.get_tasks_with_state(db_session, "pending")
-            for task in pending_tasks:
-                self.submit(models_task.TaskSubmission.from_orm_task(task))
+            for task in sorted(pending_tasks, key=lambda task: task.submitted_time):
+                self.submit(
+                    models_task.TaskSubmission.from_orm_task(task),
+                    task.user_session_id,
+                )
             logger.info(
                 "TaskWorkerPoolManager started, %d pending tasks submitted",
                 len(pending_tasks),
@@ -96,25 +238,37 @@ class TaskWorkerPoolManager:
 
     def stop(self):
         logger.info("Stopping TaskWorkerPoolManager")
+        self.scheduler.stop()
+        self.rollout_gate.stop()
         # join all pending futures
         concurrent.futures.wait([future for future, _ in self.futures.values()])
         logger.info("All worker futures finished")
-        # close all worker connections
-        for _, child_out in self.futures.values():
-            child_out.close()
-        logger.info("All worker connections closed")
-        for thread in self.listen_threads.values():
-            thread.join()
-        logger.info("All listen threads joined")
-        self.pool.shutdown(wait=True)
+        # closes all remaining worker connections
+        self.dispatcher.stop()
+        logger.info("Task message dispatcher stopped")
+        self.update_writer.stop()
+        logger.info("Task update writer stopped")
+        self.output_compactor.stop()
+        logger.info("Task output compactor stopped")
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
         logger.info("TaskWorkerPoolManager stopped")
 
-    def cancel_task(self, task_id: uuid.UUID):
+    def cancel_task(self, task_id: uuid.UUID, reason: str = "Task was cancelled"):
+        # a task that has not started yet is only removed from the queue
+        queued = self.scheduler.cancel(task_id)
         with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
             task = crud_task.get_task_by_id(db_session, task_id)
-            task.add_exception("Task was cancelled")
+            task.add_exception(reason)
+            if queued:
+                task.state = "failed"
+                task.end_time = datetime.now(timezone.utc)
             db_session.commit()
             self.on_task_update.notify(task)
+        if queued:
+            if task.parent_task_id:
+                self.update_composite_task(task.parent_task_id)
+            return
         try:
             self.send_message_to_task(
                 task_id,
@@ -131,274 +285,487 @@ class TaskWorkerPoolManager:
         if task_id in self.futures:
             self.futures[task_id][1].send(message)
 
-    def listen_child_messages(self, conn: Connection, task_id: uuid.UUID):
-        message = None
-        try:
+    def notify_new_task(self, task_id: uuid.UUID):
+        with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
+            task = crud_task.get_task_by_id(db_session, task_id)
+            self.on_new_task.notify(task)
+
+    def get_or_create_process(
+        self, task: db_models.Task, process_index: int
+    ) -> db_models.TaskProcess:
+        process = task.get_process_by_index(process_index)
+        if process is None:
+            process = db_models.TaskProcess(
+                task_id=task.id,
+                process_index=process_index,
+            )
+            task.processes.append(process)
+        return process
+
+    def apply_task_output(
+        self,
+        db_session: sqlalchemy.orm.Session,
+        task: db_models.Task,
+        process_index: int,
+        stdout: bytes,
+        stderr: bytes,
+    ) -> list[db_models.TaskOutputChunk]:
+        self.get_or_create_process(task, process_index)
+        chunks = [
+            crud_task.append_process_output(
+                db_session, task.id, process_index, "stdout", stdout
+            ),
+            crud_task.append_process_output(
+                db_session, task.id, process_index, "stderr", stderr
+            ),
+        ]
+        return [chunk for chunk in chunks if chunk is not None]
+
+    def apply_nix_status(
+        self,
+        db_session: sqlalchemy.orm.Session,
+        task: db_models.Task,
+        process_index: int,
+        status: ParsedNixProcess,
+    ) -> dict[str, tuple[int, list]]:
+        """Store a nix status update, returns the start and entries appended per stream"""
+        process = self.get_or_create_process(task, process_index)
+        process.nix_status = status.model_dump(
+            include=("done", "expected", "running", "failed")
+        )
+        # errors and logs only contain what was added since the last update
+        new_entries = {
+            "nix_errors": status.model_dump(include=("errors"))["errors"],
+            "nix_error_logs": status.logs_by_level.get(0),
+            "nix_warning_logs": status.logs_by_level.get(1),
+            "nix_notice_logs": status.logs_by_level.get(2),
+            "nix_info_logs": status.logs_by_level.get(3),
+        }
+        appended = {}
+        for stream, entries in new_entries.items():
+            start = crud_task.append_nix_log(
+                db_session, task.id, process_index, stream, entries
+            )
+            if start is not None:
+                appended[stream] = (start, entries)
+        return appended
+
+    def apply_task_update(
+        self,
+        db_session: sqlalchemy.orm.Session,
+        conn: Connection,
+        task: db_models.Task,
+        update: models_task.TaskUpdate,
+    ):
+        task_id = task.id
+
+        def reply(inner: BaseModel):
+            after_commit(
+                db_session,
+                lambda: conn.send(
+                    models_task.ControllerToRunnerTaskUpdate(inner=inner)
+                ),
+            )
+
+        match update:
+            case models_task.TaskPickedUpdate():
+                task.start_time = datetime.now(timezone.utc)
+                task.state = "running"
+            case models_task.TaskRejectedUpdate(reason=reason):
+                task.state = "failed"
+                task.add_exception(f"Task rejected: {reason}")
+                task.end_time = datetime.now(timezone.utc)
+            case models_task.TaskStdOutErrUpdate(
+                stdoutb64=stdoutb64, stderrb64=stderrb64
+            ):
+                self.apply_task_output(
+                    db_session,
+                    task,
+                    update.process_index,
+                    base64.b64decode(stdoutb64),
+                    base64.b64decode(stderrb64),
+                )
+            case models_task.TaskNixStatusUpdate(status=status):
+                self.apply_nix_status(db_session, task, update.process_index, status)
+            case models_task.TaskCompletedUpdate():
+                # task.state = "completed"
+                if not task.children:
+                    task.state = "completed"
+                    task.end_time = datetime.now(timezone.utc)
+            case models_task.TaskFailedUpdate(reason=reason):
+                submission_data = task.task_submission_data or {}
+                device = submission_data.get("device", {})
+                deployment_info_id = device.get("deployment_info_id")
+                source_identifier = device.get("source_identifier")
+                if (
+                    task.task_type == "deploy_device_task"
+                    and source_identifier
+                    and deployment_info_id
+                ):
+                    crud.deployment_info.update(
+                        db_session,
+                        uuid.UUID(deployment_info_id),
+                        pending_config_id=None,
+                    )
+                task.state = "failed"
+                task.add_exception(reason)
+                task.end_time = datetime.now(timezone.utc)
+                logger.error("Task %s failed: %s", task_id, reason)
+            case models_task.CommandRunUpdate():
+                # the process may have output already, e.g. a notice sent before
+                process = self.get_or_create_process(task, update.process_index)
+                process.process_program = update.args[0]
+                process.process_args = update.args[1:]
+                process.process_env = update.env
+            case models_task.ImageBuiltUpdate():
+                crud.agent_token.create(
+                    db_session,
+                    original_disk_config_commit=update.configuration_commit,
+                    original_disk_config_id=update.configuration_id,
+                    token=update.token,
+                )
+
+                user_session_id = task.user_session_id
+                if update.image_format == "nixos-vm":
+                    # start a new task to start the VM
+                    if task.task_submission_data is None:
+                        raise ValueError("Task submission data is None")
+                    if "project_path" not in task.task_submission_data:
+                        raise ValueError("project_path not in task submission data")
+
+                    new_task_submission = models_task.RunNixOSVMTaskSubmission(
+                        configuration_id=update.configuration_id,
+                        parent_task_id=task_id,
+                        project_path=task.task_submission_data["project_path"],
+                    )
+                    after_commit(
+                        db_session,
+                        lambda: self.submit_child_task(
+                            new_task_submission, user_session_id
+                        ),
+                    )
+                else:
+                    notifications = self.controller.notification_manager
+                    after_commit(
+                        db_session,
+                        lambda: notifications.broadcast_image_built_notification(
+                            user_session_id,
+                            update.configuration_id,
+                            update.image_format,
+                        ),
+                    )
+            case models_task.AgentShouldSwitchToNewConfigurationUpdate():
+                deployment_info = crud.deployment_info.get_by_id(
+                    db_session, update.deployment_info_id
+                )
+                relay_con_id = (
+                    self.controller.network_relay.public_key_to_connection_id[
+                        deployment_info.ssh_public_key
+                    ]
+                )
+                relay_con = self.controller.network_relay.registered_agent_connections[
+                    relay_con_id
+                ]
+                logger.info(
+                    "Switching agent to new configuration: %s",
+                    update.path_to_configuration,
+                )
+                self.send_to_agent(
+                    db_session,
+                    relay_con,
+                    agent.RtESwitchToNewConfigMessage(
+                        new_path_to_config=update.path_to_configuration,
+                        configuration_id=update.configuration_id,
+                        config_commit=update.config_commit,
+                        task_id=task_id,
+                    ),
+                )
+            case models_task.WorkerRequestsSecretsUpdate():
+                # update.secret_ids
+                secrets = self.controller.project.get_processed_secrets(
+                    db_session,
+                    update.secret_ids,
+                    update.target_recipient_token,
+                )
+                reply(models_task.SecretsResult(secrets=secrets))
+            case models_task.AgentShouldReceiveNewSecretsUpdate():
+                # update.secret_ids
+                secrets = self.controller.project.get_processed_secrets(
+                    db_session,
+                    [s.secret_id for s in update.secrets],
+                    ssh.Recipient.from_str(update.target_recipient_ssh_pubkey),
+                )
+                # send to agent
+                relay_con_id = (
+                    self.controller.network_relay.public_key_to_connection_id[
+                        update.target_recipient_ssh_pubkey
+                    ]
+                )
+                relay_con = self.controller.network_relay.registered_agent_connections[
+                    relay_con_id
+                ]
+                self.send_to_agent(
+                    db_session,
+                    relay_con,
+                    agent.RtESendSecretsMessage(
+                        secrets={
+                            k: base64.b64encode(v).decode("utf-8")
+                            for k, v in secrets.items()
+                        },
+                        secret_infos=update.secrets,
+                    ),
+                )
+                reply(models_task.AgentGotNewSecretsResult(success=True))
+
+            case models_task.BuildClaimUpdate():
+                key = (update.flake_rev, update.configuration_id, update.attribute)
+                if update.invalid_out_path:
+                    crud.build_result.delete_path(
+                        db_session, *key, update.invalid_out_path
+                    )
+                    cached = None
+                else:
+                    cached = crud.build_result.get(db_session, *key)
+                after_commit(
+                    db_session,
+                    lambda: self.claim_build(
+                        conn,
+                        task_id,
+                        key,
+                        (cached.out_path, cached.builder_task_id) if cached else None,
+                        update.invalid_out_path is not None,
+                    ),
+                )
+            case models_task.BuildFinishedUpdate():
+                key = self.build_coordinator.building(task_id)
+                if key is not None and update.out_path:
+                    crud.build_result.record(db_session, *key, update.out_path, task_id)
+                after_commit(
+                    db_session,
+                    lambda: self.send_task_replies(
+                        self.build_coordinator.finish(task_id, update.out_path)
+                    ),
+                )
+            case models_task.DeployStageClaimUpdate(stage=stage):
+                if stage == "activate" and not self.rollout_gate.request_activation(
+                    db_session, task
+                ):
+                    # admitted or cancelled by the rollout gate later
+                    after_commit(db_session, lambda: self.task_waiting(task_id))
+                else:
+                    after_commit(
+                        db_session, lambda: self.grant_stage(conn, task_id, stage)
+                    )
+            case models_task.DeployStageFinishedUpdate(stage=stage):
+                after_commit(db_session, lambda: self.release_stage(task_id, stage))
+            case models_task.DeployUpToDateCheckUpdate():
+                deployment_info = crud.deployment_info.get_by_id(
+                    db_session, update.deployment_info_id
+                )
+                running = self.controller.network_relay.running_build_hash(
+                    deployment_info.ssh_public_key
+                )
+                up_to_date = running == store_path_hash(update.toplevel)
+                if up_to_date:
+                    # what the switch result would record, without the switch
+                    submission_data = task.task_submission_data
+                    crud.deployment_info.update(
+                        db_session,
+                        deployment_info.id,
+                        deployed_config_id=submission_data["device"]["identifier"],
+                        deployed_config_commit=submission_data["config_commit"],
+                        pending_config_id=None,
+                    )
+                    task.devices_skipped = 1
+                    task.deploy_time_saved_seconds = sum(
+                        self.deploy_stages.mean_run_seconds(stage)
+                        for stage in ("copy", "activate")
+                    )
+                reply(models_task.DeployUpToDateResult(up_to_date=up_to_date))
+            case models_task.AgentQueryStorePathsUpdate():
+                deployment_info = crud.deployment_info.get_by_id(
+                    db_session, update.deployment_info_id
+                )
+                ssh_public_key = deployment_info.ssh_public_key
+                after_commit(
+                    db_session,
+                    lambda: self.query_store_paths(ssh_public_key, task_id, update),
+                )
+            case models_task.ClosureTransferStatsUpdate():
+                task.closure_transfer_stats = update.stats.model_dump(mode="json")
+            case models_task.AgentShouldFetchClosureUpdate():
+                deployment_info = crud.deployment_info.get_by_id(
+                    db_session, update.deployment_info_id
+                )
+                # querying the closure takes a while, not in the update writer
+                fetch = threading.Thread(
+                    target=self.fetch_closure,
+                    args=(task_id, deployment_info.ssh_public_key, update.store_path),
+                    daemon=True,
+                )
+                after_commit(db_session, fetch.start)
+            case _:
+                assert_never(update)
+
+    def send_to_agent(
+        self,
+        db_session: sqlalchemy.orm.Session,
+        relay_con,
+        message: BaseModel,
+    ):
+        """Send a message to an agent once the transaction of db_session committed"""
+        text = agent.RelayToAgentMessage(inner=message).model_dump_json()
+        after_commit(
+            db_session,
+            lambda: asyncio.run_coroutine_threadsafe(
+                relay_con.send_text(text), self.controller.network_relay.loop
+            ),
+        )
+
+    def submit_child_task(
+        self,
+        task_submission: models_task.TaskSubmissionData,
+        user_session_id: uuid.UUID | None,
+    ):
+        with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
+            self.controller.submit(task_submission, user_session_id, db_session)
+
+    def claim_build(
+        self,
+        conn: Connection,
+        task_id: uuid.UUID,
+        key: BuildKey,
+        cached: tuple[str, uuid.UUID | None] | None,
+        cached_invalid: bool,
+    ):
+        if cached_invalid:
+            self.build_coordinator.cached_result_invalid()
+        claim = self.build_coordinator.claim(task_id, key, cached)
+        if claim.status == "cached":
             with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
-                task = crud_task.get_task_by_id(db_session, task_id)
-                self.on_new_task.notify(task)
-
-            while True:
-                message_avail = conn.poll(0.5)
-                if not message_avail:
-                    if not task_id in self.futures:
-                        logger.info("Task %s no longer in futures", task_id)
-                        break
-                    if not self.futures[task_id][0].running():
-                        logger.error(
-                            "Task %s future is not running, no message available, but future is not popped",
-                            task_id,
+                result = crud.build_result.get(db_session, *key)
+                if result is not None:
+                    crud.build_result.record_hit(db_session, result)
+                    db_session.commit()
+        conn.send(models_task.ControllerToRunnerTaskUpdate(inner=claim))
+
+    def grant_stage(
+        self, conn: Connection, task_id: uuid.UUID, stage: models_task.DeployStage
+    ):
+        # marked before asking, a slot freed in between resumes the task
+        self.scheduler.task_waiting(task_id)
+        if self.deploy_stages.acquire(task_id, stage):
+            self.scheduler.task_resumed(task_id)
+            conn.send(
+                models_task.ControllerToRunnerTaskUpdate(
+                    inner=models_task.DeployStageGranted(stage=stage)
+                )
+            )
+        else:
+            self.scheduler.dispatch()
+
+    def release_stage(self, task_id: uuid.UUID, stage: models_task.DeployStage):
+        self.send_task_replies(self.deploy_stages.release(task_id, stage))
+        # a released build slot can start a queued build task
+        self.scheduler.dispatch()
+
+    def task_waiting(self, task_id: uuid.UUID):
+        # the worker idles until it gets a reply, another task may use its place
+        self.scheduler.task_waiting(task_id)
+        self.scheduler.dispatch()
+
+    def query_store_paths(
+        self,
+        ssh_public_key: str,
+        task_id: uuid.UUID,
+        update: models_task.AgentQueryStorePathsUpdate,
+    ):
+        network_relay = self.controller.network_relay
+        relay_con = network_relay.registered_agent_connections.get(
+            network_relay.public_key_to_connection_id.get(ssh_public_key)
+        )
+        if relay_con is None:
+            # a transfer resumes once the agent is back, see agent_connected
+            with self._pending_store_queries_lock:
+                self._pending_store_queries.setdefault(ssh_public_key, []).append(
+                    (task_id, update)
+                )
+            return
+        # all batches are sent at once, the agent answers each of them
+        for start in range(0, len(update.paths), STORE_PATH_QUERY_BATCH_SIZE):
+            asyncio.run_coroutine_threadsafe(
+                relay_con.send_text(
+                    agent.RelayToAgentMessage(
+                        inner=agent.RtEQueryStorePathsMessage(
+                            paths=update.paths[
+                                start : start + STORE_PATH_QUERY_BATCH_SIZE
+                            ],
+                            task_id=task_id,
+                            query_id=update.query_id,
                         )
-                    continue
-                message = conn.recv()
-                try:
-                    if not isinstance(
-                        message, models_task.RunnerToControllerTaskUpdate
-                    ):
-                        logger.error(
-                            "Received invalid message from worker: %s", message
+                    ).model_dump_json()
+                ),
+                network_relay.loop,
+            )
+
+    def agent_connected(self, ssh_public_key: str):
+        """Send the store path queries that waited for the agent"""
+        with self._pending_store_queries_lock:
+            pending = self._pending_store_queries.pop(ssh_public_key, [])
+        for task_id, update in pending:
+            if task_id in self.futures:
+                self.query_store_paths(ssh_public_key, task_id, update)
+
+    def fetch_closure(self, task_id: uuid.UUID, ssh_public_key: str, store_path: str):
+        """Publish the closure in the binary cache and let the agent fetch it"""
+        try:
+            paths = self.binary_cache.publish(store_path)
+            logger.info("Published %s paths of %s", paths, store_path)
+            relay_con_id = self.controller.network_relay.public_key_to_connection_id[
+                ssh_public_key
+            ]
+            relay_con = self.controller.network_relay.registered_agent_connections[
+                relay_con_id
+            ]
+            asyncio.run_coroutine_threadsafe(
+                relay_con.send_text(
+                    agent.RelayToAgentMessage(
+                        inner=agent.RtEFetchClosureMessage(
+                            store_path=store_path,
+                            trusted_public_key=self.binary_cache.signing_key.public_key,
+                            task_id=task_id,
                         )
-                        continue
-                    with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
-                        task = crud_task.get_task_by_id(db_session, message.id)
-                        if task is None:
-                            logger.error(
-                                "Received message for unknown task: %s", message
-                            )
-                            continue
-                        # logger.info("Received message from worker: %s", message)
-                        match message.update:
-                            case models_task.TaskPickedUpdate():
-                                task.start_time = datetime.now(timezone.utc)
-                                task.state = "running"
-                                db_session.commit()
-                            case models_task.TaskRejectedUpdate(reason=reason):
-                                task.state = "failed"
-                                task.add_exception(f"Task rejected: {reason}")
-                                task.end_time = datetime.now(timezone.utc)
-                                db_session.commit()
-                            case models_task.TaskStdOutErrUpdate(
-                                stdoutb64=stdoutb64, stderrb64=stderrb64
-                            ):
-                                process = task.get_process_by_index(
-                                    message.update.process_index
-                                )
-                                if process is None:
-                                    process = db_models.TaskProcess(
-                                        task_id=task_id,
-                                        process_index=message.update.process_index,
-                                    )
-                                    task.processes.append(process)
-
-                                # initialize stdout and stderr if not already set
-                                if process.process_stdout is None:
-                                    process.process_stdout = b""
-                                if process.process_stderr is None:
-                                    process.process_stderr = b""
-                                # append new data to stdout and stderr
-                                process.process_stdout += base64.b64decode(stdoutb64)
-                                process.process_stderr += base64.b64decode(stderrb64)
-                                db_session.commit()
-                                self.on_task_output.notify(task)
-                            case models_task.TaskNixStatusUpdate(status=status):
-                                process = task.get_process_by_index(
-                                    message.update.process_index
-                                )
-                                if process is None:
-                                    process = db_models.TaskProcess(
-                                        task_id=task_id,
-                                        process_index=message.update.process_index,
-                                    )
-                                    task.processes.append(process)
-                                process.nix_status = status.model_dump(
-                                    include=("done", "expected", "running", "failed")
-                                )
-                                process.nix_errors = status.model_dump(
-                                    include=("errors")
-                                )["errors"]
-                                process.nix_error_logs = status.logs_by_level.get(0)
-                                process.nix_warning_logs = status.logs_by_level.get(1)
-                                process.nix_notice_logs = status.logs_by_level.get(2)
-                                process.nix_info_logs = status.logs_by_level.get(3)
-                                db_session.commit()
-                                self.on_task_output.notify(task)
-                            case models_task.TaskCompletedUpdate():
-                                # task.state = "completed"
-                                if not task.children:
-                                    task.state = "completed"
-                                    task.end_time = datetime.now(timezone.utc)
-                                db_session.commit()
-                                conn.close()
-                                break
-                            case models_task.TaskFailedUpdate(reason=reason):
-                                submission_data = task.task_submission_data or {}
-                                device = submission_data.get("device", {})
-                                deployment_info_id = device.get("deployment_info_id")
-                                source_identifier = device.get("source_identifier")
-                                if (
-                                    task.task_type == "deploy_device_task"
-                                    and source_identifier
-                                    and deployment_info_id
-                                ):
-                                    crud.deployment_info.update(
-                                        db_session,
-                                        uuid.UUID(deployment_info_id),
-                                        pending_config_id=None,
-                                    )
-                                task.state = "failed"
-                                task.add_exception(reason)
-                                task.end_time = datetime.now(timezone.utc)
-                                logger.error("Task %s failed: %s", task_id, reason)
-                                db_session.commit()
-                                conn.close()
-                                break
-                            case models_task.CommandRunUpdate():
-                                process = db_models.TaskProcess(
-                                    task_id=task_id,
-                                    process_index=message.update.process_index,
-                                    process_program=message.update.args[0],
-                                    process_args=message.update.args[1:],
-                                    process_env=message.update.env,
-                                )
-                                task.processes.append(process)
-                                db_session.commit()
-                            case models_task.ImageBuiltUpdate():
-                                crud.agent_token.create(
-                                    db_session,
-                                    original_disk_config_commit=message.update.configuration_commit,
-                                    original_disk_config_id=message.update.configuration_id,
-                                    token=message.update.token,
-                                )
-
-                                if message.update.image_format == "nixos-vm":
-                                    # start a new task to start the VM
-                                    if task.task_submission_data is None:
-                                        raise ValueError("Task submission data is None")
-                                    if "project_path" not in task.task_submission_data:
-                                        raise ValueError(
-                                            "project_path not in task submission data"
-                                        )
-
-                                    new_task_submission = models_task.RunNixOSVMTaskSubmission(
-                                        configuration_id=message.update.configuration_id,
-                                        parent_task_id=task_id,
-                                        project_path=task.task_submission_data[
-                                            "project_path"
-                                        ],
-                                    )
-                                    new_task = self.controller.submit(
-                                        new_task_submission,
-                                        task.user_session_id,
-                                        db_session,
-                                    )
-                                    db_session.commit()
-                                else:
-                                    self.controller.notification_manager.broadcast_image_built_notification(
-                                        task.user_session_id,
-                                        message.update.configuration_id,
-                                        message.update.image_format,
-                                    )
-                            case (
-                                models_task.AgentShouldSwitchToNewConfigurationUpdate()
-                            ):
-                                deployment_info = crud.deployment_info.get_by_id(
-                                    db_session, message.update.deployment_info_id
-                                )
-                                relay_con_id = self.controller.network_relay.public_key_to_connection_id[
-                                    deployment_info.ssh_public_key
-                                ]
-                                relay_con = self.controller.network_relay.registered_agent_connections[
-                                    relay_con_id
-                                ]
-                                logger.info(
-                                    "Switching agent to new configuration: %s",
-                                    message.update.path_to_configuration,
-                                )
-                                asyncio.run_coroutine_threadsafe(
-                                    relay_con.send_text(
-                                        agent.RelayToAgentMessage(
-                                            inner=agent.RtESwitchToNewConfigMessage(
-                                                new_path_to_config=message.update.path_to_configuration,
-                                                configuration_id=message.update.configuration_id,
-                                                config_commit=message.update.config_commit,
-                                                task_id=task_id,
-                                            )
-                                        ).model_dump_json()
-                                    ),
-                                    self.controller.network_relay.loop,
-                                )
-                            case models_task.WorkerRequestsSecretsUpdate():
-                                # message.update.secret_ids
-                                secrets = self.controller.project.get_processed_secrets(
-                                    db_session,
-                                    message.update.secret_ids,
-                                    message.update.target_recipient_token,
-                                )
-                                conn.send(
-                                    models_task.ControllerToRunnerTaskUpdate(
-                                        inner=models_task.SecretsResult(
-                                            secrets=secrets,
-                                        )
-                                    )
-                                )
-                            case models_task.AgentShouldReceiveNewSecretsUpdate():
-                                # message.update.secret_ids
-                                secrets = self.controller.project.get_processed_secrets(
-                                    db_session,
-                                    [s.secret_id for s in message.update.secrets],
-                                    ssh.Recipient.from_str(
-                                        message.update.target_recipient_ssh_pubkey
-                                    ),
-                                )
-                                # send to agent
-                                relay_con_id = self.controller.network_relay.public_key_to_connection_id[
-                                    message.update.target_recipient_ssh_pubkey
-                                ]
-                                relay_con = self.controller.network_relay.registered_agent_connections[
-                                    relay_con_id
-                                ]
-                                asyncio.run_coroutine_threadsafe(
-                                    relay_con.send_text(
-                                        agent.RelayToAgentMessage(
-                                            inner=agent.RtESendSecretsMessage(
-                                                secrets={
-                                                    k: base64.b64encode(v).decode(
-                                                        "utf-8"
-                                                    )
-                                                    for k, v in secrets.items()
-                                                },
-                                                secret_infos=message.update.secrets,
-                                            )
-                                        ).model_dump_json()
-                                    ),
-                                    self.controller.network_relay.loop,
-                                )
-
-                                conn.send(
-                                    models_task.ControllerToRunnerTaskUpdate(
-                                        inner=models_task.AgentGotNewSecretsResult(
-                                            success=True
-                                        )
-                                    )
-                                )
-
-                            case _:
-                                assert_never(message.update)
-                        db_session.commit()
-                        self.on_task_update.notify(task)
-                except Exception as e:
-                    traceback.print_exc()
-                    logger.error("Error processing message from worker: %s", e)
-                    db_session.close()
-        except EOFError:
-            logger.info("Worker connection closed")
-        except OSError as e:
-            logger.info("Worker connection closed: %s", e)
-        if message:
-            with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
-                task = crud_task.get_task_by_id(db_session, message.id)
-                self.on_task_update.notify(task)
-        conn.close()
+                    ).model_dump_json()
+                ),
+                self.controller.network_relay.loop,
+            )
+        except Exception as e:
+            logger.exception("Failed to let the agent fetch %s", store_path)
+            self.send_message_to_task(
+                task_id,
+                models_task.ControllerToRunnerTaskUpdate(
+                    inner=models_task.AgentFetchClosureResult(
+                        success=False, stdout="", stderr=f"{e}\n"
+                    )
+                ),
+            )
+
+    def admit_activation(self, task_id: uuid.UUID):
+        if self.deploy_stages.acquire(task_id, "activate"):
+            self.send_task_replies(
+                [(task_id, models_task.DeployStageGranted(stage="activate"))]
+            )
+
+    def send_task_replies(self, replies: BuildReplies | StageGrants):
+        for task_id, reply in replies:
+            if isinstance(reply, models_task.DeployStageGranted):
+                self.scheduler.task_resumed(task_id)
+            try:
+                self.send_message_to_task(
+                    task_id, models_task.ControllerToRunnerTaskUpdate(inner=reply)
+                )
+            except Exception as e:
+                logger.error("Failed to send %s to task %s: %s", reply.kind, task_id, e)
 
     def update_composite_task(self, task_id: uuid.UUID):
         with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
@@ -423,6 +790,15 @@ class TaskWorkerPoolManager:
             if not task.end_time:
                 task.end_time = datetime.now(timezone.utc)
 
+            if task.task_type == "deploy_devices_task":
+                children = crud_task.get_child_tasks(db_session, task.id)
+                task.devices_skipped = sum(
+                    child.devices_skipped or 0 for child in children
+                )
+                task.deploy_time_saved_seconds = sum(
+                    child.deploy_time_saved_seconds or 0.0 for child in children
+                )
+
             db_session.commit()
             self.on_task_update.notify(task)
 
@@ -434,11 +810,29 @@ class TaskWorkerPoolManager:
         return "\n".join([error["msg"] for error in errors if "msg" in error])
 
     def finish_task(self, future: Future):
-        task_id = self.future_to_id[future]
+        task_id = self.future_to_id.pop(future)
         future, child_out = self.futures.pop(task_id)
-        # join listen thread
-        logger.info("Task %s worker finished, joining listen thread", task_id)
-        self.listen_threads[task_id].join()
+        # the worker is free again
+        self.worker_metrics.task_finished(task_id)
+        self.scheduler.task_finished(task_id)
+        logger.info("Task %s worker finished, waiting for its updates", task_id)
+        # a worker that died or returned without a final update leaves the
+        # connection open otherwise
+        self.worker_connections.pop(task_id).close()
+        if not self.listeners.pop(task_id).drained.wait(WORKER_UPDATES_DRAIN_TIMEOUT):
+            logger.error(
+                "Updates of task %s were not committed within %s seconds",
+                task_id,
+                WORKER_UPDATES_DRAIN_TIMEOUT,
+            )
+        # after its updates, a build result the task reported is applied already
+        self.send_task_replies(self.build_coordinator.task_finished(task_id))
+        self.rollout_gate.task_finished(task_id)
+        self.send_task_replies(self.deploy_stages.task_finished(task_id))
+        # build slots of the task go to deploys waiting for their build stage
+        # or to queued build tasks
+        self.send_task_replies(self.deploy_stages.grant_waiting("build"))
+        self.scheduler.dispatch()
         logger.info("Task %s worker finished execution", task_id)
         # if task is still running in the database, mark it as failed due to worker finishing before signalling success
         with sqlalchemy.orm.Session(bind=self.db_engine) as db_session:
@@ -451,6 +845,9 @@ class TaskWorkerPoolManager:
                 )
                 return
 
+            # no more output is written, merge it into compressed blocks
+            self.output_compactor.put(task_id)
+
             if task.children:
                 self.update_composite_task(task_id)
             elif task.state == "running" or task.state == "pending":
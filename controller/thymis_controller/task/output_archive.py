@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from thymis_controller import crud, db_models
+from thymis_controller.config import global_settings
+from thymis_controller.database.compression import COMPRESSION_LEVEL, OUTPUT_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIRECTORY = "task-output-archive"
+STREAMS = ("stdout", "stderr")
+NIX_LOG_FIELDS = (
+    "nix_error_logs",
+    "nix_warning_logs",
+    "nix_notice_logs",
+    "nix_info_logs",
+)
+
+
+def archive_path(task_id: uuid.UUID) -> pathlib.Path:
+    return global_settings.PROJECT_PATH / ARCHIVE_DIRECTORY / f"{task_id}.zip"
+
+
+def write_output_archive(db_session: Session, task_id: uuid.UUID) -> bool:
+    """
+    Write the output and nix logs of a task to its archive file.
+
+    Every stream is a separate zip entry, written one block at a time.
+    Returns False if the task had nothing to archive.
+    """
+    processes = db_session.scalars(
+        select(db_models.TaskProcess).where(db_models.TaskProcess.task_id == task_id)
+    ).all()
+    path = archive_path(task_id)
+    temporary_path = path.with_suffix(".zip.tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = False
+    with zipfile.ZipFile(
+        temporary_path,
+        "w",
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=COMPRESSION_LEVEL,
+    ) as archive:
+        for process in processes:
+            index = process.process_index
+            for stream in STREAMS:
+                length = crud.task.process_output_length(
+                    db_session, task_id, index, stream
+                )
+                if length == 0:
+                    continue
+                with archive.open(f"{index}/{stream}", "w", force_zip64=True) as entry:
+                    for start in range(0, length, OUTPUT_BLOCK_SIZE):
+                        entry.write(
+                            crud.task.read_process_output(
+                                db_session,
+                                task_id,
+                                index,
+                                stream,
+                                start,
+                                start + OUTPUT_BLOCK_SIZE,
+                            )
+                        )
+                written = True
+            nix_logs = {
+                field: entries
+                for field in NIX_LOG_FIELDS
+                if (
+                    entries := crud.task.read_nix_log(db_session, task_id, index, field)
+                )
+            }
+            if nix_logs:
+                archive.writestr(f"{index}/nix_logs.json", json.dumps(nix_logs))
+                written = True
+    if written:
+        os.replace(temporary_path, path)
+    else:
+        temporary_path.unlink()
+    return written
+
+
+def restore_task_output(db_session: Session, task_id: uuid.UUID):
+    """Load archived output back into the database, the archive file is removed"""
+    task = crud.task.get_task_by_id(db_session, task_id)
+    if task.output_archived_time is None:
+        return
+    path = archive_path(task_id)
+    if path.exists():
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                index, field = name.split("/")
+                process = task.get_process_by_index(int(index))
+                if process is None:
+                    continue
+                if field == "nix_logs.json":
+                    for key, value in json.loads(archive.read(name)).items():
+                        crud.task.append_nix_log(
+                            db_session, task_id, int(index), key, value
+                        )
+                    continue
+                with archive.open(name) as entry:
+                    while block := entry.read(OUTPUT_BLOCK_SIZE):
+                        crud.task.append_process_output(
+                            db_session, task_id, int(index), field, block
+                        )
+    elif global_settings.TASK_OUTPUT_ARCHIVE:
+        logger.warning("Archived output of task %s is missing: %s", task_id, path)
+    task.output_archived_time = None
+    task.output_restored_time = datetime.now(timezone.utc)
+    db_session.commit()
+    path.unlink(missing_ok=True)
+
+
+def archive_output_batch(session: Session, cutoff: datetime) -> int:
+    """
+    Archive or drop the output of up to TASK_OUTPUT_ARCHIVE_BATCH_SIZE tasks
+    that finished before cutoff in one transaction, returns their number
+    """
+    task_ids = crud.task.get_tasks_with_expired_output(
+        session, cutoff, global_settings.TASK_OUTPUT_ARCHIVE_BATCH_SIZE
+    )
+    for task_id in task_ids:
+        if global_settings.TASK_OUTPUT_ARCHIVE:
+            write_output_archive(session, task_id)
+        crud.task.clear_task_output(session, task_id, datetime.now(timezone.utc))
+    session.commit()
+    return len(task_ids)
+
+
+async def archive_expired_task_output(session: Session) -> int:
+    """
+    Archive or drop the output of tasks that finished more than
+    TASK_OUTPUT_RETENTION_DAYS ago, a small batch of tasks per transaction.
+    Batches run in a thread, reading and compressing the output of a task
+    would block the event loop.
+    """
+    if global_settings.TASK_OUTPUT_RETENTION_DAYS is None:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        days=global_settings.TASK_OUTPUT_RETENTION_DAYS
+    )
+    total = 0
+    while archived := await asyncio.to_thread(archive_output_batch, session, cutoff):
+        total += archived
+        await asyncio.sleep(0.1)  # let other writers use the database
+    if total:
+        logger.info(
+            "%s the output of %d tasks older than %d days",
+            "Archived" if global_settings.TASK_OUTPUT_ARCHIVE else "Deleted",
+            total,
+            global_settings.TASK_OUTPUT_RETENTION_DAYS,
+        )
+    return total
@@ -0,0 +1,69 @@
+import dataclasses
+import struct
+import uuid
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import ForkingPickler
+
+# Process output is sent as raw frames with `Connection.send_bytes` instead of
+# a base64 encoded, pickled TaskStdOutErrUpdate. Every other message is still
+# pickled; a pickle starts with the PROTO opcode (0x80), so it never matches
+# the frame magic.
+OUTPUT_FRAME_MAGIC = b"TOUT"
+# magic, task id, process index, stdout length, stderr length
+OUTPUT_FRAME_HEADER = struct.Struct("!4s16sIII")
+
+
+@dataclasses.dataclass
+class TaskOutputFrame:
+    task_id: uuid.UUID
+    process_index: int
+    stdout: bytes
+    stderr: bytes
+
+
+def encode_output_frame(
+    task_id: uuid.UUID, process_index: int, stdout: bytes, stderr: bytes
+) -> bytearray:
+    frame = bytearray(OUTPUT_FRAME_HEADER.size + len(stdout) + len(stderr))
+    OUTPUT_FRAME_HEADER.pack_into(
+        frame,
+        0,
+        OUTPUT_FRAME_MAGIC,
+        task_id.bytes,
+        process_index,
+        len(stdout),
+        len(stderr),
+    )
+    stdout_end = OUTPUT_FRAME_HEADER.size + len(stdout)
+    frame[OUTPUT_FRAME_HEADER.size : stdout_end] = stdout
+    frame[stdout_end:] = stderr
+    return frame
+
+
+def send_output(
+    conn: Connection,
+    task_id: uuid.UUID,
+    process_index: int,
+    stdout: bytes,
+    stderr: bytes,
+):
+    conn.send_bytes(encode_output_frame(task_id, process_index, stdout, stderr))
+
+
+def decode_message(buf: bytes) -> TaskOutputFrame | object:
+    """Decode a message received with `Connection.recv_bytes`"""
+    if not buf.startswith(OUTPUT_FRAME_MAGIC):
+        return ForkingPickler.loads(buf)
+    _, task_id, process_index, stdout_len, stderr_len = OUTPUT_FRAME_HEADER.unpack_from(
+        buf
+    )
+    view = memoryview(buf)
+    stdout_end = OUTPUT_FRAME_HEADER.size + stdout_len
+    if stdout_end + stderr_len != len(buf):
+        raise ValueError("Output frame length does not match its header")
+    return TaskOutputFrame(
+        task_id=uuid.UUID(bytes=task_id),
+        process_index=process_index,
+        stdout=bytes(view[OUTPUT_FRAME_HEADER.size : stdout_end]),
+        stderr=bytes(view[stdout_end:]),
+    )
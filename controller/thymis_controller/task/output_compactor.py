@@ -0,0 +1,59 @@
+import logging
+import queue
+import threading
+import uuid
+from typing import TYPE_CHECKING, Optional
+
+import sqlalchemy.orm
+import thymis_controller.crud.task as crud_task
+
+if TYPE_CHECKING:
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+logger = logging.getLogger(__name__)
+
+
+class TaskOutputCompactor:
+    """
+    Merges the output of finished tasks into compressed blocks on its own
+    thread, one task at a time.
+
+    Each block is committed on its own, so the task update writer waits for
+    one block at most instead of the whole output of a task.
+    """
+
+    def __init__(self, manager: "TaskWorkerPoolManager"):
+        self.manager = manager
+        self.queue: queue.Queue[Optional[uuid.UUID]] = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="task-output-compactor", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """Compact the tasks queued so far and stop"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, task_id: uuid.UUID):
+        self.start()
+        self.queue.put(task_id)
+
+    def run(self):
+        while (task_id := self.queue.get()) is not None:
+            try:
+                with sqlalchemy.orm.Session(bind=self.manager.db_engine) as db_session:
+                    crud_task.compact_process_output(db_session, task_id)
+                    crud_task.compact_nix_logs(db_session, task_id)
+            except Exception:
+                logger.exception("Failed to compact the output of task %s", task_id)
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import TYPE_CHECKING, AsyncIterator, Literal, Optional
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+from thymis_controller import crud, db_models
+from thymis_controller.task.update_writer import TaskOutputDelta
+from thymis_controller.utils import complete_utf8_length
+
+if TYPE_CHECKING:
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+logger = logging.getLogger(__name__)
+
+# largest range served by a single output request
+MAX_OUTPUT_RANGE_BYTES = 8 * 1024 * 1024
+# largest piece of output read from the database for one follow event
+FOLLOW_READ_SIZE = 64 * 1024
+# a comment is sent after this many seconds without output, so proxies keep
+# the connection open and disconnected clients are noticed
+FOLLOW_KEEPALIVE_INTERVAL = 15.0
+
+FINISHED_STATES = ("completed", "failed")
+
+
+def resolve_output_range(
+    length: int,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    tail: Optional[int] = None,
+) -> tuple[int, int]:
+    """
+    Turn the requested range into [start, end) within a stream of `length`
+    bytes. `tail` selects the last bytes of the stream and takes precedence,
+    ranges are capped at MAX_OUTPUT_RANGE_BYTES from their start.
+    """
+    if tail is not None:
+        start = max(length - tail, 0)
+        end = length
+    start = min(start or 0, length)
+    end = length if end is None else max(min(end, length), start)
+    return start, min(end, start + MAX_OUTPUT_RANGE_BYTES)
+
+
+def content_range(start: int, end: int, length: int) -> str:
+    if start == end:
+        return f"bytes */{length}"
+    return f"bytes {start}-{end - 1}/{length}"
+
+
+def sse_event(event: str, data, event_id: Optional[int] = None) -> str:
+    # data is JSON encoded, so it never spans more than one `data:` line
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class TaskOutputFollower:
+    """
+    Streams one output stream of a task process as server-sent events.
+
+    Only the read offset is kept, new output is read from the database in
+    pieces of at most FOLLOW_READ_SIZE bytes when the update writer reports
+    that it was committed. Memory stays bounded no matter how much output
+    the process writes or how slow the client reads. The id of every output
+    event is the offset the stream continues at, clients send it back as
+    `Last-Event-ID` to resume.
+    """
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        executor: "TaskWorkerPoolManager",
+        task_id: uuid.UUID,
+        process_index: int,
+        stream: Literal["stdout", "stderr"],
+        offset: int = 0,
+    ):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.db_engine = db_engine
+        self.executor = executor
+        self.task_id = task_id
+        self.process_index = process_index
+        self.stream = stream
+        self.offset = offset
+        # trailing bytes of an incomplete utf-8 character
+        self.held = b""
+
+    def connect(self):
+        self.executor.on_task_output.subscribe(self.notify_task_output)
+        self.executor.on_task_update.subscribe(self.notify_task_update)
+
+    def disconnect(self):
+        self.executor.on_task_output.unsubscribe(self.notify_task_output)
+        self.executor.on_task_update.unsubscribe(self.notify_task_update)
+
+    def notify_task_output(self, delta: TaskOutputDelta):
+        if delta.task_id != self.task_id:
+            return
+        process_delta = delta.processes.get(self.process_index)
+        if process_delta is not None and self.stream in process_delta.appended:
+            self.loop.call_soon_threadsafe(self.changed.set)
+
+    def notify_task_update(self, task: db_models.Task):
+        if task.id == self.task_id:
+            self.loop.call_soon_threadsafe(self.changed.set)
+
+    def read(self) -> tuple[Optional[str], bytes]:
+        # the state is read first, output committed together with the final
+        # state is then always read before the stream is considered finished
+        with Session(self.db_engine) as db_session:
+            state = crud.task.get_task_state(db_session, self.task_id)
+            data = crud.task.read_process_output(
+                db_session,
+                self.task_id,
+                self.process_index,
+                self.stream,
+                self.offset,
+                self.offset + FOLLOW_READ_SIZE,
+            )
+        return state, data
+
+    def take_text(self, data: bytes, final: bool = False) -> str:
+        data = self.held + data
+        complete = len(data) if final else complete_utf8_length(data)
+        self.held = data[complete:]
+        return data[:complete].decode("utf-8", errors="replace")
+
+    async def events(self) -> AsyncIterator[str]:
+        self.connect()
+        try:
+            while True:
+                self.changed.clear()
+                state, data = await asyncio.to_thread(self.read)
+                if state is None:
+                    yield sse_event("error", f"Task with id {self.task_id} not found")
+                    return
+                if data:
+                    self.offset += len(data)
+                    text = self.take_text(data)
+                    if text:
+                        yield sse_event(
+                            "output", text, event_id=self.offset - len(self.held)
+                        )
+                    continue
+                if state in FINISHED_STATES:
+                    if self.held:
+                        yield sse_event(
+                            "output", self.take_text(b"", final=True), self.offset
+                        )
+                    yield sse_event("end", state)
+                    return
+                try:
+                    await asyncio.wait_for(
+                        self.changed.wait(), FOLLOW_KEEPALIVE_INTERVAL
+                    )
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.disconnect()
@@ -0,0 +1,241 @@
+import collections
+import logging
+import math
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Literal, Optional
+
+import sqlalchemy.orm
+from sqlalchemy.orm import Session
+from thymis_controller import crud, db_models, models
+from thymis_controller.config import global_settings
+from thymis_controller.crud import fleet_alert as crud_fleet_alert
+from thymis_controller.models.task import parse_wave_size
+
+if TYPE_CHECKING:
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+logger = logging.getLogger(__name__)
+
+type ActivationState = Literal["open", "wait", "halt"]
+
+
+def rollout_wave_sizes(devices: int, specs: list[str]) -> list[int]:
+    """Split the devices into waves of the given sizes, the rest is the last wave"""
+    sizes = []
+    remaining = devices
+    for spec in specs:
+        if remaining == 0:
+            break
+        value, percent = parse_wave_size(spec)
+        size = math.ceil(devices * value / 100) if percent else int(value)
+        size = min(max(size, 1), remaining)
+        sizes.append(size)
+        remaining -= size
+    if remaining:
+        sizes.append(remaining)
+    return sizes
+
+
+def _aware(dt):
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+def rollout_wave(task: db_models.Task) -> int:
+    return (task.task_submission_data or {}).get("rollout_wave") or 0
+
+
+def device_health_problem(
+    db_session: Session, task: db_models.Task, alerts: list[models.FleetAlert]
+) -> Optional[str]:
+    """Why the device a completed deploy task activated on is not healthy, if it is not"""
+    submission_data = task.task_submission_data
+    name = task.device_identifier or str(task.id)
+    deployment_info_id = uuid.UUID(submission_data["device"]["deployment_info_id"])
+    deployment_info = crud.deployment_info.get_by_id(db_session, deployment_info_id)
+    if deployment_info is None:
+        return f"{name} no longer exists"
+    # agents before config commits were reported do not send it
+    if deployment_info.deployed_config_commit not in (
+        None,
+        submission_data["config_commit"],
+    ):
+        return f"{name} does not run the new configuration"
+    if not crud.agent_connection.is_connected(db_session, deployment_info_id) or (
+        deployment_info.last_seen is None
+        or _aware(deployment_info.last_seen) < _aware(task.end_time)
+    ):
+        return f"{name} did not reconnect"
+    for alert in alerts:
+        if (
+            alert.deployment_info_id == deployment_info_id
+            and alert.severity == "critical"
+        ):
+            return f"{name}: {alert.detail}"
+    return None
+
+
+class RolloutWaves:
+    """
+    The waves of one rollout, counted by state in one query. Loaded once per
+    check and shared by the tasks of the rollout, only the tasks of the wave
+    a decision depends on are loaded.
+    """
+
+    def __init__(self, db_session: Session, parent_task_id: uuid.UUID):
+        self.db_session = db_session
+        self.parent_task_id = parent_task_id
+        self.states: dict[int, collections.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.finished: dict[int, datetime] = {}
+        for wave, state, count, end_time in crud.task.child_wave_states(
+            db_session, parent_task_id
+        ):
+            self.states[wave][state] += count
+            if end_time is not None:
+                self.finished[wave] = max(
+                    self.finished.get(wave, _aware(end_time)), _aware(end_time)
+                )
+        self._decided: dict[int, tuple[ActivationState, Optional[str]]] = {}
+
+    def activation_state(self, wave: int) -> tuple[ActivationState, Optional[str]]:
+        if wave not in self._decided:
+            self._decided[wave] = self._activation_state(wave)
+        return self._decided[wave]
+
+    def _activation_state(self, wave: int) -> tuple[ActivationState, Optional[str]]:
+        earlier = sorted(other for other in self.states if other < wave)
+        if not earlier:
+            return "open", None
+        if failed_waves := [other for other in earlier if self.states[other]["failed"]]:
+            failed = crud.task.get_child_tasks_in_wave(
+                self.db_session, self.parent_task_id, failed_waves[0], "failed"
+            )
+            return "halt", f"deploying {failed[0].device_identifier} failed"
+        if any(
+            self.states[other]["completed"] != self.states[other].total()
+            for other in earlier
+        ):
+            return "wait", None
+
+        previous_wave = earlier[-1]
+        previous = crud.task.get_child_tasks_in_wave(
+            self.db_session, self.parent_task_id, previous_wave
+        )
+        alerts = crud_fleet_alert.get_fleet_alerts(self.db_session)
+        for sibling in previous:
+            if problem := device_health_problem(self.db_session, sibling, alerts):
+                break
+        else:
+            return "open", None
+        timeout = timedelta(
+            seconds=global_settings.DEPLOY_ROLLOUT_HEALTH_TIMEOUT_SECONDS
+        )
+        if datetime.now(timezone.utc) - self.finished[previous_wave] > timeout:
+            return "halt", f"wave {previous_wave + 1} is not healthy, {problem}"
+        return "wait", None
+
+
+def activation_state(
+    db_session: Session,
+    task: db_models.Task,
+    rollouts: Optional[dict[uuid.UUID, RolloutWaves]] = None,
+) -> tuple[ActivationState, Optional[str]]:
+    """
+    Whether a deploy task may activate: once every task of the earlier waves
+    of its rollout completed and the devices of the previous wave are healthy.
+    Halts with the reason if an earlier task failed or the previous wave is
+    not healthy in time.
+
+    rollouts: the waves loaded so far by parent task, shared between calls
+    """
+    wave = rollout_wave(task)
+    if wave == 0 or task.parent_task_id is None:
+        return "open", None
+    if rollouts is None:
+        rollouts = {}
+    if task.parent_task_id not in rollouts:
+        rollouts[task.parent_task_id] = RolloutWaves(db_session, task.parent_task_id)
+    return rollouts[task.parent_task_id].activation_state(wave)
+
+
+class RolloutGate:
+    """
+    Holds the activation of deploy tasks until the earlier waves of their
+    rollout are done and healthy.
+
+    A fleet deploy with rollout waves gives each of its device tasks a wave.
+    All of them evaluate, build and copy as usual, so later waves are
+    prefetched while earlier ones activate, but a task only gets the activate
+    stage once `activation_state` opens. Held tasks are checked again every
+    DEPLOY_ROLLOUT_POLL_INTERVAL_SECONDS and cancelled if the rollout halts.
+    """
+
+    def __init__(self, manager: "TaskWorkerPoolManager"):
+        self.manager = manager
+        self._lock = threading.Lock()
+        self._held: set[uuid.UUID] = set()
+        self._stop = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def request_activation(self, db_session: Session, task: db_models.Task) -> bool:
+        """Whether the task may activate now, otherwise it is held"""
+        state, _ = activation_state(db_session, task)
+        if state == "open":
+            return True
+        with self._lock:
+            self._held.add(task.id)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="rollout-gate", daemon=True
+                )
+                self.thread.start()
+        logger.info("Task %s waits for the earlier waves of its rollout", task.id)
+        return False
+
+    def task_finished(self, task_id: uuid.UUID):
+        with self._lock:
+            self._held.discard(task_id)
+
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self._stop.wait(global_settings.DEPLOY_ROLLOUT_POLL_INTERVAL_SECONDS):
+            try:
+                self.check_held_tasks()
+            except Exception:
+                logger.exception("Failed to check held rollout tasks")
+
+    def check_held_tasks(self):
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return
+        decided: list[tuple[uuid.UUID, ActivationState, Optional[str]]] = []
+        # the held tasks of a rollout share its waves
+        rollouts: dict[uuid.UUID, RolloutWaves] = {}
+        with sqlalchemy.orm.Session(bind=self.manager.db_engine) as db_session:
+            for task_id in held:
+                task = db_session.get(db_models.Task, task_id)
+                if task is None:
+                    self.task_finished(task_id)
+                    continue
+                state, reason = activation_state(db_session, task, rollouts)
+                if state != "wait":
+                    decided.append((task_id, state, reason))
+        for task_id, state, reason in decided:
+            with self._lock:
+                if task_id not in self._held:
+                    continue
+                self._held.discard(task_id)
+            if state == "open":
+                logger.info("Rollout wave of task %s opened", task_id)
+                self.manager.admit_activation(task_id)
+            else:
+                logger.warning("Rollout of task %s halted: %s", task_id, reason)
+                self.manager.cancel_task(task_id, f"Rollout halted: {reason}")
@@ -0,0 +1,306 @@
+import collections
+import dataclasses
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Literal, Optional
+
+import thymis_controller.models.task as models_task
+from thymis_controller.task.worker_pool import WorkerPoolKind
+
+logger = logging.getLogger(__name__)
+
+type TaskPriority = Literal["interactive", "build", "deploy"]
+type TaskResource = Literal["nix_build", "nixos_vm"]
+
+# classes in the order they are served
+PRIORITIES: tuple[TaskPriority, ...] = ("interactive", "build", "deploy")
+
+TASK_PRIORITIES: dict[str, TaskPriority] = {
+    "ssh_command_task": "interactive",
+    "run_nixos_vm_task": "interactive",
+    "project_flake_update_task": "build",
+    "build_project_task": "build",
+    "build_device_image_task": "build",
+    "deploy_devices_task": "deploy",
+    "deploy_device_task": "deploy",
+    "auto_update_task": "deploy",
+}
+
+# the limited resource a task type mostly uses, tasks without one are only
+# limited by the number of workers. Deploys limit each of their stages on
+# their own, see DeployStageLimiter. VMs run until they are stopped, they
+# would hold a build slot all that time
+TASK_RESOURCES: dict[str, TaskResource] = {
+    "build_project_task": "nix_build",
+    "build_device_image_task": "nix_build",
+    "run_nixos_vm_task": "nixos_vm",
+    "auto_update_task": "nix_build",
+}
+
+# builds keep a CPU busy, the other tasks mostly wait on devices and the network
+TASK_WORKER_POOLS: dict[str, WorkerPoolKind] = {
+    "project_flake_update_task": "cpu",
+    "build_project_task": "cpu",
+    "build_device_image_task": "cpu",
+    "run_nixos_vm_task": "cpu",
+    "auto_update_task": "cpu",
+    "deploy_devices_task": "io",
+    "deploy_device_task": "io",
+    "ssh_command_task": "io",
+}
+
+
+def task_worker_pool(task_type: str) -> WorkerPoolKind:
+    return TASK_WORKER_POOLS.get(task_type, "cpu")
+
+
+class ResourceSlots:
+    """
+    Slots of a limited resource. The scheduler and the deploy stages can
+    share one, so build tasks and deploys in their build stage count against
+    the same limit.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._holders: set[uuid.UUID] = set()
+
+    def acquire(self, task_id: uuid.UUID) -> bool:
+        with self._lock:
+            if task_id not in self._holders and len(self._holders) >= self.limit:
+                return False
+            self._holders.add(task_id)
+            return True
+
+    def release(self, task_id: uuid.UUID):
+        with self._lock:
+            self._holders.discard(task_id)
+
+
+@dataclasses.dataclass
+class QueuedTask:
+    submission: models_task.TaskSubmission
+    user_session_id: Optional[uuid.UUID]
+    priority: TaskPriority
+    resource: Optional[TaskResource]
+    pool: WorkerPoolKind
+    enqueued_at: float = dataclasses.field(default_factory=time.monotonic)
+
+
+@dataclasses.dataclass
+class PriorityStats:
+    started: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class TaskScheduler:
+    """
+    Decides which submitted task gets the next worker.
+
+    Tasks wait here instead of in the process pools, so the pools never have
+    queued work of their own. Free workers go to the highest priority class
+    with a startable task. Within a class, the user with the fewest running
+    tasks goes first and ties are served round robin, the tasks of a user
+    start in submission order. A task whose resource has no free slot is
+    skipped until a slot is released. The last
+    `interactive_workers` workers of each pool only run interactive tasks,
+    so long builds and deploys cannot keep them waiting.
+
+    A running task whose worker waits for a slot, such as a deploy waiting
+    for a deploy stage, gives its place in the pool to the next task. Up to
+    `waiting_workers` tasks of a pool wait this way, the pool has that many
+    workers in addition to `workers` for them.
+
+    A task that fails to start gives up its place and is passed to
+    `start_failed`, the other tasks still start.
+    """
+
+    def __init__(
+        self,
+        start_task: Callable[[models_task.TaskSubmission], None],
+        workers: dict[WorkerPoolKind, int],
+        resources: dict[TaskResource, ResourceSlots],
+        interactive_workers: int = 0,
+        waiting_workers: Optional[dict[WorkerPoolKind, int]] = None,
+        start_failed: Optional[
+            Callable[[models_task.TaskSubmission, Exception], None]
+        ] = None,
+    ):
+        self.start_task = start_task
+        self.start_failed = start_failed
+        self.workers = workers
+        self.resources = resources
+        self.interactive_workers = interactive_workers
+        self.waiting_workers = waiting_workers or {}
+        self._lock = threading.Lock()
+        # per priority, per user, in order of the user's first queued task
+        self._queues: dict[
+            TaskPriority,
+            collections.OrderedDict[Optional[uuid.UUID], collections.deque[QueuedTask]],
+        ] = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self._running: dict[uuid.UUID, QueuedTask] = {}
+        # running tasks whose worker waits, they do not count against the pool
+        self._waiting: set[uuid.UUID] = set()
+        self._stats = {priority: PriorityStats() for priority in PRIORITIES}
+        self._stopped = False
+
+    def submit(
+        self,
+        submission: models_task.TaskSubmission,
+        user_session_id: Optional[uuid.UUID] = None,
+    ):
+        queued = QueuedTask(
+            submission=submission,
+            user_session_id=user_session_id,
+            priority=TASK_PRIORITIES.get(submission.data.type, "build"),
+            resource=TASK_RESOURCES.get(submission.data.type),
+            pool=task_worker_pool(submission.data.type),
+        )
+        with self._lock:
+            users = self._queues[queued.priority]
+            users.setdefault(user_session_id, collections.deque()).append(queued)
+        self.dispatch()
+
+    def task_finished(self, task_id: uuid.UUID):
+        with self._lock:
+            queued = self._running.pop(task_id, None)
+            self._waiting.discard(task_id)
+            if queued is not None and queued.resource in self.resources:
+                self.resources[queued.resource].release(task_id)
+        self.dispatch()
+
+    def task_waiting(self, task_id: uuid.UUID):
+        """
+        The worker of a running task waits, its place in the pool is free
+        until task_resumed. Call dispatch to start a task in it.
+        """
+        with self._lock:
+            queued = self._running.get(task_id)
+            if queued is None or task_id in self._waiting:
+                return
+            waiting = sum(
+                1 for other in self._waiting if self._running[other].pool == queued.pool
+            )
+            if waiting < self.waiting_workers.get(queued.pool, 0):
+                self._waiting.add(task_id)
+
+    def task_resumed(self, task_id: uuid.UUID):
+        with self._lock:
+            self._waiting.discard(task_id)
+
+    def cancel(self, task_id: uuid.UUID) -> bool:
+        """Remove a task that has not started yet, returns whether it was queued"""
+        with self._lock:
+            for users in self._queues.values():
+                for user, tasks in users.items():
+                    for queued in tasks:
+                        if queued.submission.id == task_id:
+                            tasks.remove(queued)
+                            if not tasks:
+                                del users[user]
+                            return True
+        return False
+
+    def stop(self):
+        # queued tasks stay pending in the database and are submitted again
+        # when the controller starts
+        with self._lock:
+            self._stopped = True
+            for users in self._queues.values():
+                users.clear()
+
+    def dispatch(self):
+        with self._lock:
+            started = []
+            while not self._stopped:
+                queued = self._take_next()
+                if queued is None:
+                    break
+                self._running[queued.submission.id] = queued
+                stats = self._stats[queued.priority]
+                wait = time.monotonic() - queued.enqueued_at
+                stats.started += 1
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                started.append(queued)
+        for queued in started:
+            logger.info("Starting %s task %s", queued.priority, queued.submission.id)
+            try:
+                self.start_task(queued.submission)
+            except Exception as e:
+                logger.exception("Failed to start task %s", queued.submission.id)
+                self.task_finished(queued.submission.id)
+                if self.start_failed is not None:
+                    self.start_failed(queued.submission, e)
+
+    def _acquire_resource(self, queued: QueuedTask) -> bool:
+        if queued.resource is None or queued.resource not in self.resources:
+            return True
+        return self.resources[queued.resource].acquire(queued.submission.id)
+
+    def _pool_available(self, pool: WorkerPoolKind, priority: TaskPriority) -> bool:
+        running = sum(
+            1
+            for task_id, task in self._running.items()
+            if task.pool == pool and task_id not in self._waiting
+        )
+        workers = self.workers.get(pool, 0)
+        if priority != "interactive":
+            # a pool with a single worker still runs every class
+            workers -= min(self.interactive_workers, workers - 1)
+        return running < workers
+
+    def _take_next(self) -> Optional[QueuedTask]:
+        running_by_user = collections.Counter(
+            task.user_session_id for task in self._running.values()
+        )
+        for priority in PRIORITIES:
+            users = self._queues[priority]
+            # users with fewer running tasks first, then round robin
+            for user in sorted(users, key=lambda user: running_by_user[user]):
+                tasks = users[user]
+                for queued in tasks:
+                    if self._pool_available(
+                        queued.pool, queued.priority
+                    ) and self._acquire_resource(queued):
+                        tasks.remove(queued)
+                        # the user goes to the back of the round
+                        del users[user]
+                        if tasks:
+                            users[user] = tasks
+                        return queued
+        return None
+
+    def stats(self) -> list[models_task.TaskQueueStats]:
+        now = time.monotonic()
+        with self._lock:
+            result = []
+            for priority in PRIORITIES:
+                queued = [
+                    task for tasks in self._queues[priority].values() for task in tasks
+                ]
+                stats = self._stats[priority]
+                result.append(
+                    models_task.TaskQueueStats(
+                        priority=priority,
+                        queued=len(queued),
+                        running=sum(
+                            1
+                            for task in self._running.values()
+                            if task.priority == priority
+                        ),
+                        started=stats.started,
+                        oldest_wait_seconds=max(
+                            (now - task.enqueued_at for task in queued), default=0.0
+                        ),
+                        mean_wait_seconds=(
+                            stats.total_wait / stats.started if stats.started else 0.0
+                        ),
+                        max_wait_seconds=stats.max_wait,
+                    )
+                )
+            return result
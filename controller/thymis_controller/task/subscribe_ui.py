@@ -3,6 +3,7 @@ import asyncio.queues
 import logging
 import threading
 import uuid
+from typing import Optional
 
 from fastapi import WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
@@ -10,9 +11,16 @@ from sqlalchemy import Engine
 from sqlalchemy.orm import Session
 from thymis_controller import crud, db_models, models
 from thymis_controller.task.controller import TaskController
+from thymis_controller.task.update_writer import TaskOutputDelta, TaskProcessDelta
+from thymis_controller.utils import complete_utf8_length, utf8_continuation_length
 
 logger = logging.getLogger(__name__)
 
+# most stdout and stderr a subscription starts with, also when resuming. The
+# page loads earlier output from
+# /tasks/{task_id}/processes/{process_index}/{stream} on demand
+SNAPSHOT_TAIL_BYTES = 256 * 1024
+
 
 class TaskMessage(BaseModel):
     type: str
@@ -29,17 +37,9 @@ class ShortTaskUpdate(TaskMessage):
     task: models.TaskShort
 
 
-class SubscribedTask(TaskMessage):
-    type: str = "subscribed_task"
-    task: models.Task
-
-
-class SubscribedTaskOutput(TaskMessage):
-    type: str = "subscribed_task_output"
-    task: models.Task
-
-
 class SubscribedTaskProcessCounter(BaseModel):
+    # bytes of stdout and stderr and entries of the nix lists sent so far,
+    # clients pass it back when subscribing again to resume from there
     send_stdout: int = 0
     send_stderr: int = 0
     send_nix_errors: int = 0
@@ -49,6 +49,38 @@ class SubscribedTaskProcessCounter(BaseModel):
     send_nix_info_logs: int = 0
 
 
+class SubscribedTask(TaskMessage):
+    type: str = "subscribed_task"
+    task: models.Task
+    cursor: dict[int, SubscribedTaskProcessCounter] = {}
+    # offset of the first byte of stdout or stderr in the snapshot, for the
+    # streams whose earlier output was left out. A resuming client replaces
+    # what it had of these streams
+    output_start: dict[int, dict[str, int]] = {}
+
+
+class TaskProcessOutput(BaseModel):
+    # only what was appended since the previous message
+    process_index: int
+    process_program: Optional[str] = None
+    process_args: Optional[list[str]] = None
+    process_env: Optional[dict[str, str]] = None
+    process_stdout: Optional[str] = None
+    process_stderr: Optional[str] = None
+    nix_status: Optional[models.NixProcessStatus] = None
+    nix_errors: Optional[list] = None
+    nix_error_logs: Optional[list[str]] = None
+    nix_warning_logs: Optional[list[str]] = None
+    nix_notice_logs: Optional[list[str]] = None
+    nix_info_logs: Optional[list[str]] = None
+
+
+class SubscribedTaskOutput(TaskMessage):
+    type: str = "subscribed_task_output"
+    processes: list[TaskProcessOutput]
+    cursor: dict[int, SubscribedTaskProcessCounter] = {}
+
+
 class TaskWebsocketSubscriber:
     def __init__(
         self, db_engine: Engine, controller: TaskController, websocket: WebSocket
@@ -63,9 +95,17 @@ class TaskWebsocketSubscriber:
         with self.process_subscribed_task_lock:
             self.reset_subscribed_task(None)
 
-    def reset_subscribed_task(self, task_id: uuid.UUID | None):
+    def reset_subscribed_task(
+        self,
+        task_id: uuid.UUID | None,
+        cursor: dict[int, SubscribedTaskProcessCounter] | None = None,
+    ):
         self.subscribed_task = task_id
-        self.process_counter: dict[int, SubscribedTaskProcessCounter] = {}
+        self.process_counter: dict[int, SubscribedTaskProcessCounter] = dict(
+            cursor or {}
+        )
+        # trailing bytes of an incomplete utf-8 character, per process and stream
+        self.held_output: dict[tuple[int, str], bytes] = {}
 
     def connect(self):
         self.controller.executor.on_new_task.subscribe(self.notify_new_task)
@@ -107,66 +147,155 @@ class TaskWebsocketSubscriber:
             message = await self.websocket.receive_json()
             if "type" in message and message["type"] == "subscribe_task":
                 task_id = uuid.UUID(message["task_id"])
+                cursor = {
+                    int(process_index): SubscribedTaskProcessCounter.model_validate(
+                        counter
+                    )
+                    for process_index, counter in (message.get("cursor") or {}).items()
+                }
                 async with self.send_lock:
                     with self.process_subscribed_task_lock:
-                        self.reset_subscribed_task(task_id)
+                        self.reset_subscribed_task(task_id, cursor)
                         with Session(self.db_engine) as db_session:
-                            task = self.controller.get_task(task_id, db_session)
-                        subscribed_task = self.create_subscribed_task(task)
+                            task = crud.task.get_task_by_id(db_session, task_id)
+                            subscribed_task, output_start = self.create_subscribed_task(
+                                db_session, task
+                            )
+                        cursor = self.copy_cursor()
                     await self.websocket.send_json(
                         SubscribedTask(
-                            task_id=task_id, task=subscribed_task
+                            task_id=task_id,
+                            task=subscribed_task,
+                            cursor=cursor,
+                            output_start=output_start,
                         ).model_dump(mode="json")
                     )
 
-    def create_subscribed_task(self, db_task: db_models.Task):
-        # pylint: disable=attribute-defined-outside-init
-        task = models.Task.from_orm_task(db_task)
+    def copy_cursor(self) -> dict[int, SubscribedTaskProcessCounter]:
+        return {
+            process_index: counter.model_copy()
+            for process_index, counter in self.process_counter.items()
+        }
+
+    def get_counter(self, process_index: int) -> SubscribedTaskProcessCounter:
+        if process_index not in self.process_counter:
+            self.process_counter[process_index] = SubscribedTaskProcessCounter()
+        return self.process_counter[process_index]
+
+    def create_subscribed_task(
+        self, db_session: Session, db_task: db_models.Task
+    ) -> tuple[models.Task, dict[int, dict[str, int]]]:
+        # output is read from the resume offsets on, not loaded as a whole
+        task = models.Task.from_orm_task(db_task, include_output=False)
+        output_start: dict[int, dict[str, int]] = {}
 
         for process in task.processes:
-            if process.process_index not in self.process_counter:
-                self.process_counter[
-                    process.process_index
-                ] = SubscribedTaskProcessCounter()
-
-            counter = self.process_counter[process.process_index]
-            if process.process_stdout:
-                size = len(process.process_stdout)
-                process.process_stdout = process.process_stdout[counter.send_stdout :]
-                counter.send_stdout = size
-            if process.process_stderr:
-                size = len(process.process_stderr)
-                process.process_stderr = process.process_stderr[counter.send_stderr :]
-                counter.send_stderr = size
-            if process.nix_errors:
-                size = len(process.nix_errors)
-                process.nix_errors = process.nix_errors[counter.send_nix_errors :]
-                counter.send_nix_errors = size
-            if process.nix_error_logs:
-                size = len(process.nix_error_logs)
-                process.nix_error_logs = process.nix_error_logs[
-                    counter.send_nix_error_logs :
-                ]
-                counter.send_nix_error_logs = size
-            if process.nix_warning_logs:
-                size = len(process.nix_warning_logs)
-                process.nix_warning_logs = process.nix_warning_logs[
-                    counter.send_nix_warning_logs :
-                ]
-                counter.send_nix_warning_logs = size
-            if process.nix_notice_logs:
-                size = len(process.nix_notice_logs)
-                process.nix_notice_logs = process.nix_notice_logs[
-                    counter.send_nix_notice_logs :
-                ]
-                counter.send_nix_notice_logs = size
-            if process.nix_info_logs:
-                size = len(process.nix_info_logs)
-                process.nix_info_logs = process.nix_info_logs[
-                    counter.send_nix_info_logs :
-                ]
-                counter.send_nix_info_logs = size
-        return task
+            counter = self.get_counter(process.process_index)
+            for stream in ("stdout", "stderr"):
+                sent = getattr(counter, f"send_{stream}")
+                length = crud.task.process_output_length(
+                    db_session, db_task.id, process.process_index, stream
+                )
+                tail_start = (
+                    length - SNAPSHOT_TAIL_BYTES
+                    if length - sent > SNAPSHOT_TAIL_BYTES
+                    else None
+                )
+                data = crud.task.read_process_output(
+                    db_session,
+                    db_task.id,
+                    process.process_index,
+                    stream,
+                    sent if tail_start is None else tail_start,
+                )
+                if tail_start is not None:
+                    # start at a character boundary
+                    skipped = utf8_continuation_length(data)
+                    data = data[skipped:]
+                    sent = tail_start + skipped
+                    setattr(counter, f"send_{stream}", sent)
+                    output_start.setdefault(process.process_index, {})[stream] = sent
+                if data or sent:
+                    setattr(
+                        process,
+                        f"process_{stream}",
+                        self.take_text(process.process_index, stream, counter, data),
+                    )
+            for stream in db_models.NIX_LOG_STREAMS:
+                sent = getattr(counter, f"send_{stream}")
+                entries = crud.task.read_nix_log(
+                    db_session, db_task.id, process.process_index, stream, sent
+                )
+                if entries or sent:
+                    setattr(process, stream, entries)
+                    setattr(counter, f"send_{stream}", sent + len(entries))
+        return task, output_start
+
+    def take_text(
+        self,
+        process_index: int,
+        stream: str,
+        counter: SubscribedTaskProcessCounter,
+        data: bytes,
+    ) -> str:
+        # data continues right after the held bytes, an incomplete utf-8
+        # character at its end is held back until the rest of it arrives
+        data = self.held_output.pop((process_index, stream), b"") + data
+        complete = complete_utf8_length(data)
+        if complete < len(data):
+            self.held_output[(process_index, stream)] = data[complete:]
+        sent = getattr(counter, f"send_{stream}")
+        setattr(counter, f"send_{stream}", sent + complete)
+        return data[:complete].decode("utf-8", errors="replace")
+
+    def read_missing(
+        self, task_id: uuid.UUID, process_index: int, stream: str, start: int, end: int
+    ):
+        # output committed before the subscription caught up with the updates
+        with Session(self.db_engine) as db_session:
+            if stream in ("stdout", "stderr"):
+                return crud.task.read_process_output(
+                    db_session, task_id, process_index, stream, start, end
+                )
+            return crud.task.read_nix_log(
+                db_session, task_id, process_index, stream, start, end
+            )
+
+    def create_process_output(
+        self, task_id: uuid.UUID, process_delta: TaskProcessDelta
+    ) -> TaskProcessOutput:
+        process_index = process_delta.process_index
+        counter = self.get_counter(process_index)
+        output = TaskProcessOutput(
+            process_index=process_index,
+            process_program=process_delta.process_program,
+            process_args=process_delta.process_args,
+            process_env=process_delta.process_env,
+            nix_status=process_delta.nix_status,
+        )
+        for stream, appended in process_delta.appended.items():
+            held = len(self.held_output.get((process_index, stream), b""))
+            position = getattr(counter, f"send_{stream}") + held
+            if appended.end <= position:
+                continue
+            data = appended.data[max(position - appended.start, 0) :]
+            if appended.start > position:
+                data = (
+                    self.read_missing(
+                        task_id, process_index, stream, position, appended.start
+                    )
+                    + data
+                )
+            if stream in ("stdout", "stderr"):
+                setattr(
+                    output,
+                    f"process_{stream}",
+                    self.take_text(process_index, stream, counter, data),
+                )
+            else:
+                setattr(output, stream, data)
+                setattr(counter, f"send_{stream}", appended.end)
+        return output
 
     def enqueue_task(self, task_message: TaskMessage):
         self.loop.call_soon_threadsafe(self.task_queue.put_nowait, task_message)
@@ -179,11 +308,17 @@ class TaskWebsocketSubscriber:
         short_task = crud.task.TaskShort.from_orm_task(task)
         self.enqueue_task(ShortTaskUpdate(task_id=task.id, task=short_task))
 
-    def notify_task_output(self, task: db_models.Task):
+    def notify_task_output(self, delta: TaskOutputDelta):
         with self.process_subscribed_task_lock:
-            if self.subscribed_task == task.id:
+            if self.subscribed_task == delta.task_id:
+                processes = [
+                    self.create_process_output(delta.task_id, process_delta)
+                    for process_delta in delta.processes.values()
+                ]
                 self.enqueue_task(
                     SubscribedTaskOutput(
-                        task_id=task.id, task=self.create_subscribed_task(task)
+                        task_id=delta.task_id,
+                        processes=processes,
+                        cursor=self.copy_cursor(),
                     )
                 )
@@ -0,0 +1,347 @@
+import base64
+import dataclasses
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing.connection import Connection
+from typing import TYPE_CHECKING, Callable, Optional
+
+import sqlalchemy.orm
+import thymis_controller.crud.task as crud_task
+import thymis_controller.models.task as models_task
+from thymis_controller.nix.log_parse import ParsedNixProcess
+from thymis_controller.task.output_channel import TaskOutputFrame
+
+if TYPE_CHECKING:
+    from thymis_controller.task.executor import TaskWorkerPoolManager
+
+logger = logging.getLogger(__name__)
+
+# updates the worker (or finish_task) waits on, for their database state or a
+# reply, and releases of slots other workers wait for. They are committed right
+# away instead of waiting for the latency budget
+URGENT_UPDATES = (
+    models_task.TaskCompletedUpdate,
+    models_task.TaskFailedUpdate,
+    models_task.WorkerRequestsSecretsUpdate,
+    models_task.AgentShouldReceiveNewSecretsUpdate,
+    models_task.AgentShouldSwitchToNewConfigurationUpdate,
+    models_task.BuildClaimUpdate,
+    models_task.BuildFinishedUpdate,
+    models_task.DeployStageClaimUpdate,
+    models_task.DeployStageFinishedUpdate,
+    models_task.DeployUpToDateCheckUpdate,
+    models_task.AgentQueryStorePathsUpdate,
+    models_task.AgentShouldFetchClosureUpdate,
+)
+
+
+@dataclasses.dataclass
+class PendingTaskUpdate:
+    conn: Connection
+    message: models_task.RunnerToControllerTaskUpdate
+
+    @property
+    def task_id(self) -> uuid.UUID:
+        return self.message.id
+
+
+@dataclasses.dataclass
+class PendingTaskOutput:
+    task_id: uuid.UUID
+    process_index: int
+    stdout: bytearray = dataclasses.field(default_factory=bytearray)
+    stderr: bytearray = dataclasses.field(default_factory=bytearray)
+
+
+@dataclasses.dataclass
+class AppendedOutput:
+    # position of `data` in the stream, in bytes for stdout and stderr and in
+    # entries for the nix log lists
+    start: int
+    data: bytes | list
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.data)
+
+
+@dataclasses.dataclass
+class TaskProcessDelta:
+    process_index: int
+    process_program: Optional[str] = None
+    process_args: Optional[list[str]] = None
+    process_env: Optional[dict[str, str]] = None
+    nix_status: Optional[dict] = None
+    # keyed by "stdout", "stderr" and db_models.NIX_LOG_STREAMS
+    appended: dict[str, AppendedOutput] = dataclasses.field(default_factory=dict)
+
+    def append(self, stream: str, start: int, data: bytes | list):
+        previous = self.appended.get(stream)
+        if previous is not None and previous.end == start:
+            previous.data = previous.data + data
+        else:
+            self.appended[stream] = AppendedOutput(start=start, data=data)
+
+
+@dataclasses.dataclass
+class TaskOutputDelta:
+    """What a committed batch added to the processes of a task"""
+
+    task_id: uuid.UUID
+    processes: dict[int, TaskProcessDelta] = dataclasses.field(default_factory=dict)
+
+    def process(self, process_index: int) -> TaskProcessDelta:
+        if process_index not in self.processes:
+            self.processes[process_index] = TaskProcessDelta(process_index)
+        return self.processes[process_index]
+
+
+def merge_nix_status(
+    previous: ParsedNixProcess, status: ParsedNixProcess
+) -> ParsedNixProcess:
+    """Combine two consecutive nix status updates, which only carry new errors and logs"""
+    logs_by_level = {
+        level: [
+            *previous.logs_by_level.get(level, []),
+            *status.logs_by_level.get(level, []),
+        ]
+        for level in previous.logs_by_level.keys() | status.logs_by_level.keys()
+    }
+    return status.model_copy(
+        update={
+            "errors": [*previous.errors, *status.errors],
+            "logs_by_level": logs_by_level,
+        }
+    )
+
+
+def coalesce_updates(
+    updates: list[PendingTaskUpdate | PendingTaskOutput],
+) -> list[PendingTaskUpdate | PendingTaskOutput]:
+    """
+    Merge output and nix status updates of the same process into one entry.
+    Merged entries keep the position of their first occurrence, so updates of
+    a task are still applied in arrival order.
+    """
+    coalesced: list[PendingTaskUpdate | PendingTaskOutput] = []
+    positions: dict[tuple, int] = {}
+    for pending in updates:
+        if isinstance(pending, PendingTaskOutput):
+            key = ("output", pending.task_id, pending.process_index)
+            if key in positions:
+                merged = coalesced[positions[key]]
+                merged.stdout += pending.stdout
+                merged.stderr += pending.stderr
+                continue
+        elif isinstance(pending.message.update, models_task.TaskNixStatusUpdate):
+            key = ("nix_status", pending.task_id, pending.message.update.process_index)
+            if key in positions:
+                previous = coalesced[positions[key]]
+                coalesced[positions[key]] = PendingTaskUpdate(
+                    conn=pending.conn,
+                    message=models_task.RunnerToControllerTaskUpdate(
+                        id=pending.task_id,
+                        update=models_task.TaskNixStatusUpdate(
+                            process_index=pending.message.update.process_index,
+                            status=merge_nix_status(
+                                previous.message.update.status,
+                                pending.message.update.status,
+                            ),
+                        ),
+                    ),
+                )
+                continue
+        else:
+            coalesced.append(pending)
+            continue
+        positions[key] = len(coalesced)
+        coalesced.append(pending)
+    return coalesced
+
+
+class TaskUpdateWriter:
+    """
+    Applies updates from all workers to the database from a single thread.
+
+    Updates are collected for up to `commit_latency` seconds and committed in
+    one transaction, instead of one SQLite transaction per message. Their
+    replies and messages to agents are sent once that transaction committed,
+    so a batch that fails and is retried update by update sends them once.
+    """
+
+    def __init__(self, manager: "TaskWorkerPoolManager", commit_latency: float):
+        self.manager = manager
+        self.commit_latency = commit_latency
+        self.queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="task-update-writer", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, conn: Connection, message: models_task.RunnerToControllerTaskUpdate):
+        self.start()
+        if isinstance(message.update, models_task.TaskStdOutErrUpdate):
+            self.queue.put(
+                PendingTaskOutput(
+                    task_id=message.id,
+                    process_index=message.update.process_index,
+                    stdout=bytearray(base64.b64decode(message.update.stdoutb64)),
+                    stderr=bytearray(base64.b64decode(message.update.stderrb64)),
+                )
+            )
+        else:
+            self.queue.put(PendingTaskUpdate(conn=conn, message=message))
+
+    def put_output(self, frame: TaskOutputFrame):
+        self.start()
+        self.queue.put(
+            PendingTaskOutput(
+                task_id=frame.task_id,
+                process_index=frame.process_index,
+                stdout=bytearray(frame.stdout),
+                stderr=bytearray(frame.stderr),
+            )
+        )
+
+    def after_commit(self, callback: Callable[[], None]):
+        """Run `callback` on the writer thread once every update queued so far is committed"""
+        self.start()
+        self.queue.put(callback)
+
+    def flush(self):
+        """Block until every update queued so far is committed"""
+        committed = threading.Event()
+        self.after_commit(committed.set)
+        committed.wait()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            callbacks: list[Callable[[], None]] = []
+            deadline = time.monotonic() + self.commit_latency
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if callable(item):
+                    callbacks.append(item)
+                    break
+                batch.append(item)
+                if isinstance(item, PendingTaskUpdate) and isinstance(
+                    item.message.update, URGENT_UPDATES
+                ):
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                self.write_batch(coalesce_updates(batch))
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    traceback.print_exc()
+                    logger.error("Error in task update writer callback: %s", e)
+
+    def write_batch(self, batch: list[PendingTaskUpdate | PendingTaskOutput]):
+        try:
+            self.apply(batch)
+        except Exception as e:
+            # retry one by one, so a single bad update does not drop the batch
+            logger.error("Error writing batch of task updates, retrying singly: %s", e)
+            for pending in batch:
+                try:
+                    self.apply([pending])
+                except Exception as e:
+                    traceback.print_exc()
+                    logger.error("Error processing message from worker: %s", e)
+
+    def apply(self, batch: list[PendingTaskUpdate | PendingTaskOutput]):
+        with sqlalchemy.orm.Session(bind=self.manager.db_engine) as db_session:
+            tasks = {}
+            deltas: dict[uuid.UUID, TaskOutputDelta] = {}
+            for pending in batch:
+                if pending.task_id not in tasks:
+                    tasks[pending.task_id] = crud_task.get_task_by_id(
+                        db_session, pending.task_id
+                    )
+                    deltas[pending.task_id] = TaskOutputDelta(pending.task_id)
+                task = tasks[pending.task_id]
+                delta = deltas[pending.task_id]
+                if isinstance(pending, PendingTaskOutput):
+                    output = {
+                        "stdout": bytes(pending.stdout),
+                        "stderr": bytes(pending.stderr),
+                    }
+                    chunks = self.manager.apply_task_output(
+                        db_session,
+                        task,
+                        pending.process_index,
+                        output["stdout"],
+                        output["stderr"],
+                    )
+                    # chunks may be stored compressed, send the raw output
+                    for chunk in chunks:
+                        delta.process(pending.process_index).append(
+                            chunk.stream, chunk.offset, output[chunk.stream]
+                        )
+                else:
+                    self.apply_update(db_session, pending, task, delta)
+            db_session.commit()
+            for task in tasks.values():
+                if deltas[task.id].processes:
+                    self.manager.on_task_output.notify(deltas[task.id])
+                self.manager.on_task_update.notify(task)
+
+    def apply_update(
+        self,
+        db_session: sqlalchemy.orm.Session,
+        pending: PendingTaskUpdate,
+        task,
+        delta: TaskOutputDelta,
+    ):
+        update = pending.message.update
+        if isinstance(update, models_task.TaskNixStatusUpdate):
+            # the appended entries come back with their offsets, the stored
+            # lists are never loaded
+            appended = self.manager.apply_nix_status(
+                db_session, task, update.process_index, update.status
+            )
+            process = task.get_process_by_index(update.process_index)
+            process_delta = delta.process(update.process_index)
+            process_delta.nix_status = process.nix_status
+            for stream, (start, entries) in appended.items():
+                process_delta.append(stream, start, entries)
+            return
+
+        self.manager.apply_task_update(db_session, pending.conn, task, update)
+        if isinstance(update, models_task.CommandRunUpdate):
+            process = task.get_process_by_index(update.process_index)
+            process_delta = delta.process(update.process_index)
+            process_delta.process_program = process.process_program
+            process_delta.process_args = process.process_args
+            process_delta.process_env = process.process_env
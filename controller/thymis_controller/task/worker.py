@@ -1,4 +1,5 @@
 import base64
+import contextlib
 import datetime
 import glob
 import json
@@ -7,6 +8,9 @@ import pathlib
 import platform
 import queue
 import random
+import resource
+import selectors
+import shlex
 import shutil
 import signal
 import subprocess
@@ -16,14 +20,42 @@ import threading
 import time
 import uuid
 from multiprocessing.connection import Connection
-from typing import IO, AnyStr, List, assert_never
+from typing import AnyStr, Callable, List, assert_never
 
 import thymis_controller.models.task as models_task
 from pydantic import BaseModel
 from thymis_agent import agent
 from thymis_controller.nix import NIX_CMD, nix_subprocess_env
+from thymis_controller.nix.binary_cache import parse_path_infos
 from thymis_controller.nix.log_parse import NixParser
 from thymis_controller.repo import git_commit_cmd
+from thymis_controller.task.output_channel import send_output
+
+# run_command output handling
+OUTPUT_READ_SIZE = 65536
+# complete lines are sent right away, but not more often than this
+OUTPUT_FLUSH_MIN_INTERVAL = 0.05
+# partial lines (progress bars, prompts) are sent after at most this long
+OUTPUT_FLUSH_MAX_DELAY = 0.5
+OUTPUT_FLUSH_MAX_BYTES = 1024 * 1024
+OUTPUT_POLL_INTERVAL = 0.5
+# how long to keep reading pipes held open by children after the process exited
+OUTPUT_DRAIN_TIMEOUT = 0.5
+# how often a task waiting for the controller checks whether it was cancelled
+CONTROLLER_REPLY_POLL_INTERVAL = 1
+# how long an agent may take to substitute a closure from the binary cache
+AGENT_FETCH_CLOSURE_TIMEOUT = 60 * 60
+# how long an agent may take to answer which paths of a closure it lacks,
+# also the time it has to reconnect after a transfer was interrupted
+AGENT_STORE_QUERY_TIMEOUT = 5 * 60
+CLOSURE_TRANSFER_ATTEMPTS = 5
+# how often a closure transfer reports the bytes it sent
+CLOSURE_TRANSFER_PROGRESS_INTERVAL = 1
+# processes of a deploy, evaluation and build of a staged build are separate
+DEPLOY_EVAL_PROCESS = 0
+DEPLOY_BUILD_PROCESS = 1
+DEPLOY_COPY_PROCESS = 2
+DEPLOY_ACTIVATE_PROCESS = 3
 
 
 def no_new_privs() -> bool:
@@ -96,6 +128,16 @@ def listen_for_executor(conn: Connection, process_list: ProcessList):
                     pass
                 case models_task.SecretsResult():
                     process_list.msg_queue.put(message)
+                case models_task.BuildClaimResult():
+                    process_list.msg_queue.put(message)
+                case models_task.DeployStageGranted():
+                    process_list.msg_queue.put(message)
+                case models_task.AgentFetchClosureResult():
+                    process_list.msg_queue.put(message)
+                case models_task.DeployUpToDateResult():
+                    process_list.msg_queue.put(message)
+                case models_task.AgentStorePathsResult():
+                    process_list.msg_queue.put(message)
                 case _:
                     print("Received unexpected message %s", message)
                     assert_never(message)
@@ -114,20 +156,21 @@ def worker_run_task(task: models_task.TaskSubmission, conn: Connection):
     )
     executor_thread.start()
 
-    if task.data.type not in SUPPORTED_TASK_TYPES:
-        reject_task(f"Task type {task.data.type} not supported", task, conn)
-        conn.close()
-        return
-    pick_task(task, conn)
+    # the connection is closed on every path, the controller waits for its end
     try:
-        SUPPORTED_TASK_TYPES[task.data.type](task, conn, process_list)
-    except Exception as e:
-        import traceback
-
-        exception_str = traceback.format_exc()
-        report_task_finished(task, conn, False, f"Exception: {e}\n{exception_str}")
+        if task.data.type not in SUPPORTED_TASK_TYPES:
+            reject_task(f"Task type {task.data.type} not supported", task, conn)
+            return
+        pick_task(task, conn)
+        try:
+            SUPPORTED_TASK_TYPES[task.data.type](task, conn, process_list)
+        except Exception as e:
+            import traceback
 
-    conn.close()
+            exception_str = traceback.format_exc()
+            report_task_finished(task, conn, False, f"Exception: {e}\n{exception_str}")
+    finally:
+        conn.close()
     executor_thread.join()
 
 
@@ -135,7 +178,12 @@ def pick_task(task: models_task.TaskSubmission, conn: Connection):
     conn.send(
         models_task.RunnerToControllerTaskUpdate(
             id=task.id,
-            update=models_task.TaskPickedUpdate(),
+            update=models_task.TaskPickedUpdate(
+                worker_pid=os.getpid(),
+                # kilobytes on Linux
+                worker_max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                * 1024,
+            ),
         )
     )
     print("Task picked")
@@ -199,6 +247,473 @@ def build_project_task(
         report_task_finished(task, conn, False, "Build failed")
 
 
+def wait_for_message(
+    process_list: ProcessList,
+    message_type: type[BaseModel],
+    timeout: float | None = None,
+) -> BaseModel | None:
+    # None if the task was cancelled or the timeout passed while waiting
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not process_list.terminated:
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        try:
+            message = process_list.msg_queue.get(timeout=CONTROLLER_REPLY_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if isinstance(message.inner, message_type):
+            return message.inner
+    return None
+
+
+@contextlib.contextmanager
+def deploy_stage(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    stage: models_task.DeployStage,
+):
+    """Hold a slot of a deploy stage, yields False if the task was cancelled"""
+    conn.send(
+        models_task.RunnerToControllerTaskUpdate(
+            id=task.id, update=models_task.DeployStageClaimUpdate(stage=stage)
+        )
+    )
+    granted = wait_for_message(process_list, models_task.DeployStageGranted)
+    try:
+        yield granted is not None
+    finally:
+        if granted is not None:
+            conn.send(
+                models_task.RunnerToControllerTaskUpdate(
+                    id=task.id,
+                    update=models_task.DeployStageFinishedUpdate(stage=stage),
+                )
+            )
+
+
+def store_path_valid(path: str) -> bool:
+    # a cached out path may have been garbage collected since it was built
+    return (
+        subprocess.run(
+            ["nix-store", "--check-validity", path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=nix_subprocess_env(),
+            check=False,
+        ).returncode
+        == 0
+    )
+
+
+def build_configuration(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    repo_path: pathlib.Path,
+    commit: str,
+    identifier: str,
+    out_link: str,
+    env: dict | None,
+    cwd: str,
+    attribute: str = "toplevel",
+    staged: bool = False,
+) -> tuple[str | None, str | None]:
+    """
+    Build config.system.build.<attribute> of a configuration at a commit as
+    process 0, reuse the result of an earlier build or wait for a task already
+    building it. Returns the store path, or None and the reason it failed.
+
+    If staged, evaluation and build run in the eval and build deploy stages,
+    as the processes DEPLOY_EVAL_PROCESS and DEPLOY_BUILD_PROCESS.
+    """
+    installable = f'git+file:{repo_path}?rev={commit}#nixosConfigurations."{identifier}".config.system.build.{attribute}'
+    process_index = DEPLOY_BUILD_PROCESS if staged else 0
+
+    def build(installable: str) -> int:
+        return run_command(
+            task,
+            conn,
+            process_list,
+            [
+                *NIX_CMD,
+                "build",
+                installable,
+                "--out-link",
+                out_link,
+                "--allow-dirty-locks",
+            ],
+            env,
+            cwd=cwd,
+            process_index=process_index,
+        )
+
+    def evaluate_and_build() -> int | None:
+        # the derivation is written to the store by the evaluation, building
+        # it does not evaluate the flake again. None if the task was cancelled
+        drv_path_file = pathlib.Path(f"{out_link}.drv-path")
+        try:
+            with deploy_stage(task, conn, process_list, "eval") as granted:
+                if not granted:
+                    return None
+                returncode = run_command(
+                    task,
+                    conn,
+                    process_list,
+                    [
+                        *NIX_CMD,
+                        "eval",
+                        f"{installable}.drvPath",
+                        "--write-to",
+                        str(drv_path_file),
+                        "--allow-dirty-locks",
+                    ],
+                    env,
+                    cwd=cwd,
+                    process_index=DEPLOY_EVAL_PROCESS,
+                )
+            if returncode != 0:
+                return returncode
+            drv_path = drv_path_file.read_text(encoding="utf-8").strip()
+        finally:
+            drv_path_file.unlink(missing_ok=True)
+        with deploy_stage(task, conn, process_list, "build") as granted:
+            if not granted:
+                return None
+            return build(f"{drv_path}^*")
+
+    def claim_build(invalid_out_path: str | None = None):
+        conn.send(
+            models_task.RunnerToControllerTaskUpdate(
+                id=task.id,
+                update=models_task.BuildClaimUpdate(
+                    flake_rev=commit,
+                    configuration_id=identifier,
+                    attribute=attribute,
+                    invalid_out_path=invalid_out_path,
+                ),
+            )
+        )
+
+    def link_out_path(out_path: str) -> bool:
+        # an own out link keeps the path from being garbage collected
+        returncode = run_command(
+            task,
+            conn,
+            process_list,
+            [*NIX_CMD, "build", out_path, "--out-link", out_link],
+            env,
+            cwd=cwd,
+            process_index=process_index,
+        )
+        return returncode == 0
+
+    claim_build()
+    while True:
+        claim = wait_for_message(process_list, models_task.BuildClaimResult)
+        if claim is None:
+            return None, "Task was cancelled"
+        match claim.status:
+            case "wait":
+                send_output(
+                    conn,
+                    task.id,
+                    process_index,
+                    f"Waiting for the same build in task {claim.builder_task_id}\n".encode(),
+                    b"",
+                )
+            case "build":
+                returncode = evaluate_and_build() if staged else build(installable)
+                if returncode is None or process_list.terminated:
+                    # without a result, the controller hands the build to the
+                    # next waiting task once this one ended
+                    return None, "Task was cancelled"
+                out_path = (
+                    str(pathlib.Path(out_link).resolve()) if returncode == 0 else None
+                )
+                conn.send(
+                    models_task.RunnerToControllerTaskUpdate(
+                        id=task.id,
+                        update=models_task.BuildFinishedUpdate(out_path=out_path),
+                    )
+                )
+                return out_path, None if out_path else "Build failed"
+            case "built":
+                if not link_out_path(claim.out_path):
+                    return None, "Build failed"
+                return claim.out_path, None
+            case "cached":
+                if not store_path_valid(claim.out_path):
+                    claim_build(invalid_out_path=claim.out_path)
+                    continue
+                send_output(
+                    conn,
+                    task.id,
+                    process_index,
+                    f"Using {claim.out_path} built by task {claim.builder_task_id}\n".encode(),
+                    b"",
+                )
+                if not link_out_path(claim.out_path):
+                    return None, "Build failed"
+                return claim.out_path, None
+            case "failed":
+                return None, f"Build failed in task {claim.builder_task_id}"
+
+
+def agent_fetch_closure(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    store_path: str,
+) -> int:
+    """Let the agent substitute the closure from the controller, like nix copy"""
+    conn.send(
+        models_task.RunnerToControllerTaskUpdate(
+            id=task.id,
+            update=models_task.AgentShouldFetchClosureUpdate(
+                deployment_info_id=task.data.device.deployment_info_id,
+                store_path=store_path,
+            ),
+        )
+    )
+    result = wait_for_message(
+        process_list, models_task.AgentFetchClosureResult, AGENT_FETCH_CLOSURE_TIMEOUT
+    )
+    if result is None:
+        send_output(
+            conn, task.id, DEPLOY_COPY_PROCESS, b"", b"Timeout waiting for agent\n"
+        )
+        return 1
+    send_output(
+        conn,
+        task.id,
+        DEPLOY_COPY_PROCESS,
+        result.stdout.encode("utf-8"),
+        result.stderr.encode("utf-8"),
+    )
+    return 0 if result.success else 1
+
+
+def query_missing_paths(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    closure: list[str],
+) -> tuple[list[str] | None, str | None]:
+    """The paths of closure the device lacks, in closure order, or an error"""
+    query = models_task.AgentQueryStorePathsUpdate(
+        deployment_info_id=task.data.device.deployment_info_id,
+        paths=closure,
+    )
+    conn.send(models_task.RunnerToControllerTaskUpdate(id=task.id, update=query))
+    missing = set()
+    checked = 0
+    deadline = time.monotonic() + AGENT_STORE_QUERY_TIMEOUT
+    while checked < len(closure):
+        result = wait_for_message(
+            process_list,
+            models_task.AgentStorePathsResult,
+            max(deadline - time.monotonic(), 0),
+        )
+        if result is None:
+            return None, "Timeout waiting for the store paths of the agent"
+        if result.query_id not in (None, query.query_id):
+            continue  # answers an earlier, interrupted query
+        if result.error is not None:
+            return None, result.error
+        checked += result.checked
+        missing.update(result.missing)
+    return [path for path in closure if path in missing], None
+
+
+def stream_missing_paths(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    missing: list[str],
+    env: dict,
+    cwd: str,
+    on_progress: Callable[[int], None],
+) -> int:
+    """
+    Pipe nix-store --export into nix-store --import on the device over one
+    compressed ssh session, on_progress gets the NAR bytes sent so far
+    """
+    export = subprocess.Popen(
+        ["nix-store", "--export", *missing],
+        stdout=subprocess.PIPE,
+        env=nix_subprocess_env(),
+        start_new_session=True,
+    )
+    process_list.add(export)
+    read_fd, write_fd = os.pipe()
+    transferred = 0
+
+    def pump():
+        nonlocal transferred
+        try:
+            with os.fdopen(write_fd, "wb") as sink:
+                while chunk := export.stdout.read1(OUTPUT_READ_SIZE):
+                    sink.write(chunk)
+                    transferred += len(chunk)
+        except BrokenPipeError:
+            pass  # the connection dropped, run_command reports it
+        finally:
+            # stops nix-store --export if the import ended early
+            export.stdout.close()
+
+    pump_thread = threading.Thread(target=pump, daemon=True)
+    pump_thread.start()
+    returncode = run_command(
+        task,
+        conn,
+        process_list,
+        [
+            "ssh",
+            *shlex.split(env["NIX_SSHOPTS"]),
+            "-o",
+            "Compression=yes",
+            "root@127.0.0.1",
+            "nix-store",
+            "--import",
+        ],
+        env,
+        cwd=cwd,
+        process_index=DEPLOY_COPY_PROCESS,
+        stdin=read_fd,
+        on_poll=lambda: on_progress(transferred),
+    )
+    pump_thread.join()
+    export.wait()
+    on_progress(transferred)
+    return returncode or export.returncode
+
+
+def delta_transfer_closure(
+    task: models_task.TaskSubmission,
+    conn: Connection,
+    process_list: ProcessList,
+    store_path: str,
+    env: dict,
+    cwd: str,
+) -> int:
+    """
+    Copy only the paths the device lacks: one query for all paths of the
+    closure over the agent connection instead of nix copy checking them one
+    round trip at a time, then a single nix-store --export | --import stream.
+
+    Each imported path is valid on the device right away, so the store of
+    the device is the checkpoint of an interrupted transfer. It resumes by
+    querying again, once the agent reconnected, and sending what is still
+    missing.
+    """
+    started = time.monotonic()
+    # in dependency order, as nix-store --import needs them
+    closure = subprocess.run(
+        ["nix-store", "--query", "--requisites", store_path],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=nix_subprocess_env(),
+    ).stdout.split()
+    stats = None
+    transferred_before = 0
+    last_progress = 0.0
+
+    def report(transferred: int, final: bool = False):
+        nonlocal last_progress
+        now = time.monotonic()
+        stats.bytes_transferred = transferred_before + transferred
+        stats.transfer_seconds = now - transfer_started
+        if not final and now - last_progress < CLOSURE_TRANSFER_PROGRESS_INTERVAL:
+            return
+        last_progress = now
+        conn.send(
+            models_task.RunnerToControllerTaskUpdate(
+                id=task.id,
+                update=models_task.ClosureTransferStatsUpdate(stats=stats),
+            )
+        )
+
+    for attempt in range(1, CLOSURE_TRANSFER_ATTEMPTS + 1):
+        missing, error = query_missing_paths(task, conn, process_list, closure)
+        if process_list.terminated:
+            return -1
+        if missing is None:
+            send_output(
+                conn, task.id, DEPLOY_COPY_PROCESS, b"", f"{error}\n".encode("utf-8")
+            )
+            if attempt < CLOSURE_TRANSFER_ATTEMPTS:
+                continue
+            return 1
+        if stats is None:
+            nar_bytes = 0
+            if missing:
+                path_infos = subprocess.run(
+                    [*NIX_CMD, "path-info", "--json", *missing],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    env=nix_subprocess_env(),
+                ).stdout
+                nar_bytes = sum(info.nar_size for info in parse_path_infos(path_infos))
+            stats = models_task.ClosureTransferStats(
+                mode="delta",
+                paths=len(closure),
+                missing_paths=len(missing),
+                nar_bytes=nar_bytes,
+                query_seconds=time.monotonic() - started,
+                transfer_seconds=0.0,
+            )
+            transfer_started = time.monotonic()
+            send_output(
+                conn,
+                task.id,
+                DEPLOY_COPY_PROCESS,
+                f"{len(missing)} of {len(closure)} paths missing on the device, "
+                f"{nar_bytes} bytes, queried in {stats.query_seconds:.1f}s\n".encode(
+                    "utf-8"
+                ),
+                b"",
+            )
+        else:
+            stats.attempts = attempt
+            stats.resumed_paths = stats.missing_paths - len(missing)
+            send_output(
+                conn,
+                task.id,
+                DEPLOY_COPY_PROCESS,
+                f"Resuming, {stats.resumed_paths} of {stats.missing_paths} "
+                "paths were imported before\n".encode("utf-8"),
+                b"",
+            )
+        if not missing:
+            report(0, final=True)
+            return 0
+
+        returncode = stream_missing_paths(
+            task,
+            conn,
+            process_list,
+            missing,
+            env,
+            cwd,
+            report,
+        )
+        transferred_before = stats.bytes_transferred
+        report(0, final=True)
+        if returncode == 0 or process_list.terminated:
+            return returncode
+        send_output(
+            conn,
+            task.id,
+            DEPLOY_COPY_PROCESS,
+            b"",
+            b"Transfer interrupted, resuming once the agent is connected\n",
+        )
+    return 1
+
+
 def deploy_device_task(
     task: models_task.TaskSubmission, conn: Connection, process_list: ProcessList
 ):
@@ -248,30 +763,46 @@ def deploy_device_task(
                 else {}
             ),
         )
-        toplevel_path = f"{tmpdir}/toplevel"
-        returncode = run_command(
+        config_path, reason = build_configuration(
             task,
             conn,
             process_list,
-            [
-                *NIX_CMD,
-                "build",
-                f'git+file:{repo_path}?rev={task_data.config_commit}#nixosConfigurations."{task_data.device.identifier}".config.system.build.toplevel',
-                "--out-link",
-                toplevel_path,
-                "--allow-dirty-locks",
-            ],
+            repo_path,
+            task_data.config_commit,
+            task_data.device.identifier,
+            f"{tmpdir}/toplevel",
             env,
-            cwd=tmpdir,
-            process_index=0,
+            tmpdir,
+            staged=True,
         )
-
-        if returncode != 0:
-            report_task_finished(task, conn, False, "Build failed")
+        if config_path is None:
+            report_task_finished(task, conn, False, reason)
             return
 
-        # resolve the toplevel path
-        config_path = str(pathlib.Path(toplevel_path).resolve())
+        conn.send(
+            models_task.RunnerToControllerTaskUpdate(
+                id=task.id,
+                update=models_task.DeployUpToDateCheckUpdate(
+                    deployment_info_id=task_data.device.deployment_info_id,
+                    toplevel=config_path,
+                ),
+            )
+        )
+        check = wait_for_message(process_list, models_task.DeployUpToDateResult)
+        if check is None:
+            report_task_finished(task, conn, False, "Task was cancelled")
+            return
+        if check.up_to_date:
+            send_output(
+                conn,
+                task.id,
+                DEPLOY_COPY_PROCESS,
+                f"Device already runs {config_path}, "
+                "skipping copy and activation\n".encode("utf-8"),
+                b"",
+            )
+            report_task_finished(task, conn)
+            return
 
         # Try to find systemd-run for better process isolation
         systemd_run = None
@@ -292,128 +823,141 @@ def deploy_device_task(
         if systemd_run and needs_system_sudo and no_new_privs():
             systemd_run = None
 
-        # If systemd-run is available, use it for better process isolation
-        if systemd_run:
-            sudo = None
-            if needs_system_sudo:
-                for path in [
-                    "sudo",
-                    "/bin/sudo",
-                    "/run/current-system/sw/bin/sudo",
-                ]:
-                    if shutil.which(path):
-                        sudo = path
-                        break
-
-                if sudo is None:
-                    report_task_finished(task, conn, False, "sudo not found")
-                    return
-
-            returncode = run_command(
-                task,
-                conn,
-                process_list,
-                [
-                    *([sudo, "-n", "-E"] if needs_system_sudo else []),
-                    systemd_run,
-                    "-E",
-                    "NIX_SSHOPTS",
-                    "-E",
-                    "HTTP_NETWORK_RELAY_SECRET",
-                    "-E",
-                    "PATH",
-                    *(["--user"] if "DBUS_SESSION_BUS_ADDRESS" in os.environ else []),
-                    "--collect",
-                    "--no-ask-password",
-                    "--pipe",
-                    "--quiet",
-                    "--service-type=exec",
-                    f"--unit=thymis-nix-copy-closure-{random.randbytes(8).hex()}",
-                    "--wait",
-                    # Resolve nix to an absolute path so systemd-run can find it
-                    # without PATH search; systemd on newer Ubuntu/NixOS does not
-                    # use the unit's PATH env var to resolve ExecStart.
-                    shutil.which(NIX_CMD[0]) or NIX_CMD[0],
-                    *NIX_CMD[1:],
-                    "copy",
-                    "--no-check-sigs",
-                    "--to",
-                    "ssh-ng://root@127.0.0.1",
-                    config_path,
-                ],
-                env,
-                cwd=tmpdir,
-                process_index=1,
-            )
-        else:
-            # Fallback to direct nix copy without systemd-run
-            returncode = run_command(
-                task,
-                conn,
-                process_list,
-                [
-                    *NIX_CMD,
-                    "copy",
-                    "--no-check-sigs",
-                    "--to",
-                    "ssh-ng://root@127.0.0.1",
-                    config_path,
-                ],
-                env,
-                cwd=tmpdir,
-                stderr_read_size=1,
-                process_index=1,
-            )
+        with deploy_stage(task, conn, process_list, "copy") as granted:
+            if not granted:
+                report_task_finished(task, conn, False, "Task was cancelled")
+                return
+            if task_data.closure_transfer == "substitute":
+                returncode = agent_fetch_closure(task, conn, process_list, config_path)
+            elif task_data.closure_transfer == "delta":
+                returncode = delta_transfer_closure(
+                    task, conn, process_list, config_path, env, tmpdir
+                )
+            # If systemd-run is available, use it for better process isolation
+            elif systemd_run:
+                sudo = None
+                if needs_system_sudo:
+                    for path in [
+                        "sudo",
+                        "/bin/sudo",
+                        "/run/current-system/sw/bin/sudo",
+                    ]:
+                        if shutil.which(path):
+                            sudo = path
+                            break
+
+                    if sudo is None:
+                        report_task_finished(task, conn, False, "sudo not found")
+                        return
+
+                returncode = run_command(
+                    task,
+                    conn,
+                    process_list,
+                    [
+                        *([sudo, "-n", "-E"] if needs_system_sudo else []),
+                        systemd_run,
+                        "-E",
+                        "NIX_SSHOPTS",
+                        "-E",
+                        "HTTP_NETWORK_RELAY_SECRET",
+                        "-E",
+                        "PATH",
+                        *(
+                            ["--user"]
+                            if "DBUS_SESSION_BUS_ADDRESS" in os.environ
+                            else []
+                        ),
+                        "--collect",
+                        "--no-ask-password",
+                        "--pipe",
+                        "--quiet",
+                        "--service-type=exec",
+                        f"--unit=thymis-nix-copy-closure-{random.randbytes(8).hex()}",
+                        "--wait",
+                        # Resolve nix to an absolute path so systemd-run can find it
+                        # without PATH search; systemd on newer Ubuntu/NixOS does not
+                        # use the unit's PATH env var to resolve ExecStart.
+                        shutil.which(NIX_CMD[0]) or NIX_CMD[0],
+                        *NIX_CMD[1:],
+                        "copy",
+                        "--no-check-sigs",
+                        "--to",
+                        "ssh-ng://root@127.0.0.1",
+                        config_path,
+                    ],
+                    env,
+                    cwd=tmpdir,
+                    process_index=DEPLOY_COPY_PROCESS,
+                )
+            else:
+                # Fallback to direct nix copy without systemd-run
+                returncode = run_command(
+                    task,
+                    conn,
+                    process_list,
+                    [
+                        *NIX_CMD,
+                        "copy",
+                        "--no-check-sigs",
+                        "--to",
+                        "ssh-ng://root@127.0.0.1",
+                        config_path,
+                    ],
+                    env,
+                    cwd=tmpdir,
+                    process_index=DEPLOY_COPY_PROCESS,
+                )
 
         if returncode != 0:
             report_task_finished(task, conn, False, "Copy closure failed")
             return
 
-        # send message to agent on device that it should switch to the new configuration
-        conn.send(
-            models_task.RunnerToControllerTaskUpdate(
-                id=task.id,
-                update=models_task.AgentShouldSwitchToNewConfigurationUpdate(
-                    configuration_id=task_data.device.identifier,
-                    deployment_info_id=task_data.device.deployment_info_id,
-                    path_to_configuration=config_path,
-                    config_commit=task_data.config_commit,
-                ),
-            )
-        )
-
-        # wait for agent to switch to new configuration
-        try:
-            message = process_list.msg_queue.get(timeout=300)
-            if not isinstance(
-                message.inner, models_task.AgentSwitchToNewConfigurationResult
-            ):
-                report_task_finished(task, conn, False, "Unexpected message from agent")
+        with deploy_stage(task, conn, process_list, "activate") as granted:
+            if not granted:
+                # cancelled, also if its rollout halted before this device
+                report_task_finished(task, conn, False, "Task was cancelled")
                 return
-            # write message stdout and stderr to task log
+            # send message to agent on device that it should switch to the new configuration
             conn.send(
                 models_task.RunnerToControllerTaskUpdate(
                     id=task.id,
-                    update=models_task.TaskStdOutErrUpdate(
-                        process_index=2,
-                        stdoutb64=base64.b64encode(
-                            message.inner.stdout.encode("utf-8")
-                        ).decode("utf-8"),
-                        stderrb64=base64.b64encode(
-                            message.inner.stderr.encode("utf-8")
-                        ).decode("utf-8"),
+                    update=models_task.AgentShouldSwitchToNewConfigurationUpdate(
+                        configuration_id=task_data.device.identifier,
+                        deployment_info_id=task_data.device.deployment_info_id,
+                        path_to_configuration=config_path,
+                        config_commit=task_data.config_commit,
                     ),
                 )
             )
-        except queue.Empty:
-            report_task_finished(task, conn, False, "Timeout waiting for agent")
-        except Exception as e:
-            report_task_finished(task, conn, False, f"Exception: {e}")
-        else:
-            if message.inner.success:
-                report_task_finished(task, conn)
+
+            # wait for agent to switch to new configuration
+            try:
+                message = process_list.msg_queue.get(timeout=300)
+                if not isinstance(
+                    message.inner, models_task.AgentSwitchToNewConfigurationResult
+                ):
+                    report_task_finished(
+                        task, conn, False, "Unexpected message from agent"
+                    )
+                    return
+                # write message stdout and stderr to task log
+                send_output(
+                    conn,
+                    task.id,
+                    DEPLOY_ACTIVATE_PROCESS,
+                    message.inner.stdout.encode("utf-8"),
+                    message.inner.stderr.encode("utf-8"),
+                )
+            except queue.Empty:
+                report_task_finished(task, conn, False, "Timeout waiting for agent")
+            except Exception as e:
+                report_task_finished(task, conn, False, f"Exception: {e}")
             else:
-                report_task_finished(task, conn, False, "Agent failed to switch")
+                if message.inner.success:
+                    report_task_finished(task, conn)
+                else:
+                    report_task_finished(task, conn, False, "Agent failed to switch")
 
 
 def deploy_devices_task(
@@ -481,24 +1025,20 @@ def build_device_image_task(
             f"{builder_dir}/{task_data.configuration_id}.secrets-builder"
         )
 
-        returncode = run_command(
+        builder_path, reason = build_configuration(
             task,
             conn,
             process_list,
-            [
-                *NIX_CMD,
-                "build",
-                f'git+file:{repo_path}?rev={task_data.commit}#nixosConfigurations."{task_data.configuration_id}".config.system.build.thymis-image-with-secrets-builder-{architecture}',
-                "--out-link",
-                secrets_builder_dest,
-                "--allow-dirty-locks",
-            ],
-            cwd=repo_path,
-            process_index=0,
+            repo_path,
+            task_data.commit,
+            task_data.configuration_id,
+            secrets_builder_dest,
+            None,
+            repo_path,
+            attribute=f"thymis-image-with-secrets-builder-{architecture}",
         )
-
-        if returncode != 0:
-            report_task_finished(task, conn, False, "Build failed")
+        if builder_path is None:
+            report_task_finished(task, conn, False, reason)
             return
 
         token = f"thymis-{random.randbytes(64).hex()}"  # see agent/thymis_agent/agent.py `AGENT_TOKEN_EXPECTED_FORMAT =`
@@ -587,6 +1127,7 @@ def build_device_image_task(
         report_task_finished(
             task, conn, False, "Image build failed, no image found at destination"
         )
+        return
 
     report_task_finished(task, conn)
 
@@ -815,10 +1356,17 @@ def run_command(
     env: dict = None,
     cwd: str = None,
     input: AnyStr = None,
-    stderr_read_size: int = 1024,
     process_index: int = 0,
+    stdin: int | None = None,
+    on_poll: Callable[[], None] | None = None,
 ):
+    """
+    stdin: a pipe to read the input from instead of input, closed here once
+    the process started. on_poll is called at least every OUTPUT_POLL_INTERVAL
+    """
     if process_list.terminated:
+        if stdin is not None:
+            os.close(stdin)
         return -1
 
     env_without_none = {k: v for k, v in env.items() if v is not None} if env else None
@@ -835,116 +1383,140 @@ def run_command(
         )
     )
 
-    proc = subprocess.Popen(
-        args,
-        env=env_without_none,
-        cwd=cwd,
-        stdin=(subprocess.PIPE if input else None),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        start_new_session=True,  # Creates new process group to isolate children
-    )
+    try:
+        proc = subprocess.Popen(
+            args,
+            env=env_without_none,
+            cwd=cwd,
+            stdin=(subprocess.PIPE if input else stdin),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,  # Creates new process group to isolate children
+        )
+    finally:
+        if stdin is not None:
+            # the writer sees a broken pipe once the process is gone
+            os.close(stdin)
 
     process_list.add(proc)
 
-    buffer_lock = threading.Lock()
     stdout_buffer = bytearray()
     stderr_buffer = bytearray()
-
-    stdout_thread = threading.Thread(
-        target=stream_to_buffer, args=(proc.stdout, stdout_buffer, buffer_lock)
-    )
-    stderr_thread = threading.Thread(
-        target=stream_to_buffer,
-        args=(proc.stderr, stderr_buffer, buffer_lock),
-        kwargs={"read_size": stderr_read_size},
-    )
-
     nix_parser = NixParser()
 
-    # another thread for regularly sending updates to the controller (every second?)
-    # this thread should also clear the buffers after sending
-    def flush_buffers():
-        nonlocal stdout_buffer
-        nonlocal stderr_buffer
-        if stdout_buffer or stderr_buffer:
-            with buffer_lock:
-                stdout = stdout_buffer.copy()
-                stdout_buffer.clear()
-                if proc.poll() is None:
-                    stderr = nix_parser.take_complete_lines(stderr_buffer)
-                else:
-                    stderr = stderr_buffer.copy()
-                    stderr_buffer.clear()
+    def flush_buffers(final=False):
+        stdout = stdout_buffer.copy()
+        stdout_buffer.clear()
+        if final:
+            stderr = stderr_buffer.copy()
+            stderr_buffer.clear()
+        else:
+            # incomplete nix lines are kept until the rest of the line arrives
+            stderr = nix_parser.take_complete_lines(stderr_buffer)
 
-            has_processed_nix_lines = nix_parser.process_buffer(stderr)
-            if has_processed_nix_lines:
-                conn.send(
-                    models_task.RunnerToControllerTaskUpdate(
-                        id=task.id,
-                        update=models_task.TaskNixStatusUpdate(
-                            process_index=process_index, status=nix_parser.get_model()
-                        ),
-                    )
-                )
-            if stdout or stderr:
-                conn.send(
-                    models_task.RunnerToControllerTaskUpdate(
-                        id=task.id,
-                        update=models_task.TaskStdOutErrUpdate(
-                            process_index=process_index,
-                            stdoutb64=base64.b64encode(stdout).decode("utf-8"),
-                            stderrb64=base64.b64encode(stderr).decode("utf-8"),
-                        ),
-                    )
+        has_processed_nix_lines = nix_parser.process_buffer(stderr)
+        if has_processed_nix_lines:
+            conn.send(
+                models_task.RunnerToControllerTaskUpdate(
+                    id=task.id,
+                    update=models_task.TaskNixStatusUpdate(
+                        process_index=process_index,
+                        status=nix_parser.take_status_update(),
+                    ),
                 )
+            )
+        if stdout or stderr:
+            send_output(conn, task.id, process_index, stdout, stderr)
 
-    def send_update():
-        while stdout_buffer or stderr_buffer or (proc.poll() is None):
+    def kill_process_group():
+        # Kill the entire process group to ensure SSH and any child processes are cleaned up
+        # This closes any lingering pipes that might be keeping stderr open
+        # (start_new_session made proc.pid the process group id)
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        except Exception:
+            pass
+
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ, stdout_buffer)
+    selector.register(proc.stderr, selectors.EVENT_READ, stderr_buffer)
+    if input:
+        pending_input = memoryview(
+            input.encode("utf-8") if isinstance(input, str) else input
+        )
+        os.set_blocking(proc.stdin.fileno(), False)
+        selector.register(proc.stdin, selectors.EVENT_WRITE)
+
+    last_flush = time.monotonic()
+    # when the oldest unflushed output arrived, None if nothing is pending
+    pending_since = None
+    has_complete_line = False
+    exited_at = None
+
+    while selector.get_map():
+        now = time.monotonic()
+        timeout = OUTPUT_POLL_INTERVAL
+        if has_complete_line:
+            timeout = last_flush + OUTPUT_FLUSH_MIN_INTERVAL - now
+        elif pending_since is not None:
+            timeout = min(timeout, pending_since + OUTPUT_FLUSH_MAX_DELAY - now)
+
+        for key, _ in selector.select(max(timeout, 0)):
+            if key.fileobj is proc.stdin:
+                try:
+                    written = os.write(key.fd, pending_input[:OUTPUT_READ_SIZE])
+                except BrokenPipeError:
+                    written = len(pending_input)
+                pending_input = pending_input[written:]
+                if not pending_input:
+                    selector.unregister(proc.stdin)
+                    proc.stdin.close()
+                continue
+            data = os.read(key.fd, OUTPUT_READ_SIZE)
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            key.data.extend(data)
+            if pending_since is None:
+                pending_since = time.monotonic()
+            has_complete_line = has_complete_line or b"\n" in data
+
+        if on_poll is not None:
+            on_poll()
+
+        # flush as soon as a line is complete, but at most every
+        # OUTPUT_FLUSH_MIN_INTERVAL, so a chatty process is sent in batches
+        now = time.monotonic()
+        if pending_since is not None and (
+            (has_complete_line and now - last_flush >= OUTPUT_FLUSH_MIN_INTERVAL)
+            or now - pending_since >= OUTPUT_FLUSH_MAX_DELAY
+            or len(stdout_buffer) + len(stderr_buffer) >= OUTPUT_FLUSH_MAX_BYTES
+        ):
             flush_buffers()
-            time.sleep(0.5)
-
-    update_thread = threading.Thread(target=send_update)
-
-    stdout_thread.start()
-    stderr_thread.start()
-    update_thread.start()
+            last_flush = now
+            has_complete_line = False
+            pending_since = now if stdout_buffer or stderr_buffer else None
+
+        if exited_at is None and proc.poll() is not None:
+            exited_at = now
+            kill_process_group()
+        if exited_at is not None and now - exited_at >= OUTPUT_DRAIN_TIMEOUT:
+            print("Warning: output pipes still open after process termination")
+            break
 
-    if input:
-        proc.stdin.write(input)
+    selector.close()
+    if input and not proc.stdin.closed:
         proc.stdin.close()
+    proc.stdout.close()
+    proc.stderr.close()
     proc.wait()
-
-    # Kill the entire process group to ensure SSH and any child processes are cleaned up
-    # This closes any lingering pipes that might be keeping stderr open
-    try:
-        pgid = os.getpgid(proc.pid)
-        os.killpg(pgid, signal.SIGTERM)
-        # Give processes a moment to terminate gracefully
-        time.sleep(0.1)
-    except ProcessLookupError:
-        pass
-    except Exception:
-        pass
-
-    stdout_thread.join(0.5)
-    stderr_thread.join(0.5)
-    update_thread.join(1.5)
+    if exited_at is None:
+        kill_process_group()
 
     # Do a final flush to capture any remaining data
-    with buffer_lock:
-        if stdout_buffer or stderr_buffer:
-            flush_buffers()
-
-    # if anything is still alive, don't fail - the data has been captured
-    if proc.poll() is None:
-        raise RuntimeError("Process did not stop properly")
-    # complain about still living threads
-    if stdout_thread.is_alive() or stderr_thread.is_alive() or update_thread.is_alive():
-        print("Warning: One of the IO threads is still alive after process termination")
-        print(f"stdout_thread alive: {stdout_thread.is_alive()}")
-        print(f"stderr_thread alive: {stderr_thread.is_alive()}")
-        print(f"update_thread alive: {update_thread.is_alive()}")
+    flush_buffers(final=True)
 
     return proc.returncode
 
@@ -964,15 +1536,3 @@ def report_task_finished(task, conn, success=True, reason=None):
                 update=models_task.TaskFailedUpdate(reason=reason),
             )
         )
-
-
-def stream_to_buffer(
-    stream: IO[bytes], buffer: bytearray, lock: threading.Lock, read_size=1024
-):
-    while True:
-        data = stream.read(read_size)
-        if not data:
-            break
-        with lock:
-            buffer += data
-    stream.close()
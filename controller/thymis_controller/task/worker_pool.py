@@ -0,0 +1,111 @@
+import collections
+import multiprocessing
+import multiprocessing.forkserver
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Literal, Optional
+
+import thymis_controller.models.task as models_task
+
+type WorkerPoolKind = Literal["cpu", "io"]
+
+# imported once by the forkserver, workers are forked from it with these
+# modules already loaded instead of from the controller process
+WORKER_PRELOAD = ["thymis_controller.task.worker"]
+
+# start latencies kept per pool for the reported statistics
+LATENCY_SAMPLES = 1000
+
+
+def forkserver_context():
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(WORKER_PRELOAD)
+    return context
+
+
+def start_forkserver():
+    """Start the forkserver and import the preloaded modules ahead of the first task"""
+    forkserver_context()
+    multiprocessing.forkserver.ensure_running()
+
+
+def create_worker_pool(workers: int, max_tasks_per_child: int) -> ProcessPoolExecutor:
+    """
+    A process pool whose workers are forked from a forkserver instead of the
+    controller, so they do not inherit the controller's memory and threads.
+    Workers exit after `max_tasks_per_child` tasks and are replaced.
+    """
+    context = forkserver_context()
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        max_tasks_per_child=max_tasks_per_child,
+    )
+
+
+class WorkerPoolMetrics:
+    """Start latency of tasks and peak RSS of the workers, per pool"""
+
+    def __init__(self, workers: dict[WorkerPoolKind, int]):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._starting: dict[uuid.UUID, tuple[WorkerPoolKind, float]] = {}
+        self._latencies = {
+            kind: collections.deque(maxlen=LATENCY_SAMPLES) for kind in workers
+        }
+        self._started = {kind: 0 for kind in workers}
+        # peak RSS by worker pid, workers are replaced so only the latest
+        # reports of each pool are kept
+        self._worker_rss: dict[WorkerPoolKind, collections.OrderedDict[int, int]] = {
+            kind: collections.OrderedDict() for kind in workers
+        }
+
+    def task_submitted(self, task_id: uuid.UUID, kind: WorkerPoolKind):
+        with self._lock:
+            self._starting[task_id] = (kind, time.monotonic())
+
+    def task_picked(
+        self,
+        task_id: uuid.UUID,
+        worker_pid: Optional[int],
+        worker_max_rss: Optional[int],
+    ):
+        with self._lock:
+            starting = self._starting.pop(task_id, None)
+            if starting is None:
+                return
+            kind, submitted_at = starting
+            self._latencies[kind].append(time.monotonic() - submitted_at)
+            self._started[kind] += 1
+            if worker_pid is not None and worker_max_rss is not None:
+                worker_rss = self._worker_rss[kind]
+                worker_rss.pop(worker_pid, None)
+                worker_rss[worker_pid] = worker_max_rss
+                while len(worker_rss) > self.workers[kind]:
+                    worker_rss.popitem(last=False)
+
+    def task_finished(self, task_id: uuid.UUID):
+        with self._lock:
+            self._starting.pop(task_id, None)
+
+    def stats(self) -> list[models_task.WorkerPoolStats]:
+        with self._lock:
+            result = []
+            for kind, workers in self.workers.items():
+                latencies = sorted(self._latencies[kind])
+                result.append(
+                    models_task.WorkerPoolStats(
+                        pool=kind,
+                        workers=workers,
+                        tasks_started=self._started[kind],
+                        start_latency_median_seconds=(
+                            statistics.median(latencies) if latencies else None
+                        ),
+                        start_latency_max_seconds=max(latencies, default=None),
+                        worker_max_rss_bytes=dict(self._worker_rss[kind]),
+                    )
+                )
+            return result
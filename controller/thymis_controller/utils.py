@@ -49,3 +49,29 @@ def determine_first_host_with_key(
                 return host
 
     return None
+
+
+def complete_utf8_length(data: bytes) -> int:
+    """Length of the longest prefix of `data` that does not end inside a UTF-8 character"""
+    for back in range(1, min(len(data), 4) + 1):
+        byte = data[-back]
+        if byte & 0xC0 != 0x80:
+            # lead byte of the last character, or an ascii byte
+            if byte >= 0xF0:
+                expected = 4
+            elif byte >= 0xE0:
+                expected = 3
+            elif byte >= 0xC0:
+                expected = 2
+            else:
+                expected = 1
+            return len(data) if back >= expected else len(data) - back
+    return len(data)
+
+
+def utf8_continuation_length(data: bytes) -> int:
+    """Number of bytes at the start of `data` that belong to a character begun before it"""
+    length = 0
+    while length < min(len(data), 3) and data[length] & 0xC0 == 0x80:
+        length += 1
+    return length
@@ -54,8 +54,15 @@ export type Task = {
 
 	parent_task_id?: string;
 	children?: string[];
+	output_archived?: boolean;
+
+	// offset of the first byte of stdout or stderr that was received, by
+	// process index, for the streams whose earlier output was left out
+	output_start?: OutputStart;
 };
 
+type OutputStart = Record<number, { stdout?: number; stderr?: number }>;
+
 export type TaskShort = {
 	id: string;
 	task_type: string;
@@ -65,6 +72,9 @@ export type TaskShort = {
 	end_time?: string;
 	exception?: string;
 	task_submission_data: Record<string, unknown>;
+	last_update_time?: string;
+	device_identifier?: string;
+	error_headline?: string;
 
 	nix_status?: {
 		done: number;
@@ -82,19 +92,39 @@ type ShortTaskMessage = {
 	task: TaskShort;
 };
 
+// how much output of each process was received, sent back when subscribing
+// again after a reconnect so only the missing output is sent
+type TaskCursor = Record<
+	string,
+	{
+		send_stdout: number;
+		send_stderr: number;
+		send_nix_errors: number;
+		send_nix_error_logs: number;
+		send_nix_warning_logs: number;
+		send_nix_notice_logs: number;
+		send_nix_info_logs: number;
+	}
+>;
+
 type SubscripedTaskMessage = {
 	type: 'subscribed_task';
 	task_id: string;
 	task: Task;
+	cursor: TaskCursor;
+	output_start: OutputStart;
 };
 
 type SubscripedTaskOutputMessage = {
 	type: 'subscribed_task_output';
 	task_id: string;
-	task: Task;
+	processes: TaskProcess[];
+	cursor: TaskCursor;
 };
 
 let socket: WebSocket | undefined;
+let subscribedCursor: TaskCursor = {};
+let resumingTask: string | undefined;
 
 export const taskStatus = writable<Record<string, TaskShort>>({});
 export const subscribedTask = writable<Task | null>(null);
@@ -113,8 +143,17 @@ export const getAllTasks = async (
 	};
 };
 
-export const getTask = async (taskId: string, fetch: typeof window.fetch = window.fetch) => {
-	const response = await fetchWithNotify(`/api/tasks/${taskId}`, undefined, {}, fetch);
+export const getTask = async (
+	taskId: string,
+	fetch: typeof window.fetch = window.fetch,
+	includeOutput = true
+) => {
+	const response = await fetchWithNotify(
+		`/api/tasks/${taskId}?include_output=${includeOutput}`,
+		undefined,
+		{},
+		fetch
+	);
 	return (await response.json()) as Task;
 };
 
@@ -140,6 +179,24 @@ export const retryTask = async (taskId: string, fetch: typeof window.fetch = win
 	return response;
 };
 
+export const restoreTaskOutput = async (
+	taskId: string,
+	fetch: typeof window.fetch = window.fetch
+) => {
+	const response = await fetchWithNotify(
+		`/api/tasks/${taskId}/restore-output`,
+		{ method: 'POST' },
+		{},
+		fetch
+	);
+	if (response.ok && get(subscribedTask)?.id === taskId) {
+		// subscribe again to receive the restored output
+		subscribedTask.set(null);
+		await subscribeTask(taskId);
+	}
+	return response;
+};
+
 let resolvePromise: () => void;
 let socketPromise = new Promise<void>((resolve) => {
 	resolvePromise = resolve;
@@ -152,9 +209,13 @@ const isSameProcess = (a: TaskProcess, b: TaskProcess) => {
 const mergeProcesses = (existingProcesses: TaskProcess[], incomingProcesses: TaskProcess[]) => {
 	const results: TaskProcess[] = incomingProcesses.map((incoming) => {
 		const existing = existingProcesses.find((p) => isSameProcess(p, incoming));
+		// fields that did not change are sent as null
+		const changed = Object.fromEntries(
+			Object.entries(incoming).filter(([, value]) => value !== null && value !== undefined)
+		);
 		return {
 			...existing,
-			...incoming,
+			...changed,
 			process_stdout: (existing?.process_stdout ?? '') + (incoming.process_stdout ?? ''),
 			process_stderr: (existing?.process_stderr ?? '') + (incoming.process_stderr ?? ''),
 			nix_errors: (existing?.nix_errors ?? []).concat(incoming.nix_errors ?? []),
@@ -174,6 +235,26 @@ const mergeProcesses = (existingProcesses: TaskProcess[], incomingProcesses: Tas
 	return results;
 };
 
+// a resumed subscription sends only the tail of streams the client fell far
+// behind on, the output received of them before is replaced
+const restartOutput = (task: Task, outputStart: OutputStart): Task => {
+	const restarted = (stream: 'stdout' | 'stderr', process: TaskProcess, text?: string) =>
+		outputStart[process.process_index]?.[stream] !== undefined ? '' : text;
+	const mergedStart: OutputStart = { ...task.output_start };
+	for (const [processIndex, start] of Object.entries(outputStart)) {
+		mergedStart[Number(processIndex)] = { ...mergedStart[Number(processIndex)], ...start };
+	}
+	return {
+		...task,
+		output_start: mergedStart,
+		processes: (task.processes ?? []).map((process) => ({
+			...process,
+			process_stdout: restarted('stdout', process, process.process_stdout),
+			process_stderr: restarted('stderr', process, process.process_stderr)
+		}))
+	};
+};
+
 const startSocket = () => {
 	console.log('starting task_status socket');
 	// get schemed from current location
@@ -182,6 +263,13 @@ const startSocket = () => {
 	socket.onopen = () => {
 		console.log('task_status socket opened');
 		resolvePromise();
+		const task = get(subscribedTask);
+		if (task) {
+			resumingTask = task.id;
+			socket?.send(
+				JSON.stringify({ type: 'subscribe_task', task_id: task.id, cursor: subscribedCursor })
+			);
+		}
 	};
 	socket.onmessage = async (event) => {
 		const data = JSON.parse(event.data) as
@@ -201,13 +289,30 @@ const startSocket = () => {
 				return task;
 			});
 		} else if (data.type === 'subscribed_task') {
-			subscribedTask.set(data.task);
+			subscribedCursor = data.cursor;
+			if (resumingTask === data.task_id) {
+				resumingTask = undefined;
+				subscribedTask.update((task) => {
+					if (task && task.id === data.task_id) {
+						const resumed = restartOutput(task, data.output_start ?? {});
+						return {
+							...data.task,
+							output_start: resumed.output_start,
+							processes: mergeProcesses(resumed.processes, data.task.processes ?? [])
+						};
+					}
+					return { ...data.task, output_start: data.output_start };
+				});
+			} else {
+				subscribedTask.set({ ...data.task, output_start: data.output_start });
+			}
 		} else if (data.type === 'subscribed_task_output') {
 			subscribedTask.update((task) => {
 				if (task && task.id === data.task_id) {
+					subscribedCursor = data.cursor;
 					return {
-						...data.task,
-						processes: mergeProcesses(task.processes ?? [], data.task.processes ?? [])
+						...task,
+						processes: mergeProcesses(task.processes ?? [], data.processes ?? [])
 					};
 				}
 				return task;
@@ -223,10 +328,59 @@ const startSocket = () => {
 	};
 };
 
+// output loaded per request when scrolling back before the received tail
+const EARLIER_OUTPUT_BYTES = 256 * 1024;
+
+export const loadEarlierOutput = async (
+	taskId: string,
+	processIndex: number,
+	stream: 'stdout' | 'stderr',
+	fetch: typeof window.fetch = window.fetch
+) => {
+	const end = get(subscribedTask)?.output_start?.[processIndex]?.[stream];
+	if (!end) return;
+	const start = Math.max(end - EARLIER_OUTPUT_BYTES, 0);
+	const response = await fetchWithNotify(
+		`/api/tasks/${taskId}/processes/${processIndex}/${stream}?start=${start}&end=${end}`,
+		undefined,
+		{},
+		fetch
+	);
+	if (!response.ok) return;
+	const bytes = new Uint8Array(await response.arrayBuffer());
+	// start at a character boundary, the skipped bytes come with the next range
+	let skipped = 0;
+	while (start > 0 && skipped < Math.min(bytes.length, 3) && (bytes[skipped] & 0xc0) === 0x80) {
+		skipped++;
+	}
+	const text = new TextDecoder().decode(bytes.subarray(skipped));
+	const key = stream === 'stdout' ? 'process_stdout' : 'process_stderr';
+	subscribedTask.update((task) => {
+		// another request may have loaded this range already
+		if (!task || task.id !== taskId || task.output_start?.[processIndex]?.[stream] !== end) {
+			return task;
+		}
+		return {
+			...task,
+			output_start: {
+				...task.output_start,
+				[processIndex]: { ...task.output_start[processIndex], [stream]: start + skipped }
+			},
+			processes: task.processes.map((process) =>
+				process.process_index === processIndex
+					? { ...process, [key]: text + (process[key] ?? '') }
+					: process
+			)
+		};
+	});
+};
+
 export const subscribeTask = async (taskId: string) => {
 	await socketPromise;
 	if (!socket || taskId === get(subscribedTask)?.id) return;
 	subscribedTask.set(null);
+	subscribedCursor = {};
+	resumingTask = undefined;
 	socket.send(JSON.stringify({ type: 'subscribe_task', task_id: taskId }));
 };
 
@@ -4,7 +4,8 @@ import { error } from '@sveltejs/kit';
 
 export const load = (async ({ params, fetch }) => {
 	try {
-		const task = await getTask(params.id, fetch);
+		// the output is sent with the task subscription
+		const task = await getTask(params.id, fetch, false);
 		return {
 			task,
 			task_id: params.id